@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#bench_control - encode/decode cost of control letters, JSON against binary envelopes
+import argparse
+import os
+import timeit
+from uuid import uuid4
+
+from tpft import (
+    Envelope, ConfirmationLetter, ConnectionCloseLetter, UploadRequestLetter, ChunkDigestLetter, FileBatchLetter,
+    CONTROL_JSON, CONTROL_BINARY,
+)
+
+arg_parser = argparse.ArgumentParser(description='Compare per letter encode and decode cost of the JSON and binary control encodings')
+arg_parser.add_argument('-n', '--number', action='store', type=int, default=2000, help='Iterations per measurement. Default 2000')
+
+
+def sample_letters():
+    close = ConnectionCloseLetter()
+
+    upload = UploadRequestLetter()
+    upload.FileSize = 734003200
+    upload.DestinationPath = '/srv/data/backups/2024/archive-0001.tar'
+    upload.TransferId = str(uuid4())
+    upload.Resume = False
+    upload.SourceModified = 1718000000123456789
+    upload.Digest = 'blake2b'
+    upload.Compression = 'zlib'
+
+    confirmation = ConfirmationLetter()
+    confirmation.Ranges = [(offset, 4 * 1024 * 1024) for offset in range(0, 64 * 4 * 1024 * 1024, 4 * 1024 * 1024)]
+    confirmation.Digest = 'blake2b'
+
+    digests = ChunkDigestLetter()
+    digests.Algorithm = 'blake2b'
+    digests.Digests = [os.urandom(64) for x in range(256)]
+
+    batch = FileBatchLetter()
+    batch.DestinationPath = '/srv/data/tree'
+    batch.Directories = [('data/d{}'.format(d), 0o755) for d in range(16)]
+    batch.Files = [('data/d{}/file-{}.txt'.format(f % 16, f), 1000 + f, 1718000000123456789 + f, 0o644) for f in range(1024)]
+
+    return [
+        ('close', close),
+        ('upload-request', upload),
+        ('confirmation 64 ranges', confirmation),
+        ('chunk-digests 256', digests),
+        ('file-batch 1024 files', batch),
+    ]
+
+def measure(letter, encoding, number):
+    envelope = Envelope(letter)
+    encoded = envelope.encode(encoding)
+    encode_time = timeit.timeit(lambda: Envelope(letter).encode(encoding), number=number) / number
+    decode_time = timeit.timeit(lambda: Envelope(encoded), number=number) / number
+    return len(encoded), encode_time, decode_time
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    print('{:<24} {:>7} {:>10} {:>12} {:>12}'.format('letter', 'format', 'bytes', 'encode us', 'decode us'))
+    for name, letter in sample_letters():
+        for encoding in (CONTROL_JSON, CONTROL_BINARY):
+            number = max(args.number // max(len(str(Envelope(letter))) // 1024, 1), 10)
+            size, encode_time, decode_time = measure(letter, encoding, number)
+            print('{:<24} {:>7} {:>10} {:>12.2f} {:>12.2f}'.format(name, encoding, size, encode_time * 1e6, decode_time * 1e6))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#bench_engines - concurrent uploads against the threads and asyncio server engines
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from tpft import Envelope, UploadRequestLetter, ConfirmationLetter, ConnectionCloseLetter, ENGINE_THREADS, ENGINE_ASYNCIO
+from tinyproto.connection import SC_OK
+
+arg_parser = argparse.ArgumentParser(description='Run concurrent uploads against each server engine and report time, latency and server memory')
+arg_parser.add_argument('--engines', action='store', type=str, default='{},{}'.format(ENGINE_THREADS, ENGINE_ASYNCIO), help='Comma separated engines to run. Default all')
+arg_parser.add_argument('--concurrency', action='store', type=str, default='10,100,1000', help='Comma separated numbers of concurrent transfers. Default 10,100,1000')
+arg_parser.add_argument('--size', action='store', type=int, default=256 * 1024, help='Bytes uploaded by each transfer. Default 256KB')
+arg_parser.add_argument('--chunk-size', action='store', type=int, default=64 * 1024, help='Bytes per data frame. Default 64KB')
+arg_parser.add_argument('--workers', action='store', type=int, default=1, help='Server worker processes, see tpft.py --workers. Default 1')
+arg_parser.add_argument('--idle', action='store', type=int, default=0, help='Extra connections opened before the transfers and kept idle until they finish')
+arg_parser.add_argument('--json', action='store_true', default=False, help='Print results as JSON')
+
+
+async def transmit(reader, writer, payload):
+    writer.write(len(payload).to_bytes(4, 'big'))
+    status = await reader.readexactly(1)
+    if status[0] != SC_OK:
+        raise ConnectionError('Transmission rejected')
+    writer.write(payload)
+    await writer.drain()
+
+async def receive(reader, writer):
+    size = int.from_bytes(await reader.readexactly(4), 'big')
+    writer.write(bytes((SC_OK, )))
+    return await reader.readexactly(size)
+
+async def open_connection(port):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), 120)
+    writer.write(bytes((SC_OK, )))
+    await reader.readexactly(1)
+    return reader, writer
+
+async def upload(port, destination, payload, chunk_size):
+    started = time.perf_counter()
+    reader, writer = await open_connection(port)
+    try:
+        l = UploadRequestLetter()
+        l.FileSize = len(payload)
+        l.DestinationPath = destination
+        l.TransferId = str(uuid4())
+        await transmit(reader, writer, Envelope(l).encode())
+        if not isinstance(Envelope(await receive(reader, writer)).letter, ConfirmationLetter):
+            raise ConnectionError('Upload rejected')
+        for offset in range(0, len(payload), chunk_size):
+            await transmit(reader, writer, payload[offset:offset + chunk_size])
+        if not isinstance(Envelope(await receive(reader, writer)).letter, ConfirmationLetter):
+            raise ConnectionError('Upload not confirmed')
+    finally:
+        await close_connection(reader, writer)
+    return time.perf_counter() - started
+
+def process_status(pid):
+    status = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            status[name] = value.split()
+    return int(status['VmHWM'][0]) * 1024, int(status['Threads'][0])
+
+def server_status(pid):
+    # peak resident memory in bytes and current thread count of the server,
+    # summed over the workers of a supervisor
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+        pids = [pid] + [int(child) for child in f.read().split()]
+    peak_rss, threads = 0, 0
+    for pid in pids:
+        try:
+            rss, count = process_status(pid)
+        except OSError:
+            continue
+        peak_rss, threads = peak_rss + rss, threads + count
+    return peak_rss, threads
+
+class StatusSampler(threading.Thread):
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.peak_rss, threads = server_status(self.pid)
+            self.peak_threads = max(self.peak_threads, threads)
+            if self.stopped.wait(0.05):
+                return
+
+async def close_connection(reader, writer):
+    await transmit(reader, writer, Envelope(ConnectionCloseLetter()).encode())
+    writer.close()
+
+async def wait_for_server(port, process):
+    while process.poll() is None:
+        try:
+            await close_connection(*await open_connection(port))
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError('Server exited with {}'.format(process.returncode))
+
+async def run_transfers(port, directory, concurrency, args):
+    payload = os.urandom(args.size)
+    idle = [await open_connection(port) for x in range(args.idle)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        upload(port, os.path.join(directory, 'upload-{}'.format(x)), payload, args.chunk_size) for x in range(concurrency)
+    ), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    for reader, writer in idle:
+        await close_connection(reader, writer)
+    return elapsed, results
+
+def run(engine, concurrency, args):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    tpft = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpft.py')
+    process = subprocess.Popen([sys.executable, tpft, '-l', '127.0.0.1:{}'.format(port), '--engine', engine, '--workers', str(args.workers)], stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_for_server(port, process))
+        sampler = StatusSampler(process.pid)
+        sampler.start()
+        with tempfile.TemporaryDirectory() as directory:
+            elapsed, results = asyncio.run(run_transfers(port, directory, concurrency, args))
+        sampler.stopped.set()
+        sampler.join()
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = sorted(r for r in results if isinstance(r, float))
+    return {
+        'engine': engine,
+        'workers': args.workers,
+        'concurrency': concurrency,
+        'idle': args.idle,
+        'seconds': elapsed,
+        'failed': len(results) - len(latencies),
+        'mb_per_s': len(latencies) * args.size / elapsed / 1e6,
+        'p50': latencies[len(latencies) // 2] if latencies else None,
+        'p99': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] if latencies else None,
+        'server_peak_rss': sampler.peak_rss,
+        'server_peak_threads': sampler.peak_threads,
+    }
+
+if __name__ == '__main__':
+    args = arg_parser.parse_args()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        for engine in args.engines.split(','):
+            result = run(engine, concurrency, args)
+            results.append(result)
+            if not args.json:
+                print('{engine:<8} workers={workers:<3} n={concurrency:<5} idle={idle:<5} {seconds:7.2f}s {mb_per_s:8.1f}MB/s p50={p50:.3f}s p99={p99:.3f}s failed={failed} rss={rss:.1f}MB threads={server_peak_threads}'.format(
+                    rss=result['server_peak_rss'] / 1e6, **result
+                ))
+    if args.json:
+        print(json.dumps(results, indent=2))
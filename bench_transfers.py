@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#bench_transfers - upload/download matrix over loopback, run as tpft.py bench
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tpft import TpftClient, ParsedPath, Envelope, ConnectionCloseLetter, DEFAULT_CHUNK_SIZE, ENGINE_THREADS
+from tinyproto.connection import SC_OK
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+FILL_BLOCK = 16 * 1024 * 1024
+
+arg_parser = argparse.ArgumentParser(prog='tpft.py bench', description='Start a local server and measure uploads and downloads over loopback. Results are written as JSON')
+arg_parser.add_argument('--sizes', action='store', type=str, default='1K,64K,1M,16M,256M,1G', help='Comma separated file sizes, K M G suffixes allowed. Default 1K,64K,1M,16M,256M,1G')
+arg_parser.add_argument('--chunk-sizes', action='store', type=str, default='64K,1M,4M,16M', help='Comma separated client chunk sizes. Default 64K,1M,4M,16M')
+arg_parser.add_argument('--concurrency', action='store', type=str, default='1,4,16', help='Comma separated numbers of parallel transfers. Default 1,4,16')
+arg_parser.add_argument('--directions', action='store', type=str, default='upload,download', help='Comma separated directions. Default upload,download')
+arg_parser.add_argument('--scenarios', action='store', type=str, default='file,small,tree', help='file: the size matrix. small: many small files, one request each over a session. tree: the same files as one recursive transfer. Default all')
+arg_parser.add_argument('--small-count', action='store', type=int, default=2000, help='Files in the small and tree scenarios. Default 2000')
+arg_parser.add_argument('--small-size', action='store', type=str, default='4K', help='Size of each file in the small and tree scenarios. Default 4K')
+arg_parser.add_argument('--cell-bytes', action='store', type=str, default='256M', help='Smaller files are transferred repeatedly until a matrix cell moved this much. Default 256M')
+arg_parser.add_argument('--max-transfers', action='store', type=int, default=2000, help='Cap on the transfers of one matrix cell. Default 2000')
+arg_parser.add_argument('--engine', action='store', type=str, default=ENGINE_THREADS, help='Server engine. Default threads')
+arg_parser.add_argument('--dir', action='store', type=str, default=None, help='Directory for the test files, a temporary one by default. Needs room for the largest size about three times')
+arg_parser.add_argument('-o', '--output', action='store', type=str, default=None, help='Write the JSON results here instead of stdout')
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def parse_list(value, parse = parse_size):
+    return [parse(v) for v in value.split(',') if v.strip()]
+
+def fill_file(path, size):
+    # random data, so nothing along the way gets an easy ride on compressible input
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(os.urandom(min(FILL_BLOCK, size)))
+            size -= FILL_BLOCK
+
+def reset_peak_rss(pid):
+    # Linux resets VmHWM on writing 5 to clear_refs, elsewhere the peak stays the process lifetime peak
+    with contextlib.suppress(OSError):
+        with open('/proc/{}/clear_refs'.format(pid), 'w') as f:
+            f.write('5')
+
+def peak_rss(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15, counted from the pid
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+def milliseconds(seconds):
+    return '-' if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+class BenchServer:
+    def __init__(self, engine):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        tpft = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tpft.py')
+        self.process = subprocess.Popen([sys.executable, tpft, '-l', '127.0.0.1:{}'.format(self.port), '--engine', engine], stdout=subprocess.DEVNULL)
+        self.wait_ready()
+
+    def wait_ready(self):
+        # a full handshake and close letter, a bare port probe upsets the threaded server
+        payload = Envelope(ConnectionCloseLetter()).encode()
+        while self.process.poll() is None:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port)) as s:
+                    s.sendall(bytes((SC_OK, )))
+                    s.recv(1)
+                    s.sendall(len(payload).to_bytes(4, 'big'))
+                    s.recv(1)
+                    s.sendall(payload)
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Server exited with {}'.format(self.process.returncode))
+
+    def remote(self, path):
+        return '127.0.0.1:{}:{}'.format(self.port, path)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+class Measurement:
+    # CPU time and peak memory of both ends over one matrix cell
+    def __init__(self, server):
+        self.server = server
+
+    def __enter__(self):
+        reset_peak_rss(self.server.process.pid)
+        reset_peak_rss('self')
+        self.server_cpu = cpu_seconds(self.server.process.pid)
+        self.client_cpu = time.process_time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.started
+        self.client_cpu = time.process_time() - self.client_cpu
+        self.server_cpu = cpu_seconds(self.server.process.pid) - self.server_cpu
+        self.server_peak_rss = peak_rss(self.server.process.pid)
+        self.client_peak_rss = peak_rss('self')
+
+def run_requests(server, chunk_size, concurrency, jobs):
+    # jobs are (direction, source, destination), spread over concurrency workers
+    # sharing one session. Returns sorted per transfer latencies and the failure count
+    client = TpftClient()
+    client.chunk_size = chunk_size
+    latencies, failed = [], [0]
+    lock = threading.Lock()
+    with client.session(concurrency) as session:
+        def worker(index):
+            for direction, source, destination in jobs[index::concurrency]:
+                started = time.perf_counter()
+                try:
+                    if direction == 'upload':
+                        session.upload(source, server.remote(destination)).result()
+                    else:
+                        session.download(server.remote(source), destination).result()
+                except Exception:
+                    with lock:
+                        failed[0] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(concurrency)))
+    return sorted(latencies), failed[0]
+
+def result_row(scenario, direction, size, chunk_size, concurrency, transfers, measurement, latencies, failed):
+    moved = len(latencies) * size
+    return {
+        'scenario': scenario,
+        'direction': direction,
+        'file_size': size,
+        'chunk_size': chunk_size,
+        'concurrency': concurrency,
+        'transfers': transfers,
+        'failed': failed,
+        'bytes': moved,
+        'seconds': measurement.seconds,
+        'mb_per_s': moved / measurement.seconds / 1e6,
+        'files_per_s': len(latencies) / measurement.seconds,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'client_cpu_seconds': measurement.client_cpu,
+        'server_cpu_seconds': measurement.server_cpu,
+        'client_peak_rss': measurement.client_peak_rss,
+        'server_peak_rss': measurement.server_peak_rss,
+    }
+
+def bench_files(server, directory, args, report):
+    cell_bytes = parse_size(args.cell_bytes)
+    for size in parse_list(args.sizes):
+        source = os.path.join(directory, 'source-{}'.format(size))
+        fill_file(source, size)
+        for chunk_size in parse_list(args.chunk_sizes):
+            for concurrency in parse_list(args.concurrency, int):
+                transfers = min(max(concurrency, -(-cell_bytes // size)), max(args.max_transfers, concurrency))
+                for direction in args.directions.split(','):
+                    if direction == 'upload':
+                        jobs = [(direction, source, os.path.join(directory, 'up-{}'.format(x % concurrency))) for x in range(transfers)]
+                    else:
+                        jobs = [(direction, source, os.path.join(directory, 'down-{}'.format(x % concurrency))) for x in range(transfers)]
+                    with Measurement(server) as measurement:
+                        latencies, failed = run_requests(server, chunk_size, concurrency, jobs)
+                    report(result_row('file', direction, size, chunk_size, concurrency, transfers, measurement, latencies, failed))
+        os.unlink(source)
+        for name in os.listdir(directory):
+            if name.startswith(('up-', 'down-')):
+                os.unlink(os.path.join(directory, name))
+
+def make_small_files(directory, count, size):
+    os.makedirs(directory)
+    for x in range(count):
+        with open(os.path.join(directory, 'file-{}'.format(x)), 'wb') as f:
+            f.write(os.urandom(size))
+
+def bench_small(server, directory, args, report):
+    count, size = args.small_count, parse_size(args.small_size)
+    source = os.path.join(directory, 'small-source')
+    make_small_files(source, count, size)
+    names = sorted(os.listdir(source))
+    for concurrency in parse_list(args.concurrency, int):
+        for direction in args.directions.split(','):
+            target = os.path.join(directory, 'small-{}-{}'.format(direction, concurrency))
+            os.makedirs(target)
+            jobs = [(direction, os.path.join(source, name), os.path.join(target, name)) for name in names]
+            with Measurement(server) as measurement:
+                latencies, failed = run_requests(server, DEFAULT_CHUNK_SIZE, concurrency, jobs)
+            report(result_row('small', direction, size, DEFAULT_CHUNK_SIZE, concurrency, count, measurement, latencies, failed))
+
+def bench_tree(server, directory, args, report):
+    count, size = args.small_count, parse_size(args.small_size)
+    source = os.path.join(directory, 'tree-source')
+    make_small_files(source, count, size)
+    for direction in args.directions.split(','):
+        target = os.path.join(directory, 'tree-{}'.format(direction))
+        os.makedirs(target)
+        client = TpftClient()
+        # the tree transfer is one request, so its latency is the whole run
+        with Measurement(server) as measurement:
+            if direction == 'upload':
+                client.upload_tree([ParsedPath(source)], ParsedPath(server.remote(target)), False)
+            else:
+                client.download_tree(ParsedPath(server.remote(source)), ParsedPath(target), False)
+        received = os.path.join(target, 'tree-source')
+        done = len(os.listdir(received)) if os.path.isdir(received) else 0
+        latencies = [measurement.seconds] * done
+        report(result_row('tree', direction, size, DEFAULT_CHUNK_SIZE, 1, count, measurement, latencies, count - done))
+
+def main(argv = None):
+    args = arg_parser.parse_args(argv)
+    results = []
+
+    def report(row):
+        results.append(row)
+        print('{scenario:<6} {direction:<8} size={file_size:<11} chunk={chunk_size:<9} n={concurrency:<3} {mb_per_s:9.1f}MB/s {files_per_s:9.1f}files/s p50={p50}ms p99={p99}ms failed={failed}'.format(
+            **dict(row, p50=milliseconds(row['p50']), p99=milliseconds(row['p99']))
+        ), file=sys.stderr)
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    server = BenchServer(args.engine)
+    # messages printed by the client would end up in the JSON otherwise
+    try:
+        with tempfile.TemporaryDirectory(dir=args.dir) as directory, contextlib.redirect_stdout(sys.stderr):
+            scenarios = args.scenarios.split(',')
+            if 'file' in scenarios:
+                bench_files(server, directory, args, report)
+            if 'small' in scenarios:
+                bench_small(server, directory, args, report)
+            if 'tree' in scenarios:
+                bench_tree(server, directory, args, report)
+    finally:
+        server.stop()
+
+    output = {
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'started': started,
+        'engine': args.engine,
+        'results': results,
+    }
+    if args.output is None:
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+if __name__ == '__main__':
+    main()
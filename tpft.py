@@ -1,13 +1,161 @@
 #!/usr/bin/env python3
 #tpft - tiny proto file transfer
 import os
-from tinyproto import TinyProtoServer, TinyProtoClient, TinyProtoConnection, TinyProtoConnectionDetails
+from tinyproto import TinyProtoServer, TinyProtoClient, TinyProtoConnection, TinyProtoConnectionDetails, TinyProtoError
+from tinyproto.connection import SC_OK, SC_GENERIC_ERROR, MSG_MAX_SIZE
 import argparse
+import asyncio
+import bz2
+import contextlib
+import errno
+import fcntl
+import hashlib
+import ipaddress
 import json
+import lzma
+import mmap
+import queue
+import select
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from stat import S_ISDIR, S_ISREG
+from uuid import uuid4
 
 DEFAULT_CHUNK_SIZE=4 * 1024 * 1024
+MAX_CHUNK_SIZE=256 * 1024 * 1024
 DEFAULT_PORT=8088
+RANGE_ALIGNMENT=64 * 1024
+RESUME_CHECKPOINT_SIZE=64 * 1024 * 1024
+# seconds between looks at the size of a followed file
+FOLLOW_POLL_INTERVAL=0.25
+# a request waiting for admission is told where it stands this often, which also keeps its client from timing out
+ADMISSION_NOTICE_INTERVAL=5
+# seconds between looks at whether the client of a waiting request left
+ADMISSION_POLL_INTERVAL=0.25
+# seconds a file batch waits in line before it is turned away, well within the time a client waits on a frame
+ADMISSION_BATCH_WAIT=60
+# small frames are gathered into writes of this size, ending on RANGE_ALIGNMENT boundaries of the file
+WRITE_COALESCE_SIZE=4 * 1024 * 1024
+# frames per vectored write, well below IOV_MAX
+WRITE_COALESCE_FRAMES=256
+DURABILITY_NONE='none'
+DURABILITY_END='end'
+DURABILITY_PERIODIC='periodic'
+PARTIAL_SUFFIX='.tpft-part'
+# as a local path, stdin for uploads and stdout for downloads
+STREAM_PATH='-'
+PARTIAL_STATE_SUFFIX='.state'
+DEFAULT_DIGEST='blake2b'
+SUPPORTED_DIGESTS=('blake2b', 'blake2s', 'sha256', 'sha512')
+VERIFY_QUEUE_DEPTH=2
+MAX_RETRANSMIT_ROUNDS=3
+DELTA_MIN_BLOCK_SIZE=64 * 1024
+DELTA_MAX_BLOCK_SIZE=8 * 1024 * 1024
+DELTA_TARGET_BLOCK_COUNT=16 * 1024
+DELTA_BATCH_SIZE=32 * 1024 * 1024
+DELTA_WORKERS=os.cpu_count() or 4
+DELTA_SUFFIX='.tpft-delta'
+DELTA_OP_COPY=0x43
+DELTA_OP_LITERAL=0x4c
+# holes shorter than this are sent as data, they are not worth a range of their own
+SPARSE_MIN_HOLE=64 * 1024
+# a file more fragmented than this is sent densely, keeping the extent list within one letter
+SPARSE_MAX_EXTENTS=64 * 1024
+SUPPORTED_COMPRESSIONS=('zlib', 'lzma', 'bz2')
+# fastest level of each codec, the point is to keep up with the network
+DEFAULT_COMPRESSION_LEVELS={'zlib': 1, 'lzma': 0, 'bz2': 1}
+COMPRESSION_LEVEL_RANGES={'zlib': range(0, 10), 'lzma': range(0, 10), 'bz2': range(1, 10)}
+COMPRESSION_WORKERS=min(os.cpu_count() or 4, 8)
+# a compressed chunk must come out below this fraction of its size, or it is sent raw
+COMPRESSION_MIN_RATIO=0.95
+# after a chunk fails to shrink compression is skipped for a doubling number of chunks, up to this
+COMPRESSION_MAX_BACKOFF=64
+BATCH_MAX_FILES=1024
+BATCH_MAX_BYTES=64 * 1024 * 1024
+# entries per manifest letter, a large tree is listed over several letters
+MANIFEST_BATCH_ENTRIES=16 * 1024
+MANIFEST_HASH_WORKERS=min(os.cpu_count() or 4, 8)
+MANIFEST_HASH_BLOCK=1024 * 1024
+# digests of listed trees are kept here between runs, see ManifestCache
+MANIFEST_CACHE_DIR=os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'tpft', 'manifests')
+# when spreading files over connections each file also weighs this many bytes, so many small files spread out too
+SYNC_FILE_WEIGHT=64 * 1024
+CONTROL_JSON='json'
+CONTROL_BINARY='binary'
+BINARY_ENVELOPE_MAGIC=0xb1
+BINARY_ENVELOPE_VERSION=1
+# container keys of every letter, a field is sent as its index. Append only,
+# index 0 means the key name follows as a string
+BINARY_FIELD_NAMES=(
+    None, 'offset', 'length', 'ranges', 'digest', 'block_size', 'block_count', 'compression', 'transfer_digest',
+    'failed', 'file_size', 'modified', 'reason', 'destination_path', 'transfer_id', 'resume', 'source_modified',
+    'delta', 'download_path', 'chunk_size', 'compression_level', 'algorithm', 'digests', 'chunks', 'directories',
+    'files', 'encodings', 'fields', 'transfers', 'global_limit', 'client_limit', 'connection_limit',
+    'extents', 'sparse', 'manifest_path', 'paths', 'follow', 'stream', 'queue', 'position',
+    'delta_digest',
+)
+BINARY_FIELD_CODES={name: code for code, name in enumerate(BINARY_FIELD_NAMES) if name is not None}
+BINARY_NONE=0
+BINARY_FALSE=1
+BINARY_TRUE=2
+BINARY_INT=3
+BINARY_STR=4
+BINARY_LIST=5
+# homogeneous lists are packed in bulk, a table is a list of equal length rows sent column by column
+BINARY_INT_LIST=6
+BINARY_STR_LIST=7
+BINARY_TABLE=8
+# finished transfers a server keeps around for stats requests, next to the running ones
+TRANSFER_HISTORY=64
+# seconds of samples behind the instantaneous throughput of a transfer
+INSTANT_WINDOW=1.0
+# columns of every row of a stats letter, all times in microseconds and throughputs in bytes per second.
+# bound names what the transfer spent most of its time on: network, disk, throttled or cpu
+TRANSFER_METRICS_FIELDS=(
+    'id', 'peer', 'direction', 'path', 'size', 'bytes', 'active', 'elapsed_us', 'average_bps', 'instant_bps',
+    'network_send_us', 'network_receive_us', 'disk_read_us', 'disk_write_us', 'other_us', 'bound', 'throttled_us',
+)
+# bytes a shaped connection reserves at a time. Waiting connections take turns
+# per quantum, so each gets an equal share of a saturated limit
+SHAPING_QUANTUM=64 * 1024
+# connections a session keeps open to one host:port, requests beyond that wait for a free one
+DEFAULT_SESSION_CONNECTIONS=4
+ENGINE_THREADS='threads'
+ENGINE_ASYNCIO='asyncio'
+ASYNC_DISK_WORKERS=16
+ASYNC_LISTEN_BACKLOG=4096
+# a worker that dies sooner than this after it started is replaced only once this much has passed
+WORKER_RESTART_INTERVAL=1
+# seconds a worker waits on each sibling when collecting stats or passing on limits
+WORKER_QUERY_TIMEOUT=2
+# socket bytes buffered per connection before reading pauses
+ASYNC_STREAM_LIMIT=1024 * 1024
+CHUNK_RAW=0
+CHUNK_COMPRESSED=1
+
+# weak adler32 and strong 128 bit blake2b checksum of one block
+SIGNATURE_ENTRY=struct.Struct('!I16s')
+# copy a run of block count blocks of the basis file, starting at block first
+DELTA_COPY=struct.Struct('!BQI')
+# literal data of the given length follows
+DELTA_LITERAL=struct.Struct('!BI')
+# magic, version, letter code and field count of a binary envelope
+BINARY_ENVELOPE_HEADER=struct.Struct('!BBBB')
+BINARY_INT_VALUE=struct.Struct('!q')
+BINARY_LENGTH=struct.Struct('!I')
+# leads every data frame of a compressed transfer: CHUNK_RAW or CHUNK_COMPRESSED, then the decoded length
+CHUNK_HEADER=struct.Struct('!BI')
 
 class RemoteHostInvalidError(Exception):
     pass
@@ -33,17 +181,92 @@ class MultipleRemotePathsError(Exception):
 class NoRemotePathError(Exception):
     pass
 
+class InvalidChunkSizeError(Exception):
+    pass
+
+class InvalidStreamCountError(Exception):
+    pass
+
+class InvalidQueueDepthError(Exception):
+    pass
+
+class IntegrityCheckFailedError(Exception):
+    pass
+
+class InvalidCompressionLevelError(Exception):
+    pass
+
+class DirectoryRequiresRecursiveError(Exception):
+    pass
+
+class TransferRejectedError(Exception):
+    pass
+
+class SessionClosedError(Exception):
+    pass
+
+class InvalidRateLimitError(Exception):
+    pass
+
+class InvalidDurabilityError(Exception):
+    pass
+
+class InvalidLengthError(Exception):
+    pass
+
+class RangeRequiresDownloadError(Exception):
+    pass
+
+class StreamRequiresSingleFileError(Exception):
+    pass
+
+class InvalidAdmissionLimitError(Exception):
+    pass
+
+class InvalidWorkerCountError(Exception):
+    pass
+
+class TransfersBelowWorkersError(Exception):
+    pass
+
 arg_parser = argparse.ArgumentParser('Client/Server file transfer tool.')
 arg_parser.add_argument('-l', '--listen', action='store', type=str, help='Start listener server instead of uploading/downloading a file')
 arg_parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Enable verbosity. UNIMPLEMENTED')
-arg_parser.add_argument('-p', '--progress', action='store_true', default=False, help='Display progress information. UNIMPLEMENTED')
+arg_parser.add_argument('-p', '--progress', action='store_true', default=False, help='Display progress information. A server prints the throughput of its running transfers every second')
 arg_parser.add_argument('--chunk-size', action='store', type=int, default=DEFAULT_CHUNK_SIZE, help='Default chunk size. File will be split into chunks for transfer. Default size {}MB'.format(DEFAULT_CHUNK_SIZE/1024/1024))
-arg_parser.add_argument('path', action='store', type=str, nargs='*', help='Source and destination file paths. There can be multiple local paths, but only one remote path')
+arg_parser.add_argument('--streams', action='store', type=int, default=1, help='Number of parallel connections used to transfer a single file. Each connection moves its own byte range. With --sync, the number of connections changed files are spread over. Default 1')
+arg_parser.add_argument('--resume', action='store_true', default=False, help='Resume an interrupted transfer. Only bytes missing from the destination are sent')
+arg_parser.add_argument('--queue-depth', action='store', type=int, default=0, help='Number of chunks kept in flight between disk and network by a background I/O thread. 0 disables pipelining and sends straight from the page cache. Default 0')
+arg_parser.add_argument('--verify', action='store_true', default=False, help='Verify transferred data with per-chunk digests, retransmitting chunks that do not match. The transfer is confirmed with a chunk-list digest, a hash over the chunk digests that is not comparable with sha256sum and similar tools')
+arg_parser.add_argument('--digest', action='store', type=str, default=DEFAULT_DIGEST, choices=SUPPORTED_DIGESTS, help='Digest algorithm used by --verify. Default {}'.format(DEFAULT_DIGEST))
+arg_parser.add_argument('--offset', action='store', type=int, default=None, help='Download the remote file from this byte on. A negative offset counts back from the end of the file, -10485760 fetches its last 10MB')
+arg_parser.add_argument('--length', action='store', type=int, default=None, help='Download at most this many bytes of the remote file. Defaults to the rest of the file')
+arg_parser.add_argument('--follow', action='store_true', default=False, help='Keep a download open and append what is added to the remote file, like tail -f, until interrupted. Uses a single connection')
+arg_parser.add_argument('--delta', action='store_true', default=False, help='Upload only the blocks that differ from the file already at the destination. Applies to single stream uploads that are not resumed')
+arg_parser.add_argument('--compress', action='store', type=str, default=None, choices=SUPPORTED_COMPRESSIONS, help='Compress data on the wire with the given codec. Chunks that do not shrink are sent raw')
+arg_parser.add_argument('--compress-level', action='store', type=int, default=None, help='Compression level passed to the codec. Defaults to the fastest level of the codec')
+arg_parser.add_argument('-r', '--recursive', action='store_true', default=False, help='Transfer directories recursively. All files go through a single connection, placed inside the destination directory')
+arg_parser.add_argument('--sync', action='store_true', default=False, help='Transfer directories recursively, skipping files whose size and modification time match the destination. Files missing from the source are left in place')
+arg_parser.add_argument('--checksum', action='store_true', default=False, help='With --sync, compare files by their --digest instead of modification time. Digests are cached between runs and only recomputed for files that changed')
+arg_parser.add_argument('--control', action='store', type=str, default=CONTROL_BINARY, choices=(CONTROL_BINARY, CONTROL_JSON), help='Encoding of control messages. Binary is offered on the first message and JSON is kept when the server does not take it up. Default {}'.format(CONTROL_BINARY))
+arg_parser.add_argument('--engine', action='store', type=str, default=ENGINE_THREADS, choices=(ENGINE_THREADS, ENGINE_ASYNCIO), help='Server engine. threads runs a thread per connection, asyncio serves every connection from one event loop with disk I/O on a bounded thread pool. asyncio does not serve --compress or --delta, clients fall back to uncompressed and full transfers and say so. Default {}'.format(ENGINE_THREADS))
+arg_parser.add_argument('--workers', action='store', type=int, default=1, help='Server processes sharing the listening port through SO_REUSEPORT, so transfers spread over CPU cores. A supervisor starts them and replaces any that dies. --stats and --limits cover every worker. --rate-limit, --max-transfers and --max-inflight are split evenly between the workers, a connection is held to the share of the worker it landed on. --client-rate-limit, --connection-rate-limit and --cache-size apply to each worker on its own, since the connections of one client may land on different workers. Default 1')
+arg_parser.add_argument('--cache-size', action='store', type=int, default=0, help='Bytes of memory mapped file data the server keeps for repeated downloads, least recently used files are dropped first. 0 disables the cache. Default 0')
+arg_parser.add_argument('--durability', action='store', type=str, default=DURABILITY_NONE, metavar='{none,end,periodic:N}', help='When received files are synced to disk. none leaves it to the OS, end syncs each file before it is renamed into place, periodic:N also syncs every N MB so resume state never covers unsynced data. Default none')
+arg_parser.add_argument('--rate-limit', action='store', type=int, default=None, help='Bytes per second a server sends over all connections together. 0 or unset means unlimited')
+arg_parser.add_argument('--client-rate-limit', action='store', type=int, default=None, help='Bytes per second a server sends to one client address over all its connections. 0 or unset means unlimited')
+arg_parser.add_argument('--connection-rate-limit', action='store', type=int, default=None, help='Bytes per second a server sends over one connection. 0 or unset means unlimited')
+arg_parser.add_argument('--max-transfers', action='store', type=int, default=0, help='Transfers a server runs at once, each file batch of an -r or --sync upload counting as one. Requests beyond it wait in line on the server and are let in as transfers finish, a batch is turned away after waiting {} seconds. A --follow download counts until its requested range is sent, not while it follows. 0 for unlimited, the default'.format(ADMISSION_BATCH_WAIT))
+arg_parser.add_argument('--max-inflight', action='store', type=int, default=0, help='Bytes the transfers a server runs may announce together. Requests beyond it wait in line on the server, a larger transfer runs once it would run alone. A --follow download stops counting once it follows. 0 for unlimited, the default')
+arg_parser.add_argument('--limits', action='store', type=str, default=None, metavar='HOST[:PORT]', help='Apply the rate limits given with --rate-limit, --client-rate-limit and --connection-rate-limit to a running server, then print its limits as JSON. Changes are accepted from local clients only')
+arg_parser.add_argument('--stats', action='store', type=str, default=None, metavar='HOST[:PORT]', help='Print the metrics of running and recently finished transfers of a server as JSON, then exit')
+arg_parser.add_argument('path', action='store', type=str, nargs='*', help='Source and destination file paths. There can be multiple local paths, but only one remote path. A local path of {} streams stdin up or the download to stdout'.format(STREAM_PATH))
 
 
 class Letter:
     __slots__ = ('_container', )
     _type_ = 'base-letter'
+    _code_ = 0
 
     def __init__(self, payload = None):
         self._container = {}
@@ -56,12 +279,23 @@ class Letter:
     def dump_payload(self):
         return self._container
 
+    @property
+    def Encodings(self):
+        return self._container.get('encodings', [])
+    @Encodings.setter
+    def Encodings(self, newvalue):
+        # control encodings the sender would like to switch to
+        self._container['encodings'] = list(newvalue)
+
 class Envelope:
-    __slots__ = ('letter',)
+    __slots__ = ('letter', 'encoding')
 
     def __init__(self, payload):
+        self.encoding = CONTROL_JSON
         if isinstance(payload, Letter):
             self.load_from_payload(payload)
+        elif len(payload) > 0 and payload[0] == BINARY_ENVELOPE_MAGIC:
+            self.load_from_binary(payload)
         else:
             self.load_from_json(payload)
 
@@ -77,20 +311,27 @@ class Envelope:
         if not isinstance(decoded, dict) or 'type' not in decoded or 'letter' not in decoded:
             raise CommunicationDecodeError(payload)
 
-        if decoded['type'] == ConfirmationLetter._type_:
-            self.letter = ConfirmationLetter(decoded['letter'])
-        elif decoded['type'] == RejectionLetter._type_:
-            self.letter = RejectionLetter(decoded['letter'])
-        elif decoded['type'] == ConnectionCloseLetter._type_:
-            self.letter = ConnectionCloseLetter(decoded['letter'])
-        elif decoded['type'] == UploadRequestLetter._type_:
-            self.letter = UploadRequestLetter(decoded['letter'])
-        elif decoded['type'] == DownloadRequestLetter._type_:
-            self.letter = DownloadRequestLetter(decoded['letter'])
-        elif decoded['type'] == DownloadConfirmationLetter._type_:
-            self.letter = DownloadConfirmationLetter(decoded['letter'])
-        else:
-            self.letter = Letter(decoded['letter'])
+        self.letter = LETTER_TYPES.get(decoded['type'], Letter)(decoded['letter'])
+
+    def load_from_binary(self, payload):
+        try:
+            magic, version, code, field_count = BINARY_ENVELOPE_HEADER.unpack_from(payload)
+            if version != BINARY_ENVELOPE_VERSION:
+                raise ValueError('Unsupported binary envelope version {}'.format(version))
+            container = {}
+            offset = BINARY_ENVELOPE_HEADER.size
+            for x in range(field_count):
+                field = payload[offset]
+                offset = offset + 1
+                if field == 0:
+                    name, offset = decode_binary_value(payload, offset)
+                else:
+                    name = BINARY_FIELD_NAMES[field]
+                container[name], offset = decode_binary_value(payload, offset)
+        except (IndexError, ValueError, struct.error, UnicodeDecodeError):
+            raise CommunicationDecodeError(payload)
+        self.encoding = CONTROL_BINARY
+        self.letter = LETTER_CODES.get(code, Letter)(container)
 
     def dump(self):
         return json.dumps({
@@ -98,14 +339,129 @@ class Envelope:
             'letter': self.letter.dump_payload()
         }, separators=(',', ':'))
 
+    def dump_binary(self):
+        container = self.letter.dump_payload()
+        out = bytearray(BINARY_ENVELOPE_HEADER.pack(BINARY_ENVELOPE_MAGIC, BINARY_ENVELOPE_VERSION, self.letter.__class__._code_, len(container)))
+        for name, value in container.items():
+            field = BINARY_FIELD_CODES.get(name)
+            if field is None:
+                out.append(0)
+                encode_binary_value(name, out)
+            else:
+                out.append(field)
+            encode_binary_value(value, out)
+        return out
+
+    def encode(self, encoding = CONTROL_JSON):
+        if encoding == CONTROL_BINARY:
+            return self.dump_binary()
+        return self.dump().encode()
+
     def __str__(self):
         return self.dump()
 
 class ConfirmationLetter(Letter):
     _type_ = 'confirmed'
+    _code_ = 1
+
+    @property
+    def Offset(self):
+        return self._container.get('offset')
+    @Offset.setter
+    def Offset(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Offset must be an integer number of bytes')
+        self._container['offset'] = newvalue
+
+    @property
+    def Length(self):
+        return self._container.get('length')
+    @Length.setter
+    def Length(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Length must be an integer number of bytes')
+        self._container['length'] = newvalue
+
+    @property
+    def Ranges(self):
+        return self._container.get('ranges')
+    @Ranges.setter
+    def Ranges(self, newvalue):
+        self._container['ranges'] = [[offset, length] for offset, length in newvalue]
+
+    @property
+    def Sparse(self):
+        # set when the holes of an upload were taken out of Ranges
+        return self._container.get('sparse', False)
+    @Sparse.setter
+    def Sparse(self, newvalue):
+        self._container['sparse'] = bool(newvalue)
+
+    @property
+    def Digest(self):
+        return self._container.get('digest')
+    @Digest.setter
+    def Digest(self, newvalue):
+        self._container['digest'] = newvalue
+
+    @property
+    def BlockSize(self):
+        return self._container.get('block_size')
+    @BlockSize.setter
+    def BlockSize(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Block size must be an integer number of bytes')
+        self._container['block_size'] = newvalue
+
+    @property
+    def BlockCount(self):
+        return self._container.get('block_count')
+    @BlockCount.setter
+    def BlockCount(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Block count must be an integer')
+        self._container['block_count'] = newvalue
+
+    @property
+    def Compression(self):
+        return self._container.get('compression')
+    @Compression.setter
+    def Compression(self, newvalue):
+        self._container['compression'] = newvalue
+
+    @property
+    def TransferDigest(self):
+        return self._container.get('transfer_digest')
+    @TransferDigest.setter
+    def TransferDigest(self, newvalue):
+        self._container['transfer_digest'] = newvalue
+
+    @property
+    def Failed(self):
+        return self._container.get('failed', [])
+    @Failed.setter
+    def Failed(self, newvalue):
+        self._container['failed'] = [[path, reason] for path, reason in newvalue]
+
+    @property
+    def Stream(self):
+        # the data follows as a stream of frames ended by an empty one, no size is given
+        return self._container.get('stream', False)
+    @Stream.setter
+    def Stream(self, newvalue):
+        self._container['stream'] = bool(newvalue)
 
 class DownloadConfirmationLetter(ConfirmationLetter):
     _type_ = 'download-confirmation'
+    _code_ = 2
+
+    @property
+    def Extents(self):
+        # data extents of the served range, only the extents are sent when set
+        return self._container.get('extents')
+    @Extents.setter
+    def Extents(self, newvalue):
+        self._container['extents'] = [[offset, length] for offset, length in newvalue]
 
     @property
     def FileSize(self):
@@ -116,8 +472,26 @@ class DownloadConfirmationLetter(ConfirmationLetter):
             raise ValueError('File size can only be integer value in bytes')
         self._container['file_size'] = newvalue
 
+    @property
+    def Modified(self):
+        return self._container.get('modified')
+    @Modified.setter
+    def Modified(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Modification time must be an integer number of nanoseconds')
+        self._container['modified'] = newvalue
+
+    @property
+    def Follow(self):
+        # the server keeps offering what is appended to the file once this range is sent
+        return self._container.get('follow', False)
+    @Follow.setter
+    def Follow(self, newvalue):
+        self._container['follow'] = bool(newvalue)
+
 class RejectionLetter(Letter):
     _type_ = 'rejected'
+    _code_ = 3
 
     @property
     def Reason(self):
@@ -128,9 +502,11 @@ class RejectionLetter(Letter):
 
 class ConnectionCloseLetter(Letter):
     _type_ = 'close'
+    _code_ = 4
 
 class UploadRequestLetter(Letter):
     _type_ = 'upload-request'
+    _code_ = 5
 
     @property
     def FileSize(self):
@@ -148,8 +524,103 @@ class UploadRequestLetter(Letter):
     def DestinationPath(self, newvalue):
         self._container['destination_path'] = newvalue
 
+    @property
+    def Offset(self):
+        return self._container.get('offset')
+    @Offset.setter
+    def Offset(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Offset must be an integer number of bytes')
+        self._container['offset'] = newvalue
+
+    @property
+    def Length(self):
+        return self._container.get('length')
+    @Length.setter
+    def Length(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Length must be an integer number of bytes')
+        self._container['length'] = newvalue
+
+    @property
+    def TransferId(self):
+        return self._container.get('transfer_id')
+    @TransferId.setter
+    def TransferId(self, newvalue):
+        self._container['transfer_id'] = newvalue
+
+    @property
+    def Resume(self):
+        return self._container.get('resume', False)
+    @Resume.setter
+    def Resume(self, newvalue):
+        self._container['resume'] = bool(newvalue)
+
+    @property
+    def SourceModified(self):
+        return self._container.get('source_modified')
+    @SourceModified.setter
+    def SourceModified(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Modification time must be an integer number of nanoseconds')
+        self._container['source_modified'] = newvalue
+
+    @property
+    def Delta(self):
+        return self._container.get('delta', False)
+    @Delta.setter
+    def Delta(self, newvalue):
+        self._container['delta'] = bool(newvalue)
+
+    @property
+    def DeltaDigest(self):
+        # the client sends the digest of its source after the delta
+        return self._container.get('delta_digest', False)
+    @DeltaDigest.setter
+    def DeltaDigest(self, newvalue):
+        self._container['delta_digest'] = bool(newvalue)
+
+    @property
+    def Compression(self):
+        return self._container.get('compression')
+    @Compression.setter
+    def Compression(self, newvalue):
+        self._container['compression'] = newvalue
+
+    @property
+    def Digest(self):
+        return self._container.get('digest')
+    @Digest.setter
+    def Digest(self, newvalue):
+        self._container['digest'] = newvalue
+
+    @property
+    def Extents(self):
+        # data extents of the uploaded range, sent when the source has holes
+        return self._container.get('extents')
+    @Extents.setter
+    def Extents(self, newvalue):
+        self._container['extents'] = [[offset, length] for offset, length in newvalue]
+
+    @property
+    def Stream(self):
+        # the source is read until it ends, FileSize is left out
+        return self._container.get('stream', False)
+    @Stream.setter
+    def Stream(self, newvalue):
+        self._container['stream'] = bool(newvalue)
+
+    @property
+    def Queue(self):
+        # the client waits in line when the server is busy, it is turned away otherwise
+        return self._container.get('queue', False)
+    @Queue.setter
+    def Queue(self, newvalue):
+        self._container['queue'] = bool(newvalue)
+
 class DownloadRequestLetter(Letter):
     _type_ = 'download-request'
+    _code_ = 6
 
     @property
     def DownloadPath(self):
@@ -158,274 +629,4788 @@ class DownloadRequestLetter(Letter):
     def DownloadPath(self, newvalue):
         self._container['download_path'] = newvalue
 
+    @property
+    def Offset(self):
+        return self._container.get('offset')
+    @Offset.setter
+    def Offset(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Offset must be an integer number of bytes')
+        self._container['offset'] = newvalue
 
+    @property
+    def Length(self):
+        return self._container.get('length')
+    @Length.setter
+    def Length(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Length must be an integer number of bytes')
+        self._container['length'] = newvalue
 
+    @property
+    def ChunkSize(self):
+        return self._container.get('chunk_size')
+    @ChunkSize.setter
+    def ChunkSize(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Chunk size must be an integer number of bytes')
+        self._container['chunk_size'] = newvalue
 
-class TpftServerConnection(TinyProtoConnection):
-    __slots__ = ('verbose', 'display_progress', 'uuid')
+    @property
+    def Digest(self):
+        return self._container.get('digest')
+    @Digest.setter
+    def Digest(self, newvalue):
+        self._container['digest'] = newvalue
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.verbose = False
-        self.display_progress = False
-        self.uuid = None
+    @property
+    def Compression(self):
+        return self._container.get('compression')
+    @Compression.setter
+    def Compression(self, newvalue):
+        self._container['compression'] = newvalue
 
-    def handle_upload(self, file_size, destination_path):
-        try:
-            fd = open(destination_path, 'wb')
-        except OSError as e:
-            l = RejectionLetter()
-            l.Reason = str(e)
-            self.transmit(str(Envelope(l)).encode())
-            if self.verbose:
-                print("[{}] Failed to open destination path: {} - Sending reject.".format(self.uuid, str(e)))
-        else:
-            self.transmit(str(Envelope(ConfirmationLetter())).encode())
+    @property
+    def CompressionLevel(self):
+        return self._container.get('compression_level')
+    @CompressionLevel.setter
+    def CompressionLevel(self, newvalue):
+        if not isinstance(newvalue, int):
+            raise ValueError('Compression level must be an integer')
+        self._container['compression_level'] = newvalue
 
-            if self.verbose:
-                print("[{}] Destination file opened. Confirmation sent. Starting data transfer ... ".format(self.uuid))
-            count = 0
-            while count < file_size:
-                buff = self.receive()
-                count = count + len(buff)
-                fd.write(buff)
-            if self.verbose:
-                print("[{}] Transfer complete. Saving to disk ... ".format(self.uuid))
-            fd.close()
-            if self.verbose:
-                print("[{}] File saved. Sending confirmation to client.".format(self.uuid))
-            self.transmit(str(Envelope(ConfirmationLetter())).encode())
+    @property
+    def Sparse(self):
+        # asks for the data extents only, holes are left out of the transfer
+        return self._container.get('sparse', False)
+    @Sparse.setter
+    def Sparse(self, newvalue):
+        self._container['sparse'] = bool(newvalue)
 
-    def handle_download(self, download_path):
-        try:
-            file_size = os.path.getsize(download_path)
-        except OSError as e:
-            l = RejectionLetter()
-            l.Reason = str(e)
-            self.transmit(str(Envelope(l)).encode())
-            if self.verbose:
-                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
-        else:
-            fd = open(download_path, 'rb')
-            if self.verbose:
-                print("[{}] Opened file for reading. Sending download confirmation ... ".format(self.uuid))
+    @property
+    def Follow(self):
+        # asks the server to keep the download open and send what is appended to the file
+        return self._container.get('follow', False)
+    @Follow.setter
+    def Follow(self, newvalue):
+        self._container['follow'] = bool(newvalue)
 
-            l = DownloadConfirmationLetter()
-            l.FileSize = file_size
-            self.transmit(str(Envelope(l)).encode())
+    @property
+    def Stream(self):
+        # asks for the file read until it ends rather than up to its size
+        return self._container.get('stream', False)
+    @Stream.setter
+    def Stream(self, newvalue):
+        self._container['stream'] = bool(newvalue)
 
-            msg = self.receive()
-            envelope = Envelope(msg)
-            if not isinstance(envelope.letter, ConfirmationLetter):
-                if self.verbose:
-                    print("[{}] Client rejected file.".format(self.uuid))
-            else:
-                if self.verbose:
-                    print("[{}] Client accepted file. Starting transfer ... ".format(self.uuid))
+    @property
+    def Queue(self):
+        # see UploadRequestLetter.Queue
+        return self._container.get('queue', False)
+    @Queue.setter
+    def Queue(self, newvalue):
+        self._container['queue'] = bool(newvalue)
 
-                count = 0
-                while count < file_size:
-                    buff = fd.read(DEFAULT_CHUNK_SIZE)
-                    self.transmit(buff)
-                    count = count + len(buff)
+class ChunkDigestLetter(Letter):
+    _type_ = 'chunk-digests'
+    _code_ = 7
 
-                msg = self.receive()
-                envelope = Envelope(msg)
-                if not isinstance(envelope.letter, ConfirmationLetter) and self.verbose:
-                    print("[{}] Client rejected binary transfer.".format(self.uuid))
-                if self.verbose:
-                    print("[{}] Transfer completed.".format(self.uuid))
-            fd.close()
+    @property
+    def Algorithm(self):
+        return self._container.get('algorithm')
+    @Algorithm.setter
+    def Algorithm(self, newvalue):
+        self._container['algorithm'] = newvalue
 
-    def handle_message(self, msg):
-        if not isinstance(msg, Envelope):
-            raise ValueError('handle_letter only accepts instances of Letter class')
+    @property
+    def Digests(self):
+        return self._container.get('digests', [])
+    @Digests.setter
+    def Digests(self, newvalue):
+        self._container['digests'] = [digest.hex() for digest in newvalue]
 
-        letter = msg.letter
-        if isinstance(letter, ConnectionCloseLetter):
-            self.shutdown = True
-        elif isinstance(letter, UploadRequestLetter):
-            if self.verbose:
-                print("[{}] Requested upload of file {} of size {}".format(self.uuid, letter.DestinationPath, letter.FileSize))
-            self.handle_upload(letter.FileSize, letter.DestinationPath)
-        elif isinstance(letter, DownloadRequestLetter):
-            if self.verbose:
-                print("[{}] Requested download of file {}".format(self.uuid, letter.DownloadPath))
-            self.handle_download(letter.DownloadPath)
-        else:
-            if self.verbose:
-                print("[{}] Unhandleable letter received {}".format(self.uuid, letter.__class__))
+class RetransmitRequestLetter(Letter):
+    _type_ = 'retransmit-request'
+    _code_ = 8
 
-    def transmission_received(self, msg):
-        envelope = Envelope(msg)
-        self.handle_message(envelope)
+    @property
+    def Chunks(self):
+        return self._container.get('chunks', [])
+    @Chunks.setter
+    def Chunks(self, newvalue):
+        self._container['chunks'] = list(newvalue)
 
-class TpftServer(TinyProtoServer):
-    __slots__ = ('verbose', 'display_progress')
 
-    def conn_init(self, conn_id, conn_o):
-        if self.verbose:
-            print('[SRV] Opened connection from {}'.format(conn_o.socket_o.getpeername()))
-        conn_o.verbose = self.verbose
-        conn_o.display_progress = self.display_progress
-        conn_o.uuid = conn_id
+class FileBatchLetter(Letter):
+    _type_ = 'file-batch'
+    _code_ = 9
 
-    def conn_shutdown(self, conn_id, conn_o):
-        if self.verbose:
-            print('[SRV] Connection closed from {}'.format(conn_o.peername_details))
+    @property
+    def DestinationPath(self):
+        return self._container.get('destination_path')
+    @DestinationPath.setter
+    def DestinationPath(self, newvalue):
+        self._container['destination_path'] = newvalue
 
+    @property
+    def Directories(self):
+        return self._container.get('directories', [])
+    @Directories.setter
+    def Directories(self, newvalue):
+        # [relative path, mode]
+        self._container['directories'] = [[path, mode] for path, mode in newvalue]
 
+    @property
+    def Files(self):
+        return self._container.get('files', [])
+    @Files.setter
+    def Files(self, newvalue):
+        # [relative path, size, modified, mode], content follows in this order
+        self._container['files'] = [[path, size, modified, mode] for path, size, modified, mode in newvalue]
 
-class TpftClientUploadConnection(TinyProtoConnection):
-    __slots__ = ('source_file_descriptor', 'source_file_size', 'destination_path', 'ready_for_upload', 'progress')
+class TreeDownloadRequestLetter(Letter):
+    _type_ = 'tree-download-request'
+    _code_ = 10
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.ready_for_upload = False
+    @property
+    def DownloadPath(self):
+        return self._container.get('download_path')
+    @DownloadPath.setter
+    def DownloadPath(self, newvalue):
+        self._container['download_path'] = newvalue
 
-    def upload_file(self, source_file, source_file_size, destination_path):
-        self.source_file_descriptor = source_file
-        self.source_file_size = source_file_size
-        self.destination_path = destination_path
-        self.ready_for_upload = True
-        self.progress = 0
+    @property
+    def Paths(self):
+        return self._container.get('paths')
+    @Paths.setter
+    def Paths(self, newvalue):
+        # relative paths as listed by a manifest, only these are sent instead of the whole tree
+        self._container['paths'] = list(newvalue)
 
-    def request_upload(self):
-        l = UploadRequestLetter()
-        l.FileSize = self.source_file_size
-        l.DestinationPath = self.destination_path
-        msg = Envelope(l)
-        self.transmit(str(msg).encode())
+    @property
+    def Queue(self):
+        # see UploadRequestLetter.Queue
+        return self._container.get('queue', False)
+    @Queue.setter
+    def Queue(self, newvalue):
+        self._container['queue'] = bool(newvalue)
 
-        response = self.receive()
-        return Envelope(response)
+class StatsRequestLetter(Letter):
+    _type_ = 'stats-request'
+    _code_ = 11
 
-    def upload_confirmed(self):
-        msg = self.receive()
-        envelope = Envelope(msg)
-        if isinstance(envelope.letter, ConfirmationLetter):
-            return True
-        else:
-            return False
+class StatsLetter(Letter):
+    _type_ = 'stats'
+    _code_ = 12
 
-    def upload_binary(self):
-        count = 0
-        while count < self.source_file_size:
-            buff = self.source_file_descriptor.read(DEFAULT_CHUNK_SIZE)
-            self.transmit(buff)
-            count = count + len(buff)
-            self.progress = int(count / self.source_file_size * 100)
+    @property
+    def Fields(self):
+        return self._container.get('fields', [])
+    @Fields.setter
+    def Fields(self, newvalue):
+        self._container['fields'] = list(newvalue)
 
-    def loop_pass(self):
-        if self.ready_for_upload:
-            msg = self.request_upload()
+    @property
+    def Transfers(self):
+        return self._container.get('transfers', [])
+    @Transfers.setter
+    def Transfers(self, newvalue):
+        # one row per transfer, values in the order of Fields
+        self._container['transfers'] = [list(row) for row in newvalue]
 
-            if isinstance(msg.letter, ConfirmationLetter):
-                self.upload_binary()
-                msg = self.upload_confirmed()
-            elif isinstance(msg.letter, RejectionLetter):
-                print(msg.letter.Reason)
+class LimitsLetter(Letter):
+    # sent to change the rate limits of a server, limits left out stay as they are.
+    # The server answers with a LimitsLetter holding every limit in effect, 0 meaning unlimited
+    _type_ = 'limits'
+    _code_ = 13
 
-            self.transmit(str(Envelope(ConnectionCloseLetter())).encode())
-            time.sleep(0.1)
-            self.shutdown = True
+    @property
+    def GlobalLimit(self):
+        return self._container.get('global_limit')
+    @GlobalLimit.setter
+    def GlobalLimit(self, newvalue):
+        if not isinstance(newvalue, int) or newvalue < 0:
+            raise ValueError('GlobalLimit must be a non negative number of bytes per second')
+        self._container['global_limit'] = newvalue
 
-    def pre_loop(self):
-        self.socket_o.settimeout(90)
+    @property
+    def ClientLimit(self):
+        return self._container.get('client_limit')
+    @ClientLimit.setter
+    def ClientLimit(self, newvalue):
+        if not isinstance(newvalue, int) or newvalue < 0:
+            raise ValueError('ClientLimit must be a non negative number of bytes per second')
+        self._container['client_limit'] = newvalue
 
-class TpftClientDownloadConnection(TinyProtoConnection):
-    __slots__ = ('local_path', 'remote_path', 'ready_for_download', 'progress')
+    @property
+    def ConnectionLimit(self):
+        return self._container.get('connection_limit')
+    @ConnectionLimit.setter
+    def ConnectionLimit(self, newvalue):
+        if not isinstance(newvalue, int) or newvalue < 0:
+            raise ValueError('ConnectionLimit must be a non negative number of bytes per second')
+        self._container['connection_limit'] = newvalue
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.ready_for_download = False
+class ManifestRequestLetter(Letter):
+    _type_ = 'manifest-request'
+    _code_ = 14
 
-    def download_file(self, remote_path, local_path):
-        self.local_path = local_path
-        self.remote_path = remote_path
-        self.ready_for_download = True
-        self.progress = 0
+    @property
+    def Path(self):
+        return self._container.get('manifest_path')
+    @Path.setter
+    def Path(self, newvalue):
+        self._container['manifest_path'] = newvalue
 
-    def request_download(self):
-        l = DownloadRequestLetter()
-        l.DownloadPath = self.remote_path
-        msg = Envelope(l)
-        self.transmit(str(msg).encode())
+    @property
+    def Algorithm(self):
+        return self._container.get('algorithm')
+    @Algorithm.setter
+    def Algorithm(self, newvalue):
+        # digest of every file is listed when set, None lists size and modification time only
+        self._container['algorithm'] = newvalue
 
-        response = self.receive()
-        return Envelope(response)
+class ManifestLetter(Letter):
+    _type_ = 'manifest'
+    _code_ = 15
 
-    def download_binary(self, file_size):
-        count = 0
-        fd = open(self.local_path, 'wb')
-        while count < file_size:
-            buff = self.receive()
-            fd.write(buff)
-            count = count + len(buff)
-            self.progress = int(count / file_size * 100)
-        fd.close()
+    @property
+    def Algorithm(self):
+        return self._container.get('algorithm')
+    @Algorithm.setter
+    def Algorithm(self, newvalue):
+        self._container['algorithm'] = newvalue
 
-    def accept_download(self):
-        self.transmit(str(Envelope(ConfirmationLetter())).encode())
+    @property
+    def Directories(self):
+        return self._container.get('directories', [])
+    @Directories.setter
+    def Directories(self, newvalue):
+        # [relative path, mode]
+        self._container['directories'] = [[path, mode] for path, mode in newvalue]
 
-    def confirm_download(self):
-        self.transmit(str(Envelope(ConfirmationLetter())).encode())
+    @property
+    def Files(self):
+        return self._container.get('files', [])
+    @Files.setter
+    def Files(self, newvalue):
+        # [relative path, size, modified, hex digest or None]
+        self._container['files'] = [[path, size, modified, digest] for path, size, modified, digest in newvalue]
 
-    def loop_pass(self):
-        if self.ready_for_download:
-            msg = self.request_download()
+class BusyLetter(Letter):
+    # tells a queued transfer request where it stands, every
+    # ADMISSION_NOTICE_INTERVAL until the server answers it
+    _type_ = 'busy'
+    _code_ = 16
 
-            if isinstance(msg.letter, DownloadConfirmationLetter):
-                self.accept_download()
-                self.download_binary(msg.letter.FileSize)
-                self.confirm_download()
-            elif isinstance(msg.letter, RejectionLetter):
-                print(msg.letter.Reason)
+    @property
+    def Position(self):
+        # 1 for the request that goes next
+        return self._container.get('position')
+    @Position.setter
+    def Position(self, newvalue):
+        self._container['position'] = newvalue
 
-            self.transmit(str(Envelope(ConnectionCloseLetter())).encode())
-            time.sleep(0.1)
-            self.shutdown = True
+LETTER_TYPES = {letter._type_: letter for letter in (
+    ConfirmationLetter, DownloadConfirmationLetter, RejectionLetter, ConnectionCloseLetter, UploadRequestLetter, DownloadRequestLetter,
+    ChunkDigestLetter, RetransmitRequestLetter, FileBatchLetter, TreeDownloadRequestLetter, StatsRequestLetter, StatsLetter,
+    LimitsLetter, ManifestRequestLetter, ManifestLetter, BusyLetter,
+)}
+LETTER_CODES = {letter._code_: letter for letter in LETTER_TYPES.values()}
 
-    def pre_loop(self):
-        self.socket_o.settimeout(90)
+class PartialFile:
+    __slots__ = ('path', 'partial_path', 'state_path', 'durability', 'sync_interval')
 
+    def __init__(self, path, durability = DURABILITY_NONE, sync_interval = 0):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.state_path = self.partial_path + PARTIAL_STATE_SUFFIX
+        self.durability = durability
+        self.sync_interval = sync_interval
 
-class TpftClient(TinyProtoClient):
-    def upload_file(self, local_path, remote_path, progress):
-        self.set_conn_handler(TpftClientUploadConnection)
-        if not isinstance(local_path, ParsedPath) or not isinstance(remote_path, ParsedPath):
-            raise ValueError('Paths need to be instances of ParsedPath')
+    @property
+    def checkpoint_size(self):
+        # periodic durability syncs at every checkpoint, so checkpoints come every sync_interval bytes
+        return self.sync_interval if self.durability == DURABILITY_PERIODIC else RESUME_CHECKPOINT_SIZE
 
-        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
-        uuid = self.connect_to(connection_details)
+    def sync(self):
+        fd = os.open(self.partial_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def locked_state(self):
+        # the state file doubles as the lock shared by every stream (and every
+        # process) writing into the same partial file
+        while True:
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.state_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # lost a race with a stream finalising the file, start over
+            os.close(fd)
+        try:
+            raw = os.pread(fd, os.fstat(fd).st_size, 0)
+            try:
+                state = json.loads(raw) if raw else None
+            except ValueError:
+                state = None
+            yield fd, state
+        finally:
+            os.close(fd)
+
+    def write_state(self, fd, state):
+        os.ftruncate(fd, 0)
+        pwrite_all(fd, json.dumps(state, separators=(',', ':')).encode(), 0)
+
+    def begin(self, file_size, transfer_id, resume, source_modified, offset, length):
+        with self.locked_state() as (fd, state):
+            reusable = (
+                state is not None
+                and state.get('file_size') == file_size
+                and os.path.exists(self.partial_path)
+                and (state.get('transfer_id') == transfer_id or (resume and state.get('source_modified') == source_modified))
+            )
+            if not reusable:
+                partial_fd = os.open(self.partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                os.ftruncate(partial_fd, file_size)
+                os.close(partial_fd)
+                state = {'file_size': file_size, 'source_modified': source_modified, 'committed': []}
+            state['transfer_id'] = transfer_id
+            self.write_state(fd, state)
+            return subtract_ranges([(offset, length)], state['committed'])
+
+    def open_for_write(self):
+        return os.open(self.partial_path, os.O_WRONLY)
+
+    def commit(self, offset, length):
+        return self.commit_ranges([(offset, length)])
+
+    def commit_ranges(self, ranges):
+        with self.locked_state() as (fd, state):
+            if state is None:
+                # nothing to commit into, the transfer was finalised already
+                os.unlink(self.state_path)
+                return False
+            committed = merge_ranges(state['committed'] + list(ranges))
+            if self.durability != DURABILITY_NONE and (self.durability == DURABILITY_PERIODIC or not subtract_ranges([(0, state['file_size'])], committed)):
+                # the data is on disk before the state, or the final name, points at it
+                self.sync()
+            if subtract_ranges([(0, state['file_size'])], committed):
+                state['committed'] = committed
+                self.write_state(fd, state)
+                if self.durability == DURABILITY_PERIODIC:
+                    os.fsync(fd)
+                return False
+            os.replace(self.partial_path, self.path)
+            if self.durability != DURABILITY_NONE:
+                sync_directory(os.path.dirname(os.path.abspath(self.path)))
+            os.unlink(self.state_path)
+            return True
+
+class FollowedFile:
+    # takes the place of the PartialFile of a followed download once the
+    # first range is in place, appended ranges go straight into the local file
+    __slots__ = ('path', 'durability')
+
+    def __init__(self, path, durability = DURABILITY_NONE):
+        self.path = path
+        self.durability = durability
+
+    @property
+    def checkpoint_size(self):
+        return RESUME_CHECKPOINT_SIZE
+
+    def open_for_write(self):
+        return os.open(self.path, os.O_WRONLY)
+
+    def commit(self, offset, length):
+        return self.commit_ranges([(offset, length)])
+
+    def commit_ranges(self, ranges):
+        # holes at the end of an appended range are never written, the file is grown over them
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            end = max(offset + length for offset, length in ranges)
+            if os.fstat(fd).st_size < end:
+                os.ftruncate(fd, end)
+            if self.durability != DURABILITY_NONE:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
+
+
+class VerifiedCommits:
+    # stands in for the partial file of one verified stream. Its ranges are
+    # committed, and the file takes its final name, only once verification
+    # passed. Until then a resume sends them again
+    __slots__ = ('partial', 'ranges')
+
+    def __init__(self, partial):
+        self.partial = partial
+        self.ranges = []
+
+    @property
+    def checkpoint_size(self):
+        return self.partial.checkpoint_size
+
+    def commit(self, offset, length):
+        return self.commit_ranges([(offset, length)])
+
+    def commit_ranges(self, ranges):
+        self.ranges.extend(ranges)
+        return False
+
+    def release(self):
+        ranges = self.ranges
+        self.ranges = []
+        return self.partial.commit_ranges(ranges) if ranges else False
+
+
+class StreamedFile:
+    # receives a stream of unknown size. It is written front to back into
+    # the partial file, which takes the final name once the stream has ended
+    __slots__ = ('path', 'partial_path', 'durability', 'sync_interval', 'unsynced')
+
+    def __init__(self, path, durability = DURABILITY_NONE, sync_interval = 0):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+
+    def open_for_write(self):
+        self.unsynced = 0
+        return os.open(self.partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    def written(self, fd, count):
+        if self.durability == DURABILITY_PERIODIC:
+            self.unsynced = self.unsynced + count
+            if self.unsynced >= self.sync_interval:
+                os.fsync(fd)
+                self.unsynced = 0
+
+    def finish(self, fd):
+        if self.durability != DURABILITY_NONE:
+            os.fsync(fd)
+        os.replace(self.partial_path, self.path)
+        if self.durability != DURABILITY_NONE:
+            sync_directory(os.path.dirname(os.path.abspath(self.path)))
+
+    def abandon(self):
+        # a stream cannot be resumed, what arrived of it is dropped
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.partial_path)
+
+class CacheEntry:
+    __slots__ = ('path', 'file_o', 'mapping', 'view', 'size', 'modified', 'identity', 'references', 'evicted', 'digests')
+
+    def __init__(self, path):
+        self.path = path
+        self.file_o = open(path, 'rb')
+        try:
+            st = os.fstat(self.file_o.fileno())
+            self.size = st.st_size
+            self.modified = st.st_mtime_ns
+            # taken from the open file, a file replaced after the stat in acquire is still noticed
+            self.identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            self.mapping = mmap.mmap(self.file_o.fileno(), self.size, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file_o.close()
+            raise
+        if hasattr(self.mapping, 'madvise'):
+            # one sequential read fills the page cache for every download that follows
+            self.mapping.madvise(mmap.MADV_WILLNEED)
+        self.view = memoryview(self.mapping)
+        self.references = 0
+        self.evicted = False
+        # chunk digests by (algorithm, chunk size, ranges), so fan-out verified downloads hash once
+        self.digests = {}
+
+    def chunk_digests(self, algorithm, ranges, chunk_size):
+        key = (algorithm, chunk_size, tuple((offset, length) for offset, length in ranges))
+        digests = self.digests.get(key)
+        if digests is None:
+            digests = [hashlib.new(algorithm, self.view[offset:offset + length]).digest() for offset, length in chunk_table(ranges, chunk_size)]
+            self.digests[key] = digests
+        return digests
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            # a slice is still alive somewhere, the mapping goes when it does
+            pass
+        self.file_o.close()
+
+class FileCache:
+    __slots__ = ('budget', 'entries', 'cached_bytes', 'lock', 'hits', 'misses', 'evictions', 'invalidations')
+
+    def __init__(self, budget):
+        self.budget = budget
+        # path -> CacheEntry, least recently used first
+        self.entries = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def acquire(self, path):
+        # returns a CacheEntry that stays valid until release, or None when the
+        # file cannot be cached. The file is stat'ed on every call and an
+        # entry whose size, mtime or inode changed is dropped
+        st = os.stat(path)
+        identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if entry.identity == identity:
+                    self.entries.move_to_end(path)
+                    entry.references += 1
+                    self.hits += 1
+                    return entry
+                self.invalidations += 1
+                self.drop(entry)
+            self.misses += 1
+            if not S_ISREG(st.st_mode) or st.st_size == 0 or st.st_size > self.budget:
+                return None
+
+        entry = CacheEntry(path)
+        with self.lock:
+            existing = self.entries.get(path)
+            if existing is not None and existing.identity == entry.identity:
+                # loaded by another connection in the meantime
+                entry.close()
+                existing.references += 1
+                return existing
+            if existing is not None:
+                self.drop(existing)
+            while self.cached_bytes + entry.size > self.budget and self.entries:
+                self.drop(next(iter(self.entries.values())))
+                self.evictions += 1
+            self.entries[path] = entry
+            self.cached_bytes += entry.size
+            entry.references += 1
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.references -= 1
+            if entry.evicted and entry.references == 0:
+                entry.close()
+
+    def drop(self, entry):
+        # caller holds the lock. Entries still being served are closed on their last release
+        del self.entries[entry.path]
+        self.cached_bytes -= entry.size
+        entry.evicted = True
+        if entry.references == 0:
+            entry.close()
+
+    def dump(self):
+        return {
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations,
+            'entries': len(self.entries), 'cached_bytes': self.cached_bytes, 'budget': self.budget,
+        }
+
+    def __str__(self):
+        return 'hits={hits} misses={misses} evictions={evictions} invalidations={invalidations} entries={entries} bytes={cached_bytes}/{budget}'.format(**self.dump())
+
+class TransferMetrics:
+    __slots__ = ('transfer_id', 'peer', 'direction', 'path', 'size', 'bytes', 'started', 'finished', 'network_send', 'network_receive', 'disk_read', 'disk_write', 'throttled', 'samples')
+
+    def __init__(self, direction, path, size = None, peer = None):
+        self.transfer_id = str(uuid4())
+        self.peer = peer
+        self.direction = direction
+        self.path = path
+        self.size = size
+        # data frame bytes moved, as they went over the wire
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        # seconds the connection was blocked in each place, the rest went to cpu
+        self.network_send = 0.0
+        self.network_receive = 0.0
+        self.disk_read = 0.0
+        self.disk_write = 0.0
+        # seconds held back by rate limits
+        self.throttled = 0.0
+        # (time, bytes so far) covering the last INSTANT_WINDOW seconds
+        self.samples = deque([(self.started, 0)])
+
+    def moved(self, count):
+        now = time.perf_counter()
+        self.bytes = self.bytes + count
+        self.samples.append((now, self.bytes))
+        while len(self.samples) > 2 and self.samples[1][0] <= now - INSTANT_WINDOW:
+            self.samples.popleft()
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def average(self):
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def instantaneous(self):
+        if self.finished is not None:
+            return 0.0
+        now = time.perf_counter()
+        try:
+            # read while the connection thread may be appending
+            first_time, first_bytes = self.samples[0]
+        except IndexError:
+            return 0.0
+        if now - first_time <= 0:
+            return 0.0
+        return (self.bytes - first_bytes) / (now - first_time)
+
+    def other(self):
+        return max(0.0, self.elapsed() - self.network_send - self.network_receive - self.disk_read - self.disk_write - self.throttled)
+
+    def bound(self):
+        network = self.network_send + self.network_receive
+        disk = self.disk_read + self.disk_write
+        other = self.other()
+        if self.throttled >= max(network, disk, other):
+            return 'throttled'
+        if network >= disk and network >= other:
+            return 'network'
+        return 'disk' if disk >= other else 'cpu'
+
+    def row(self):
+        # values in the order of TRANSFER_METRICS_FIELDS
+        microseconds = lambda seconds: int(seconds * 1000000)
+        return [
+            self.transfer_id, self.peer, self.direction, self.path, self.size, self.bytes, self.finished is None,
+            microseconds(self.elapsed()), int(self.average()), int(self.instantaneous()),
+            microseconds(self.network_send), microseconds(self.network_receive), microseconds(self.disk_read), microseconds(self.disk_write),
+            microseconds(self.other()), self.bound(), microseconds(self.throttled),
+        ]
+
+    def dump(self):
+        return dict(zip(TRANSFER_METRICS_FIELDS, self.row()))
+
+    def __str__(self):
+        return 'bytes={} elapsed={:.3f}s average={:.1f}MB/s network_send={:.3f}s network_receive={:.3f}s disk_read={:.3f}s disk_write={:.3f}s throttled={:.3f}s other={:.3f}s bound={}'.format(
+            self.bytes, self.elapsed(), self.average() / 1e6, self.network_send, self.network_receive, self.disk_read, self.disk_write, self.throttled, self.other(), self.bound()
+        )
+
+class TransferRegistry:
+    __slots__ = ('active', 'finished', 'lock')
+
+    def __init__(self):
+        self.active = {}
+        self.finished = deque(maxlen=TRANSFER_HISTORY)
+        self.lock = threading.Lock()
+
+    def begin(self, metrics):
+        with self.lock:
+            self.active[metrics.transfer_id] = metrics
+
+    def end(self, metrics):
+        with self.lock:
+            if self.active.pop(metrics.transfer_id, None) is not None:
+                self.finished.append(metrics)
+
+    def running(self):
+        with self.lock:
+            return list(self.active.values())
+
+    def rows(self):
+        with self.lock:
+            transfers = list(self.active.values()) + list(self.finished)
+        return [metrics.row() for metrics in transfers]
+
+    def print_progress(self):
+        for metrics in self.running():
+            print('[SRV] {} {} {}: {} of {} bytes, {:.1f}MB/s now, {:.1f}MB/s average'.format(
+                metrics.peer, metrics.direction, metrics.path, metrics.bytes, metrics.size if metrics.size is not None else '?', metrics.instantaneous() / 1e6, metrics.average() / 1e6
+            ))
+
+class TokenBucket:
+    __slots__ = ('rate', 'next_free', 'lock')
+
+    def __init__(self, rate = 0):
+        # bytes per second, 0 lets everything through
+        self.rate = rate
+        # when the bytes reserved so far have drained at rate
+        self.next_free = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, count):
+        # returns the seconds to wait before count bytes may go. Reservations
+        # are served in the order they are made, so connections sharing a
+        # bucket alternate quantum by quantum
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_free, now)
+            self.next_free = start + count / self.rate
+            return start - now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            # whatever was queued at the old rate does not hold back the new one
+            self.next_free = 0.0
+
+class ConnectionShaper:
+    __slots__ = ('shaper', 'connection_bucket', 'client')
+
+    def __init__(self, shaper, client):
+        self.shaper = shaper
+        self.client = client
+        self.connection_bucket = TokenBucket(shaper.connection_limit)
+
+    def delays(self, count):
+        # yields the waits of count bytes, one bucket at a time from the narrowest
+        # to the global one. Each reservation is made once the previous wait is over
+        if not self.shaper.limited():
+            return
+        while count > 0:
+            quantum = min(count, SHAPING_QUANTUM)
+            for bucket in (self.connection_bucket, self.shaper.client_bucket(self.client), self.shaper.global_bucket):
+                yield bucket.reserve(quantum)
+            count = count - quantum
+
+    def throttle(self, count):
+        waited = 0.0
+        for delay in self.delays(count):
+            if delay > 0:
+                time.sleep(delay)
+                waited = waited + delay
+        return waited
+
+class BandwidthShaper:
+    # token buckets for the data a server sends: one global, one per client
+    # address and one per connection. Limits may change at any time, running
+    # transfers pick them up with their next quantum
+    __slots__ = ('global_limit', 'client_limit', 'connection_limit', 'global_bucket', 'client_buckets', 'connections', 'lock')
+
+    def __init__(self, global_limit = 0, client_limit = 0, connection_limit = 0):
+        self.global_limit = global_limit
+        self.client_limit = client_limit
+        self.connection_limit = connection_limit
+        self.global_bucket = TokenBucket(global_limit)
+        # client address: [bucket, connections using it]
+        self.client_buckets = {}
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def limited(self):
+        return self.global_limit > 0 or self.client_limit > 0 or self.connection_limit > 0
+
+    def attach(self, client):
+        connection = ConnectionShaper(self, client)
+        with self.lock:
+            entry = self.client_buckets.get(client)
+            if entry is None:
+                entry = self.client_buckets[client] = [TokenBucket(self.client_limit), 0]
+            entry[1] = entry[1] + 1
+            self.connections.add(connection)
+        return connection
+
+    def detach(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            entry = self.client_buckets.get(connection.client)
+            if entry is not None:
+                entry[1] = entry[1] - 1
+                if entry[1] <= 0:
+                    del self.client_buckets[connection.client]
+
+    def client_bucket(self, client):
+        entry = self.client_buckets.get(client)
+        # a detached client falls back to a bucket of its own
+        return entry[0] if entry is not None else TokenBucket(self.client_limit)
+
+    def set_limits(self, global_limit = None, client_limit = None, connection_limit = None):
+        with self.lock:
+            if global_limit is not None:
+                self.global_limit = global_limit
+                self.global_bucket.set_rate(global_limit)
+            if client_limit is not None:
+                self.client_limit = client_limit
+                for bucket, references in self.client_buckets.values():
+                    bucket.set_rate(client_limit)
+            if connection_limit is not None:
+                self.connection_limit = connection_limit
+                for connection in self.connections:
+                    connection.connection_bucket.set_rate(connection_limit)
+
+    def __str__(self):
+        return 'global={} client={} connection={} bytes/s'.format(self.global_limit, self.client_limit, self.connection_limit)
+
+class Admission:
+    __slots__ = ('size', 'device', 'reserved', 'ticket', 'position')
+
+    def __init__(self, size = 0, device = None, reserved = 0, ticket = None, position = 0):
+        self.size = size
+        self.device = device
+        # bytes of the filesystem held for the transfer until it has allocated them
+        self.reserved = reserved
+        # place in line of a request that waits, position counts from 1
+        self.ticket = ticket
+        self.position = position
+
+    @property
+    def admitted(self):
+        return self.position == 0
+
+class AdmissionControl:
+    # caps the transfers a server runs at once and the bytes they announce.
+    # Requests over a cap wait in line and get in in the order they came,
+    # uploads that do not fit on their filesystem are turned away before
+    # anything is written
+    __slots__ = ('max_transfers', 'max_bytes', 'running', 'inflight', 'waiting', 'reserved', 'next_ticket', 'lock', 'changed')
+
+    def __init__(self, max_transfers = 0, max_bytes = 0):
+        self.max_transfers = max_transfers
+        self.max_bytes = max_bytes
+        self.running = 0
+        self.inflight = 0
+        # tickets in line, the first goes next
+        self.waiting = []
+        # device: bytes admitted uploads hold on it
+        self.reserved = {}
+        self.next_ticket = 1
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def full(self, size):
+        # a transfer larger than max_bytes still runs, once it runs alone
+        if self.max_transfers > 0 and self.running >= self.max_transfers:
+            return True
+        return self.max_bytes > 0 and self.running > 0 and self.inflight + size > self.max_bytes
+
+    def admit(self, size, ticket = None, path = None, space = 0, timeout = 0):
+        # size counts towards the bytes in flight, space has to fit on the
+        # filesystem of path or OSError is raised. Waits up to timeout for
+        # room, a request that is not admitted gets a ticket to ask again
+        # with. 0 asks for one, without a ticket the request cannot wait
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                ahead = self.waiting.index(ticket) if ticket in self.waiting else len(self.waiting)
+                if ahead == 0 and not self.full(size):
+                    break
+                if ticket is None:
+                    return Admission(position = ahead + 1)
+                if ticket not in self.waiting:
+                    ticket = self.next_ticket
+                    self.next_ticket += 1
+                    self.waiting.append(ticket)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return Admission(ticket = ticket, position = ahead + 1)
+                self.changed.wait(remaining)
+
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                # the next in line may fit as well
+                self.changed.notify_all()
+            device = None
+            if space > 0:
+                directory = os.path.dirname(os.path.abspath(path))
+                # a tree creates the directories it is missing
+                while not os.path.isdir(directory) and directory != os.path.dirname(directory):
+                    directory = os.path.dirname(directory)
+                device = os.stat(directory).st_dev
+                stat = os.statvfs(directory)
+                available = stat.f_bavail * stat.f_frsize - self.reserved.get(device, 0)
+                if space > available:
+                    raise OSError(errno.ENOSPC, 'Not enough space for {}: {} bytes needed, {} available'.format(path, space, max(available, 0)))
+                self.reserved[device] = self.reserved.get(device, 0) + space
+            self.running += 1
+            self.inflight += size
+            return Admission(size, device, space if device is not None else 0)
+
+    def withdraw(self, ticket):
+        # the request waiting with ticket is gone
+        with self.changed:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.changed.notify_all()
+
+    def allocated(self, admission):
+        # the transfer holds its blocks in the file now, they show in the free space
+        with self.lock:
+            if admission.reserved > 0:
+                self.reserved[admission.device] -= admission.reserved
+                admission.reserved = 0
+
+    def release(self, admission):
+        self.allocated(admission)
+        with self.changed:
+            self.running -= 1
+            self.inflight -= admission.size
+            self.changed.notify_all()
+
+    def __str__(self):
+        return 'running={} inflight={} waiting={}'.format(self.running, self.inflight, len(self.waiting))
+
+class BufferPool:
+    __slots__ = ('buffers', )
+
+    def __init__(self, buffer_size, count):
+        self.buffers = queue.Queue()
+        for x in range(count):
+            self.buffers.put(bytearray(buffer_size))
+
+    def get(self):
+        return self.buffers.get()
+
+    def put(self, buffer):
+        self.buffers.put(buffer)
+
+class PipelineStats:
+    __slots__ = ('chunks', 'bytes', 'disk_time', 'digest_time', 'disk_stall', 'network_stall')
+
+    def __init__(self):
+        self.chunks = 0
+        self.bytes = 0
+        # seconds spent in disk reads/writes
+        self.disk_time = 0.0
+        # seconds spent hashing chunks, on the disk thread
+        self.digest_time = 0.0
+        # seconds the disk thread sat idle waiting for the network side
+        self.disk_stall = 0.0
+        # seconds the network side sat idle waiting for the disk thread
+        self.network_stall = 0.0
+
+    def dump(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return 'chunks={} bytes={} disk={:.3f}s digest={:.3f}s disk_stall={:.3f}s network_stall={:.3f}s'.format(
+            self.chunks, self.bytes, self.disk_time, self.digest_time, self.disk_stall, self.network_stall
+        )
+
+class CompressionStats:
+    __slots__ = ('chunks', 'bytes', 'wire_bytes', 'bypassed', 'skipped', 'codec_time')
+
+    def __init__(self):
+        self.chunks = 0
+        # bytes of file data, before compression
+        self.bytes = 0
+        # bytes of frame payload actually sent or received
+        self.wire_bytes = 0
+        # chunks compressed but sent raw because they did not shrink
+        self.bypassed = 0
+        # chunks sent raw without trying, while backing off incompressible data
+        self.skipped = 0
+        # seconds the worker pool spent compressing or decompressing
+        self.codec_time = 0.0
+
+    def dump(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return 'chunks={} bytes={} wire={} ratio={:.2f} bypassed={} skipped={} codec={:.3f}s'.format(
+            self.chunks, self.bytes, self.wire_bytes, self.bytes / self.wire_bytes if self.wire_bytes else 1.0, self.bypassed, self.skipped, self.codec_time
+        )
+
+class ChunkReader:
+    __slots__ = ('file_o', 'ranges', 'chunk_size', 'digest', 'digests', 'pool', 'queue', 'stats', 'error', 'stopped', 'finished', 'current', '_thread')
+
+    def __init__(self, file_o, ranges, chunk_size, depth, digest = None):
+        self.file_o = file_o
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.digests = []
+        self.pool = BufferPool(chunk_size, depth + 2)
+        self.queue = queue.Queue(depth)
+        self.stats = PipelineStats()
+        self.error = None
+        self.stopped = False
+        self.finished = False
+        self.current = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            fileno = self.file_o.fileno()
+            for offset, length in self.ranges:
+                count = 0
+                while count < length and not self.stopped:
+                    size = min(self.chunk_size, length - count)
+                    started = time.perf_counter()
+                    view = memoryview(self.pool.get())[:size]
+                    self.stats.disk_stall += time.perf_counter() - started
+                    started = time.perf_counter()
+                    read = 0
+                    while read < size:
+                        n = os.preadv(fileno, [view[read:]], offset + count + read)
+                        if n == 0:
+                            raise EOFError('File ended {} bytes short of offset {}'.format(size - read, offset + count + size))
+                        read = read + n
+                    self.stats.disk_time += time.perf_counter() - started
+                    if self.digest is not None:
+                        started = time.perf_counter()
+                        self.digests.append(hashlib.new(self.digest, view).digest())
+                        self.stats.digest_time += time.perf_counter() - started
+                    started = time.perf_counter()
+                    self.queue.put((offset + count, view))
+                    self.stats.disk_stall += time.perf_counter() - started
+                    count = count + size
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            if self.current is not None:
+                self.pool.put(self.current.obj)
+                self.current = None
+            started = time.perf_counter()
+            item = self.queue.get()
+            self.stats.network_stall += time.perf_counter() - started
+            if item is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                return
+            offset, self.current = item
+            self.stats.chunks += 1
+            self.stats.bytes += len(self.current)
+            yield offset, self.current
+
+    def close(self):
+        self.stopped = True
+        if self.current is not None:
+            self.pool.put(self.current.obj)
+            self.current = None
+        while not self.finished:
+            item = self.queue.get()
+            if item is None:
+                self.finished = True
+            else:
+                self.pool.put(item[1].obj)
+        self._thread.join()
+
+class ChunkWriter:
+    __slots__ = ('fd', 'digest', 'chunks', 'pool', 'queue', 'stats', 'error', '_thread')
+
+    def __init__(self, fd, chunk_size, depth, digest = None):
+        self.fd = fd
+        self.digest = digest
+        # [offset, length, digest] of every chunk written, digest is filled in by the writer thread
+        self.chunks = []
+        self.pool = BufferPool(chunk_size, depth + 2)
+        self.queue = queue.Queue(depth)
+        self.stats = PipelineStats()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.perf_counter()
+            item = self.queue.get()
+            self.stats.disk_stall += time.perf_counter() - started
+            if item is None:
+                return
+            if self.error is not None:
+                # keep draining so the network side never blocks on a dead writer
+                if item[0] == 'write':
+                    self.pool.put(item[2].obj)
+                continue
+            try:
+                started = time.perf_counter()
+                if item[0] == 'write':
+                    pwrite_all(self.fd, item[2], item[1])
+                    self.stats.disk_time += time.perf_counter() - started
+                    if self.digest is not None:
+                        started = time.perf_counter()
+                        self.chunks[item[3]][2] = hashlib.new(self.digest, item[2]).digest()
+                        self.stats.digest_time += time.perf_counter() - started
+                    self.pool.put(item[2].obj)
+                else:
+                    item[1](*item[2])
+                    self.stats.disk_time += time.perf_counter() - started
+            except Exception as e:
+                self.error = e
+
+    def get_buffer(self):
+        started = time.perf_counter()
+        buffer = self.pool.get()
+        self.stats.network_stall += time.perf_counter() - started
+        return buffer
+
+    def release_buffer(self, buffer):
+        self.pool.put(buffer)
+
+    def write(self, offset, view):
+        if self.error is not None:
+            raise self.error
+        self.chunks.append([offset, len(view), None])
+        started = time.perf_counter()
+        self.queue.put(('write', offset, view, len(self.chunks) - 1))
+        self.stats.network_stall += time.perf_counter() - started
+        self.stats.chunks += 1
+        self.stats.bytes += len(view)
+
+    def call(self, function, *args):
+        # runs function on the writer thread, after every write queued before it
+        self.queue.put(('call', function, args))
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class TpftConnection(TinyProtoConnection):
+    __slots__ = ('chunk_size', 'queue_depth', 'digest', 'compression', 'compression_level', 'control_encoding', 'control_offer', 'receive_buffer', 'transferred', 'pipeline_stats', 'compression_stats', 'integrity_failure', 'wakeup', 'metrics', 'transfer_registry', 'shaper', 'durability', 'sync_interval')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.queue_depth = 0
+        # digest algorithm requested for transfers started from this end, None disables verification
+        self.digest = None
+        # codec requested for transfers started from this end, None sends data as is
+        self.compression = None
+        self.compression_level = None
+        # control messages go out as JSON until the remote end shows it reads
+        # control_offer, by sending it or by asking for it
+        self.control_encoding = CONTROL_JSON
+        self.control_offer = None
+        self.integrity_failure = None
+        self.receive_buffer = bytearray()
+        self.transferred = 0
+        self.pipeline_stats = None
+        self.compression_stats = None
+        self.wakeup = None
+        # metrics of the current or last transfer, published to transfer_registry when one is set
+        self.metrics = None
+        self.transfer_registry = None
+        # ConnectionShaper pacing the data frames sent, None sends at full speed
+        self.shaper = None
+        # sync policy of the files this end receives
+        self.durability = DURABILITY_NONE
+        self.sync_interval = 0
+
+    def throttle(self, count):
+        if self.shaper is not None:
+            waited = self.shaper.throttle(count)
+            if self.metrics is not None:
+                self.metrics.throttled += waited
+
+    def begin_metrics(self, direction, path, size = None):
+        peer = '{}:{}'.format(*self.peername_details[:2]) if self.peername_details else None
+        self.metrics = TransferMetrics(direction, path, size, peer)
+        if self.transfer_registry is not None:
+            self.transfer_registry.begin(self.metrics)
+
+    def end_metrics(self):
+        if self.metrics is not None and self.metrics.finished is None:
+            self.metrics.finish()
+            if self.transfer_registry is not None:
+                self.transfer_registry.end(self.metrics)
+
+    def enable_wakeup(self):
+        # a pipe polled next to the socket, so another thread handing over work
+        # does not have to wait for the poll timeout
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self._selector.register(self.wakeup[0], selectors.EVENT_READ)
+
+    def wake(self):
+        if self.wakeup is not None:
+            os.write(self.wakeup[1], b'\0')
+
+    def clear_wakeup(self):
+        if self.wakeup is not None:
+            with contextlib.suppress(BlockingIOError):
+                os.read(self.wakeup[0], 4096)
+
+    def close_wakeup(self):
+        if self.wakeup is not None:
+            wakeup, self.wakeup = self.wakeup, None
+            os.close(wakeup[0])
+            os.close(wakeup[1])
+
+    def send_letter(self, letter):
+        if self.control_offer is not None and self.control_encoding != self.control_offer:
+            letter.Encodings = [self.control_offer]
+        self.transmit(Envelope(letter).encode(self.control_encoding))
+
+    def decode_letter(self, payload):
+        envelope = Envelope(payload)
+        if envelope.encoding == CONTROL_BINARY or CONTROL_BINARY in envelope.letter.Encodings:
+            self.control_encoding = CONTROL_BINARY
+        return envelope
+
+    def request(self, letter):
+        # sends a transfer request. A busy server keeps it in line and tells
+        # where it stands until it answers
+        letter.Queue = True
+        self.send_letter(letter)
+        envelope = self.receive_letter()
+        if isinstance(envelope.letter, BusyLetter):
+            print('Server busy, waiting in line at position {}'.format(envelope.letter.Position))
+        while isinstance(envelope.letter, BusyLetter):
+            envelope = self.receive_letter()
+        return envelope
+
+    def receive_letter(self):
+        return self.decode_letter(self.receive())
+
+    def transmit_file(self, file_o, offset, count):
+        self.throttle(count)
+        # time in sendfile counts as network, page cache reads happen inside it
+        started = time.perf_counter()
+        # plugins may rewrite the payload, so sendfile is only safe on a bare connection
+        if len(self.plugin_list) > 0:
+            self.transmit(os.pread(file_o.fileno(), count, offset))
+        else:
+            try:
+                with self.connection_lock:
+                    self._raw_transmit(self._s_to_ba(count))
+                    tx_status = self._raw_receive(1)
+                    if tx_status[0] != SC_OK:
+                        raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+                    sent = self.socket_o.sendfile(file_o, offset, count)
+                    if sent != count:
+                        raise TinyProtoError('File ended after {} out of {} bytes'.format(sent, count))
+            except OSError:
+                self.shutdown = True
+        if self.metrics is not None:
+            self.metrics.network_send += time.perf_counter() - started
+            self.metrics.moved(count)
+
+    def transmit_chunk(self, view, header = b''):
+        # header goes out in front of view as part of the same frame
+        self.throttle(len(header) + len(view))
+        started = time.perf_counter()
+        if len(self.plugin_list) > 0:
+            self.transmit(header + view if header else view)
+        else:
+            try:
+                with self.connection_lock:
+                    self._raw_transmit(self._s_to_ba(len(header) + len(view)))
+                    tx_status = self._raw_receive(1)
+                    if tx_status[0] != SC_OK:
+                        raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+                    if header:
+                        self.socket_o.sendall(header)
+                    self.socket_o.sendall(view)
+            except OSError:
+                self.shutdown = True
+        if self.metrics is not None:
+            self.metrics.network_send += time.perf_counter() - started
+            self.metrics.moved(len(header) + len(view))
+
+    def receive_chunk(self, buffer = None):
+        # returns a view into buffer, or into a buffer reused by every call when
+        # none is given. Frames larger than the buffer get a fresh one, which is
+        # always reachable as the view's .obj
+        started = time.perf_counter()
+        view = self.receive_frame(buffer)
+        if self.metrics is not None:
+            # includes the time the sender took to produce the frame
+            self.metrics.network_receive += time.perf_counter() - started
+            self.metrics.moved(len(view))
+        return view
+
+    def receive_frame(self, buffer):
+        if len(self.plugin_list) > 0:
+            return memoryview(self.receive())
+        try:
+            with self.connection_lock:
+                recv_count = self._ba_to_s(self._raw_receive(4))
+                if recv_count > MSG_MAX_SIZE:
+                    self._raw_transmit(SC_GENERIC_ERROR)
+                    raise TinyProtoError('Remote end trying to send message of size {} which is bigger then supported max size of {}'.format(recv_count, MSG_MAX_SIZE))
+                elif recv_count == 0 and self.shutdown:
+                    raise TinyProtoError('Received zero bytes from remote end. Most probably remote end dropped connection.')
+                self._raw_transmit(SC_OK)
+                if buffer is None:
+                    if len(self.receive_buffer) < recv_count:
+                        self.receive_buffer = bytearray(recv_count)
+                    buffer = self.receive_buffer
+                elif len(buffer) < recv_count:
+                    buffer = bytearray(recv_count)
+                view = memoryview(buffer)[:recv_count]
+                count = 0
+                while count < recv_count:
+                    received = self.socket_o.recv_into(view[count:])
+                    if received == 0:
+                        self.shutdown = True
+                        return view[:0]
+                    count = count + received
+                return view
+        except OSError:
+            self.shutdown = True
+            return memoryview(b'')
+
+    def send_ranges(self, file_o, ranges, chunk_size = None, digest = None, compression = None, level = None):
+        # returns the digest of every chunk sent when digest names an algorithm
+        chunk_size = chunk_size or self.chunk_size
+        if compression is not None:
+            return self.send_compressed(file_o, ranges, chunk_size, digest, compression, level)
+        # hashing needs the data in userspace, and is kept off this thread by the pipeline
+        queue_depth = self.queue_depth or (VERIFY_QUEUE_DEPTH if digest is not None else 0)
+        if queue_depth > 0:
+            reader = ChunkReader(file_o, ranges, chunk_size, queue_depth, digest)
+            self.pipeline_stats = reader.stats
+            try:
+                started = time.perf_counter()
+                for offset, chunk in reader:
+                    if self.metrics is not None:
+                        self.metrics.disk_read += time.perf_counter() - started
+                    self.transmit_chunk(chunk)
+                    self.transferred = self.transferred + len(chunk)
+                    if self.shutdown:
+                        break
+                    started = time.perf_counter()
+            finally:
+                reader.close()
+            return reader.digests if digest is not None else None
+
+        # without a pipeline the file goes straight from page cache to socket
+        for offset, length in ranges:
+            count = 0
+            while count < length and not self.shutdown:
+                chunk = min(chunk_size, length - count)
+                self.transmit_file(file_o, offset + count, chunk)
+                count = count + chunk
+                self.transferred = self.transferred + chunk
+
+    def send_stream(self, fd, chunk_size = None, digest = None):
+        # sends what fd yields as soon as it is there until fd ends, then the
+        # empty frame that ends the stream and a confirmation carrying the
+        # digest of everything sent
+        hasher = hashlib.new(digest) if digest is not None else None
+        buffer = memoryview(bytearray(chunk_size or self.chunk_size))
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        while not self.shutdown:
+            started = time.perf_counter()
+            count = read_available(fd, buffer, poller)
+            if self.metrics is not None:
+                self.metrics.disk_read += time.perf_counter() - started
+            if count == 0:
+                break
+            if hasher is not None:
+                hasher.update(buffer[:count])
+            self.transmit_chunk(buffer[:count])
+            self.transferred = self.transferred + count
+        if self.shutdown:
+            return
+        self.transmit_chunk(buffer[:0])
+        l = ConfirmationLetter()
+        if hasher is not None:
+            l.TransferDigest = hasher.hexdigest()
+        self.send_letter(l)
+
+    def receive_stream(self, fd, digest = None, streamed = None, drain = True):
+        # writes frames to fd in order until the empty frame that ends the
+        # stream, then checks the digest sent behind it. Once a write fails the
+        # rest is read off and dropped, or with drain unset the connection is
+        # given up. Returns why the stream was not taken, None when it all is in fd
+        hasher = hashlib.new(digest) if digest is not None else None
+        error = None
+        while True:
+            view = self.receive_chunk()
+            if self.shutdown:
+                return 'Connection lost'
+            if len(view) == 0:
+                break
+            self.transferred = self.transferred + len(view)
+            if error is not None:
+                continue
+            if hasher is not None:
+                hasher.update(view)
+            started = time.perf_counter()
+            try:
+                write_all(fd, view)
+                if streamed is not None:
+                    streamed.written(fd, len(view))
+            except OSError as e:
+                error = str(e)
+                if not drain:
+                    self.shutdown = True
+                    return error
+            if self.metrics is not None:
+                self.metrics.disk_write += time.perf_counter() - started
+        trailer = self.receive_letter().letter
+        if error is not None:
+            return error
+        if hasher is not None and trailer.TransferDigest != hasher.hexdigest():
+            return 'Streamed data failed verification'
+        return None
+
+    def send_view(self, entry, ranges, chunk_size, digest = None):
+        # serves a cached file straight from its mapping
+        digests = entry.chunk_digests(digest, ranges, chunk_size) if digest is not None else None
+        for offset, length in chunk_table(ranges, chunk_size):
+            self.transmit_chunk(entry.view[offset:offset + length])
+            self.transferred = self.transferred + length
+            if self.shutdown:
+                break
+        return digests
+
+    def send_compressed(self, file_o, ranges, chunk_size, digest, algorithm, level):
+        # chunks are read, hashed and compressed by a worker pool and sent in
+        # file order. A chunk that does not shrink goes out raw, and compression
+        # is then skipped for a doubling number of chunks before it is tried again
+        fileno = file_o.fileno()
+        stats = CompressionStats()
+        self.compression_stats = stats
+        digests = []
+        pending = deque()
+        backoff = 0
+        skip = 0
+
+        def encode(offset, size, attempt):
+            data = os.pread(fileno, size, offset)
+            if len(data) != size:
+                raise EOFError('File ended {} bytes short of offset {}'.format(size - len(data), offset + size))
+            chunk_digest = hashlib.new(digest, data).digest() if digest is not None else None
+            if not attempt:
+                return chunk_digest, CHUNK_RAW, data, size, False, 0.0
+            started = time.perf_counter()
+            packed = compress_chunk(algorithm, data, level)
+            elapsed = time.perf_counter() - started
+            if len(packed) < size * COMPRESSION_MIN_RATIO:
+                return chunk_digest, CHUNK_COMPRESSED, packed, size, True, elapsed
+            return chunk_digest, CHUNK_RAW, data, size, True, elapsed
+
+        def send(future):
+            nonlocal backoff, skip
+            chunk_digest, flag, payload, size, attempted, elapsed = future.result()
+            self.transmit_chunk(payload, CHUNK_HEADER.pack(flag, size))
+            stats.chunks += 1
+            stats.bytes += size
+            stats.wire_bytes += CHUNK_HEADER.size + len(payload)
+            stats.codec_time += elapsed
+            if not attempted:
+                stats.skipped += 1
+            elif flag == CHUNK_RAW:
+                stats.bypassed += 1
+                backoff = min(max(backoff * 2, 1), COMPRESSION_MAX_BACKOFF)
+                skip = backoff
+            else:
+                backoff = 0
+            if digest is not None:
+                digests.append(chunk_digest)
+            self.transferred = self.transferred + size
+
+        with ThreadPoolExecutor(max_workers=COMPRESSION_WORKERS) as pool:
+            try:
+                for offset, length in ranges:
+                    count = 0
+                    while count < length and not self.shutdown:
+                        size = min(chunk_size, length - count)
+                        attempt = skip == 0
+                        skip = max(skip - 1, 0)
+                        pending.append(pool.submit(encode, offset + count, size, attempt))
+                        count = count + size
+                        if len(pending) >= COMPRESSION_WORKERS * 2:
+                            send(pending.popleft())
+                while pending and not self.shutdown:
+                    send(pending.popleft())
+            finally:
+                for future in pending:
+                    future.cancel()
+        return digests if digest is not None else None
+
+    def receive_range(self, fd, writer, partial, offset, length):
+        # without a writer, frames are received back to back into receive_buffer
+        # and written out together once the next one would not fit
+        count = 0
+        # bytes of the range handed to the disk, count - written wait in receive_buffer
+        written = 0
+        checkpoint = 0
+        frame_size = 0
+
+        def flush(final):
+            nonlocal written
+            pending = count - written
+            size = pending
+            if not final and (offset + count) % RANGE_ALIGNMENT < pending:
+                # the write ends on an aligned offset, the tail leads the next one
+                size = pending - (offset + count) % RANGE_ALIGNMENT
+            started = time.perf_counter()
+            pwrite_all(fd, memoryview(self.receive_buffer)[:size], offset + written)
+            if self.metrics is not None:
+                self.metrics.disk_write += time.perf_counter() - started
+            self.receive_buffer[:pending - size] = self.receive_buffer[size:pending]
+            written = written + size
+
+        try:
+            while count < length:
+                if writer is None:
+                    if len(self.receive_buffer) < WRITE_COALESCE_SIZE:
+                        self.receive_buffer = bytearray(WRITE_COALESCE_SIZE)
+                    if count > written and len(self.receive_buffer) - (count - written) < frame_size:
+                        flush(False)
+                    buff = self.receive_chunk(memoryview(self.receive_buffer)[count - written:])
+                else:
+                    started = time.perf_counter()
+                    buffer = writer.get_buffer()
+                    if self.metrics is not None:
+                        self.metrics.disk_write += time.perf_counter() - started
+                    buff = self.receive_chunk(buffer)
+                if self.shutdown:
+                    if writer is not None:
+                        writer.release_buffer(buffer)
+                    break
+                if writer is None:
+                    frame_size = len(buff)
+                    if buff.obj is not self.receive_buffer:
+                        # outgrew the buffer, the frame goes out on its own and its buffer is kept for the next ones
+                        if count > written:
+                            flush(True)
+                        started = time.perf_counter()
+                        pwrite_all(fd, buff, offset + count)
+                        if self.metrics is not None:
+                            self.metrics.disk_write += time.perf_counter() - started
+                        written = written + len(buff)
+                        if isinstance(buff.obj, bytearray) and len(buff.obj) > len(self.receive_buffer):
+                            self.receive_buffer = buff.obj
+                else:
+                    started = time.perf_counter()
+                    writer.write(offset + count, buff)
+                    if self.metrics is not None:
+                        self.metrics.disk_write += time.perf_counter() - started
+                    written = written + len(buff)
+                count = count + len(buff)
+                self.transferred = self.transferred + len(buff)
+                if written - checkpoint >= partial.checkpoint_size:
+                    self.commit_range(writer, partial, offset + checkpoint, written - checkpoint)
+                    checkpoint = written
+        finally:
+            # whatever made it to disk stays resumable, even if the connection dropped
+            if count > written:
+                flush(True)
+            self.commit_range(writer, partial, offset + checkpoint, written - checkpoint)
+        return count == length
+
+    def commit_range(self, writer, partial, offset, length):
+        if writer is None:
+            partial.commit(offset, length)
+        else:
+            writer.call(partial.commit, offset, length)
+
+    def receive_compressed(self, fd, partial, ranges, algorithm, digest = None, chunks = None):
+        # frames are decoded, written and hashed by a worker pool. Every frame
+        # is received into a buffer of its own since it outlives this loop
+        stats = CompressionStats()
+        self.compression_stats = stats
+        pending = deque()
+
+        def decode(frame, offset, chunk):
+            flag, size = CHUNK_HEADER.unpack_from(frame)
+            payload = frame[CHUNK_HEADER.size:]
+            elapsed = 0.0
+            if flag == CHUNK_COMPRESSED:
+                started = time.perf_counter()
+                payload = decompress_chunk(algorithm, payload, size)
+                elapsed = time.perf_counter() - started
+            if len(payload) != size:
+                raise ValueError('Chunk at offset {} decoded to {} bytes instead of {}'.format(offset, len(payload), size))
+            pwrite_all(fd, payload, offset)
+            if chunk is not None:
+                chunk[2] = hashlib.new(digest, payload).digest()
+            return elapsed
+
+        def drain(limit):
+            while len(pending) > limit:
+                stats.codec_time += pending.popleft().result()
+
+        with ThreadPoolExecutor(max_workers=COMPRESSION_WORKERS) as pool:
+            for offset, length in ranges:
+                count = 0
+                checkpoint = 0
+                try:
+                    while count < length:
+                        frame = self.receive_chunk(bytearray())
+                        if self.shutdown:
+                            break
+                        flag, size = CHUNK_HEADER.unpack_from(frame)
+                        if size > length - count:
+                            raise ValueError('Chunk of {} bytes overruns the range by {} bytes'.format(size, size - length + count))
+                        chunk = None
+                        if digest is not None:
+                            chunk = [offset + count, size, None]
+                            chunks.append(chunk)
+                        pending.append(pool.submit(decode, frame, offset + count, chunk))
+                        stats.chunks += 1
+                        stats.bytes += size
+                        stats.wire_bytes += len(frame)
+                        if flag == CHUNK_RAW:
+                            stats.bypassed += 1
+                        count = count + size
+                        self.transferred = self.transferred + size
+                        drain(COMPRESSION_WORKERS * 2)
+                        if count - checkpoint >= partial.checkpoint_size:
+                            drain(0)
+                            partial.commit(offset + checkpoint, count - checkpoint)
+                            checkpoint = count
+                finally:
+                    drain(0)
+                    partial.commit(offset + checkpoint, count - checkpoint)
+                if count < length:
+                    return False
+        return True
+
+    def receive_ranges(self, fd, partial, ranges, digest = None, chunks = None, compression = None):
+        # with digest set, [offset, length, digest] of every received chunk is appended to chunks
+        if compression is not None:
+            return self.receive_compressed(fd, partial, ranges, compression, digest, chunks)
+        writer = None
+        queue_depth = self.queue_depth or (VERIFY_QUEUE_DEPTH if digest is not None else 0)
+        if queue_depth > 0:
+            writer = ChunkWriter(fd, self.chunk_size, queue_depth, digest)
+            self.pipeline_stats = writer.stats
+        try:
+            for offset, length in ranges:
+                if not self.receive_range(fd, writer, partial, offset, length):
+                    return False
+            return True
+        finally:
+            if writer is not None:
+                writer.close()
+                if chunks is not None:
+                    chunks.extend(writer.chunks)
+
+    def send_batch(self, files):
+        # streams the content of files back to back, small files share frames.
+        # Files that changed since they were listed are cut or zero padded to
+        # the listed size, returns [relative path, reason] for each of them
+        failed = []
+        frame = bytearray()
+        for relative, size, modified, mode, local_path in files:
+            try:
+                file_o = open(local_path, 'rb')
+            except OSError as e:
+                failed.append([relative, str(e)])
+                file_o = None
+            with file_o or contextlib.nullcontext():
+                sent = 0
+                if file_o is not None and size >= self.chunk_size and os.fstat(file_o.fileno()).st_size >= size:
+                    if len(frame) > 0:
+                        self.transmit_chunk(frame)
+                        frame = bytearray()
+                    while sent < size and not self.shutdown:
+                        count = min(self.chunk_size, size - sent)
+                        self.transmit_file(file_o, sent, count)
+                        sent = sent + count
+                        self.transferred = self.transferred + count
+                while sent < size and not self.shutdown:
+                    count = min(self.chunk_size - len(frame), size - sent)
+                    started = time.perf_counter()
+                    data = os.pread(file_o.fileno(), count, sent) if file_o is not None else b''
+                    if self.metrics is not None:
+                        self.metrics.disk_read += time.perf_counter() - started
+                    if len(data) < count:
+                        if file_o is not None and (not failed or failed[-1][0] != relative):
+                            failed.append([relative, 'File changed size during transfer'])
+                        data = data + bytes(count - len(data))
+                    frame += data
+                    sent = sent + count
+                    self.transferred = self.transferred + count
+                    if len(frame) >= self.chunk_size:
+                        self.transmit_chunk(frame)
+                        frame = bytearray()
+        if len(frame) > 0 and not self.shutdown:
+            self.transmit_chunk(frame)
+        return failed
+
+    def receive_batch(self, root, directories, files):
+        # writes what send_batch streams. Each file is written next to its
+        # destination and renamed into place once complete. Returns
+        # [relative path, reason] for every entry that could not be saved, or
+        # None when the connection dropped
+        failed = []
+        for relative, mode in directories:
+            try:
+                path = tree_path(root, relative)
+                os.makedirs(path, exist_ok=True)
+                os.chmod(path, mode | 0o700)
+            except (OSError, ValueError) as e:
+                failed.append([relative, str(e)])
+
+        view = memoryview(b'')
+        # parents of the files renamed into place, synced once the batch is done
+        synced_directories = set()
+        for relative, size, modified, mode in files:
+            fd = None
+            started = time.perf_counter()
+            try:
+                path = tree_path(root, relative)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd = os.open(path + PARTIAL_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                if size >= RANGE_ALIGNMENT:
+                    preallocate(fd, [(0, size)])
+            except (OSError, ValueError) as e:
+                failed.append([relative, str(e)])
+            if self.metrics is not None:
+                self.metrics.disk_write += time.perf_counter() - started
+            try:
+                written = 0
+                while written < size:
+                    if len(view) == 0:
+                        view = self.receive_chunk()
+                        if self.shutdown:
+                            return None
+                    piece = view[:size - written]
+                    if fd is not None:
+                        started = time.perf_counter()
+                        try:
+                            pwrite_all(fd, piece, written)
+                        except OSError as e:
+                            # the rest of the file is still read off the connection
+                            failed.append([relative, str(e)])
+                            os.close(fd)
+                            fd = None
+                            with contextlib.suppress(OSError):
+                                os.unlink(path + PARTIAL_SUFFIX)
+                        if self.metrics is not None:
+                            self.metrics.disk_write += time.perf_counter() - started
+                    written = written + len(piece)
+                    view = view[len(piece):]
+                    self.transferred = self.transferred + len(piece)
+                if fd is not None:
+                    started = time.perf_counter()
+                    os.fchmod(fd, mode)
+                    if self.durability != DURABILITY_NONE:
+                        os.fsync(fd)
+                    os.close(fd)
+                    fd = None
+                    os.utime(path + PARTIAL_SUFFIX, ns=(modified, modified))
+                    os.replace(path + PARTIAL_SUFFIX, path)
+                    if self.durability != DURABILITY_NONE:
+                        synced_directories.add(os.path.dirname(path))
+                    if self.metrics is not None:
+                        self.metrics.disk_write += time.perf_counter() - started
+            except OSError as e:
+                failed.append([relative, str(e)])
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        for directory in synced_directories:
+            with contextlib.suppress(OSError):
+                sync_directory(directory)
+        return failed
+
+    def serve_retransmits(self, file_o, ranges, chunk_size, algorithm, digests):
+        # sender side of verification. Returns the envelope that ended it,
+        # normally the receiver's final confirmation or rejection
+        l = ChunkDigestLetter()
+        l.Algorithm = algorithm
+        l.Digests = digests
+        self.send_letter(l)
+
+        table = chunk_table(ranges, chunk_size or self.chunk_size)
+        while True:
+            envelope = self.receive_letter()
+            if not isinstance(envelope.letter, RetransmitRequestLetter):
+                return envelope
+            for index in envelope.letter.Chunks:
+                offset, length = table[index]
+                self.transmit_file(file_o, offset, length)
+
+    def verify_received(self, fd, chunks, algorithm, commits):
+        # receiver side of verification. Requests mismatched chunks again and
+        # finishes with a confirmation carrying the transfer digest, or a
+        # rejection. commits are released before the confirmation goes out, a
+        # rejected transfer stays a partial file
+        envelope = self.receive_letter()
+        if not isinstance(envelope.letter, ChunkDigestLetter):
+            return None
+        expected = envelope.letter.Digests
+        for attempt in range(MAX_RETRANSMIT_ROUNDS + 1):
+            mismatched = [index for index, chunk in enumerate(chunks) if index >= len(expected) or chunk[2].hex() != expected[index]]
+            if len(expected) == len(chunks) and not mismatched:
+                try:
+                    commits.release()
+                except OSError as e:
+                    l = RejectionLetter()
+                    l.Reason = str(e)
+                    self.send_letter(l)
+                    return None
+                l = ConfirmationLetter()
+                l.TransferDigest = transfer_digest(algorithm, [chunk[2] for chunk in chunks])
+                self.send_letter(l)
+                return l.TransferDigest
+            if attempt == MAX_RETRANSMIT_ROUNDS or len(expected) != len(chunks):
+                break
+            l = RetransmitRequestLetter()
+            l.Chunks = mismatched
+            self.send_letter(l)
+            for index in mismatched:
+                buff = self.receive_chunk()
+                if self.shutdown:
+                    return None
+                pwrite_all(fd, buff, chunks[index][0])
+                chunks[index][2] = hashlib.new(algorithm, buff).digest()
+
+        l = RejectionLetter()
+        l.Reason = 'Integrity check failed for {} chunks'.format(max(len(mismatched), abs(len(expected) - len(chunks))))
+        self.send_letter(l)
+        return None
+
+
+class TpftServerConnection(TpftConnection):
+    __slots__ = ('verbose', 'display_progress', 'uuid', 'file_cache', 'bandwidth_shaper', 'admission_control', 'admission', 'workers')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.verbose = False
+        self.display_progress = False
+        self.uuid = None
+        self.file_cache = None
+        self.admission_control = None
+        self.admission = None
+        self.workers = None
+
+    def pre_loop(self):
+        # a sendfile payload would otherwise sit behind Nagle waiting for a delayed ack
+        self.socket_o.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def apply_delta(self, basis_fd, basis_size, out_fd, file_size, block_size):
+        written = 0
+        literal = 0
+        while written < file_size:
+            frame = self.receive_chunk()
+            if self.shutdown:
+                return None
+            position = 0
+            while position < len(frame):
+                if frame[position] == DELTA_OP_COPY:
+                    op, first, count = DELTA_COPY.unpack_from(frame, position)
+                    position += DELTA_COPY.size
+                    if first * block_size >= basis_size:
+                        raise ValueError('Delta references block {} past the end of the basis file'.format(first))
+                    length = min(count * block_size, basis_size - first * block_size)
+                    started = time.perf_counter()
+                    copy_file_range(basis_fd, out_fd, first * block_size, written, length)
+                else:
+                    op, length = DELTA_LITERAL.unpack_from(frame, position)
+                    position += DELTA_LITERAL.size
+                    started = time.perf_counter()
+                    pwrite_all(out_fd, frame[position:position + length], written)
+                    position += length
+                    literal += length
+                if self.metrics is not None:
+                    self.metrics.disk_write += time.perf_counter() - started
+                written += length
+                self.transferred = self.transferred + length
+        return literal
+
+    def handle_delta_upload(self, letter):
+        destination_path = letter.DestinationPath
+        directory, filename = os.path.split(destination_path)
+        try:
+            basis = open(destination_path, 'rb')
+            out_fd, temp_path = tempfile.mkstemp(prefix='.' + filename + '.', suffix=DELTA_SUFFIX, dir=directory or '.')
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open delta basis or temporary file: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        basis_fd = basis.fileno()
+        basis_stat = os.fstat(basis_fd)
+        block_size = delta_block_size(basis_stat.st_size)
+        l = ConfirmationLetter()
+        l.BlockSize = block_size
+        l.BlockCount = -(-basis_stat.st_size // block_size)
+        # the rebuilt file is hashed whole, copies from the basis included
+        digest = letter.Digest if letter.DeltaDigest and letter.Digest in SUPPORTED_DIGESTS else None
+        if digest is not None:
+            l.Digest = digest
+        self.send_letter(l)
+        if self.verbose:
+            print("[{}] Sending signature of {} blocks of {} bytes ... ".format(self.uuid, l.BlockCount, block_size))
+        self.transmit(b''.join(block_signature(basis_fd, basis_stat.st_size, block_size)))
+
+        literal = None
+        rebuilt_digest = None
+        matched = True
+        try:
+            literal = self.apply_delta(basis_fd, basis_stat.st_size, out_fd, letter.FileSize, block_size)
+            if literal is not None and digest is not None:
+                # the client sends the digest of its source once it has read all of it,
+                # the basis is only replaced by a rebuilt file that matches it
+                rebuilt_digest = file_digest(temp_path, digest)
+                envelope = self.receive_letter()
+                if self.shutdown:
+                    literal = None
+                else:
+                    matched = isinstance(envelope.letter, ConfirmationLetter) and envelope.letter.TransferDigest == rebuilt_digest
+            if literal is not None and matched:
+                os.fchmod(out_fd, basis_stat.st_mode & 0o7777)
+                if self.durability != DURABILITY_NONE:
+                    os.fsync(out_fd)
+                os.replace(temp_path, destination_path)
+                if self.durability != DURABILITY_NONE:
+                    sync_directory(directory or '.')
+        finally:
+            os.close(out_fd)
+            basis.close()
+            if literal is None or not matched:
+                os.unlink(temp_path)
+        if literal is None:
+            if self.verbose:
+                print("[{}] Connection lost. Delta upload discarded.".format(self.uuid))
+            return
+        if not matched:
+            l = RejectionLetter()
+            l.Reason = 'Rebuilt file does not match the source'
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Rebuilt file does not match the source. Delta upload discarded, {} kept.".format(self.uuid, destination_path))
+            return
+        if self.verbose:
+            print("[{}] File rebuilt from {} literal and {} copied bytes. Sending confirmation to client.".format(self.uuid, literal, letter.FileSize - literal))
+        l = ConfirmationLetter()
+        if rebuilt_digest is not None:
+            l.TransferDigest = rebuilt_digest
+        self.send_letter(l)
+
+    def handle_upload(self, letter):
+        if letter.Stream:
+            self.handle_stream_upload(letter)
+            return
+        if letter.Delta and letter.Offset is None and not letter.Resume and os.path.isfile(letter.DestinationPath):
+            self.handle_delta_upload(letter)
+            return
+
+        file_size = letter.FileSize
+        ranged = letter.Offset is not None
+        offset = letter.Offset or 0
+        length = file_size - offset if letter.Length is None else letter.Length
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        compression = letter.Compression if letter.Compression in SUPPORTED_COMPRESSIONS else None
+        partial = PartialFile(letter.DestinationPath, self.durability, self.sync_interval)
+
+        try:
+            ranges = partial.begin(file_size, letter.TransferId or str(uuid4()), letter.Resume, letter.SourceModified, offset, length)
+            fd = partial.open_for_write()
+            if letter.Extents is not None:
+                # the partial file starts out as one hole, the holes of the source are complete already
+                ranges, holes = split_sparse(ranges, letter.Extents)
+                if holes:
+                    partial.commit_ranges(holes)
+            # running out of space is answered before any data is sent
+            preallocate(fd, ranges)
+            self.admission_control.allocated(self.admission)
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open destination path: {} - Sending reject.".format(self.uuid, str(e)))
+        else:
+            l = ConfirmationLetter()
+            if ranged:
+                l.Offset = offset
+                l.Length = length
+            l.Ranges = ranges
+            if letter.Extents is not None:
+                l.Sparse = True
+            if digest is not None:
+                l.Digest = digest
+            if compression is not None:
+                l.Compression = compression
+            self.send_letter(l)
+
+            if self.verbose:
+                print("[{}] Destination file opened. Confirmation sent. Starting data transfer of {} bytes out of {} requested ... ".format(self.uuid, sum(r[1] for r in ranges), length))
+            chunks = []
+            verified = None
+            commits = VerifiedCommits(partial) if digest is not None else partial
+            try:
+                complete = self.receive_ranges(fd, commits, ranges, digest, chunks, compression)
+                if complete and not ranges and not self.shutdown:
+                    # an empty file, nothing was received that would have completed it
+                    commits.commit(offset, 0)
+                if complete and digest is not None and not self.shutdown:
+                    verified = self.verify_received(fd, chunks, digest, commits)
+            finally:
+                os.close(fd)
+            if self.shutdown:
+                if self.verbose:
+                    print("[{}] Connection lost. Partial file kept at {}".format(self.uuid, partial.partial_path))
+                return
+            if self.verbose and self.pipeline_stats is not None:
+                print("[{}] Pipeline stats: {}".format(self.uuid, self.pipeline_stats))
+            if self.verbose and self.compression_stats is not None:
+                print("[{}] Compression stats: {}".format(self.uuid, self.compression_stats))
+            if digest is not None:
+                # verification already answered the client
+                if self.verbose:
+                    if verified:
+                        print("[{}] File saved. Verification passed with {} chunk-list digest {}.".format(self.uuid, digest, verified))
+                    else:
+                        print("[{}] Verification failed. Partial file kept at {}".format(self.uuid, partial.partial_path))
+                return
+            if self.verbose:
+                print("[{}] File saved. Sending confirmation to client.".format(self.uuid))
+            self.send_letter(ConfirmationLetter())
+
+    def handle_stream_upload(self, letter):
+        # nothing is known of the size, frames are appended as they come
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        streamed = StreamedFile(letter.DestinationPath, self.durability, self.sync_interval)
+        try:
+            fd = streamed.open_for_write()
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open destination path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        l = ConfirmationLetter()
+        l.Stream = True
+        if digest is not None:
+            l.Digest = digest
+        self.send_letter(l)
+        if self.verbose:
+            print("[{}] Destination file opened. Confirmation sent. Receiving stream ... ".format(self.uuid))
+        try:
+            error = self.receive_stream(fd, digest, streamed)
+            if error is None:
+                streamed.finish(fd)
+        except OSError as e:
+            error = str(e)
+        finally:
+            os.close(fd)
+        if error is not None:
+            streamed.abandon()
+            if self.verbose:
+                print("[{}] Stream dropped: {}".format(self.uuid, error))
+            if not self.shutdown:
+                l = RejectionLetter()
+                l.Reason = error
+                self.send_letter(l)
+            return
+        if self.verbose:
+            print("[{}] Stream of {} bytes saved. Sending confirmation to client.".format(self.uuid, self.transferred))
+        self.send_letter(ConfirmationLetter())
+
+    def handle_download(self, letter):
+        if letter.Stream:
+            self.handle_stream_download(letter)
+            return
+        download_path, offset, length = letter.DownloadPath, letter.Offset, letter.Length
+        entry = None
+        try:
+            # a followed file keeps growing, the cache only holds what it mapped
+            if self.file_cache is not None and not letter.Follow:
+                entry = self.file_cache.acquire(download_path)
+            if entry is None:
+                fd = open(download_path, 'rb')
+                stat = os.fstat(fd.fileno())
+                file_size, modified = stat.st_size, stat.st_mtime_ns
+            else:
+                fd = entry.file_o
+                file_size, modified = entry.size, entry.modified
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+        else:
+            ranged = offset is not None
+            offset, length = resolve_window(file_size, offset, length)
+            if self.verbose:
+                print("[{}] Opened file for reading{}. Sending download confirmation ... ".format(self.uuid, '' if entry is None else ' from cache'))
+            if self.serve_range(fd, entry, letter, offset, length, file_size, modified, ranged) and letter.Follow:
+                self.follow_download(fd, letter, offset + length)
+            if entry is not None:
+                self.file_cache.release(entry)
+            else:
+                fd.close()
+
+    def handle_stream_download(self, letter):
+        # the file is read until it ends rather than up to its size, so a pipe
+        # or a file still being written is sent as well
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        try:
+            fd = os.open(letter.DownloadPath, os.O_RDONLY)
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        try:
+            l = DownloadConfirmationLetter()
+            l.Stream = True
+            if digest is not None:
+                l.Digest = digest
+            self.send_letter(l)
+            if not isinstance(self.receive_letter().letter, ConfirmationLetter):
+                if self.verbose:
+                    print("[{}] Client rejected file.".format(self.uuid))
+                return
+            if self.verbose:
+                print("[{}] Client accepted file. Starting stream ... ".format(self.uuid))
+            self.send_stream(fd, min(max(letter.ChunkSize or self.chunk_size, 1), MAX_CHUNK_SIZE), digest)
+            if not self.shutdown and not isinstance(self.receive_letter().letter, ConfirmationLetter) and self.verbose:
+                print("[{}] Client rejected stream.".format(self.uuid))
+            if self.verbose:
+                print("[{}] Stream of {} bytes completed.".format(self.uuid, self.transferred))
+        finally:
+            os.close(fd)
+
+    def serve_range(self, fd, entry, letter, offset, length, file_size, modified, ranged):
+        # offers offset and length of an open download and sends them once the
+        # client accepts, returns whether the client confirmed what it got
+        ranges = [(offset, length)]
+        if letter.Sparse:
+            ranges = data_extents(fd.fileno(), offset, length)
+        if self.metrics is not None:
+            self.metrics.size = (self.metrics.size or 0) + sum(size for start, size in ranges)
+
+        l = DownloadConfirmationLetter()
+        l.FileSize = file_size
+        l.Modified = modified
+        if ranged:
+            l.Offset = offset
+            l.Length = length
+        if ranges != [(offset, length)]:
+            l.Extents = ranges
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        if digest is not None:
+            l.Digest = digest
+        compression = letter.Compression if letter.Compression in SUPPORTED_COMPRESSIONS else None
+        if compression is not None:
+            l.Compression = compression
+        if letter.Follow:
+            l.Follow = True
+        self.send_letter(l)
+
+        envelope = self.receive_letter()
+        if not isinstance(envelope.letter, ConfirmationLetter):
+            if self.verbose:
+                print("[{}] Client rejected file.".format(self.uuid))
+            return False
+        if self.verbose:
+            print("[{}] Client accepted file. Starting transfer of {} bytes at offset {} ... ".format(self.uuid, length, offset))
+
+        chunk_size = min(max(letter.ChunkSize or self.chunk_size, 1), MAX_CHUNK_SIZE)
+        level = letter.CompressionLevel
+        if compression is not None and level not in COMPRESSION_LEVEL_RANGES[compression]:
+            level = None
+        if entry is not None and compression is None:
+            digests = self.send_view(entry, ranges, chunk_size, digest)
+        else:
+            digests = self.send_ranges(fd, ranges, chunk_size, digest, compression, level)
+
+        if digest is not None:
+            envelope = self.serve_retransmits(fd, ranges, chunk_size, digest, digests)
+        else:
+            envelope = self.receive_letter()
+        confirmed = isinstance(envelope.letter, ConfirmationLetter)
+        if not confirmed and self.verbose:
+            print("[{}] Client rejected binary transfer.".format(self.uuid))
+        if self.verbose and self.pipeline_stats is not None:
+            print("[{}] Pipeline stats: {}".format(self.uuid, self.pipeline_stats))
+        if self.verbose and self.compression_stats is not None:
+            print("[{}] Compression stats: {}".format(self.uuid, self.compression_stats))
+        if self.verbose:
+            print("[{}] Transfer completed.".format(self.uuid))
+        return confirmed
+
+    def follow_download(self, fd, letter, end):
+        # keeps a download open once its range is sent. What gets appended to
+        # the file is offered as a range of its own until the client leaves,
+        # the open file is followed, a file renamed over its path is not
+        if self.admission is not None:
+            # following has no end, it gives up its admission once the requested range is sent
+            self.admission_control.release(self.admission)
+            self.admission = None
+        if self.verbose:
+            print("[{}] Following {} from offset {}".format(self.uuid, letter.DownloadPath, end))
+        while not self.shutdown:
+            if any(key.fileobj is self.socket_o for key, events in self._selector.select(FOLLOW_POLL_INTERVAL)):
+                # a follower only speaks up to leave, the close letter is taken so the client is not reset
+                if self.socket_o.recv(1, socket.MSG_PEEK):
+                    self.receive()
+                self.shutdown = True
+                break
+            stat = os.fstat(fd.fileno())
+            if stat.st_size < end:
+                l = RejectionLetter()
+                l.Reason = 'File {} was truncated while followed'.format(letter.DownloadPath)
+                self.send_letter(l)
+                break
+            if stat.st_size > end:
+                if not self.serve_range(fd, None, letter, end, stat.st_size - end, stat.st_size, stat.st_mtime_ns, True):
+                    break
+                end = stat.st_size
+        if self.verbose:
+            print("[{}] Stopped following {} at offset {}".format(self.uuid, letter.DownloadPath, end))
+
+    def handle_file_batch(self, letter):
+        failed = self.receive_batch(letter.DestinationPath, letter.Directories, letter.Files)
+        if failed is None:
+            if self.verbose:
+                print("[{}] Connection lost. File batch discarded.".format(self.uuid))
+            return
+        if self.verbose:
+            print("[{}] Saved batch of {} directories and {} files, {} failed. Sending confirmation to client.".format(self.uuid, len(letter.Directories), len(letter.Files), len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        self.send_letter(l)
+
+    def handle_tree_download(self, letter):
+        download_path = letter.DownloadPath
+        try:
+            os.stat(download_path)
+        except OSError as e:
+            l = RejectionLetter()
+            l.Reason = str(e)
+            self.send_letter(l)
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        failed = []
+        file_count = 0
+        if letter.Paths is None:
+            batches = batch_tree([download_path], failed)
+        else:
+            # listed paths start with the name of the download path, like the entries of a whole tree
+            root, name = os.path.split(os.path.normpath(download_path))
+            paths = []
+            for relative in letter.Paths:
+                if relative.split('/', 1)[0] == name:
+                    paths.append((root, relative))
+                else:
+                    failed.append([relative, 'Refusing path outside of the download path'])
+            batches = batch_entries(listed_entries(paths, failed))
+        for directories, files in batches:
+            l = FileBatchLetter()
+            l.Directories = directories
+            l.Files = [entry[:4] for entry in files]
+            self.send_letter(l)
+            failed.extend(self.send_batch(files))
+            if self.shutdown:
+                if self.verbose:
+                    print("[{}] Connection lost during tree download.".format(self.uuid))
+                return
+            file_count = file_count + len(files)
+        if self.verbose:
+            print("[{}] Sent {} files, {} failed.".format(self.uuid, file_count, len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        self.send_letter(l)
+
+    def handle_manifest(self, letter):
+        # the manifest goes out over as many letters as needed, a confirmation
+        # listing the entries that could not be read ends it
+        if letter.Path is None:
+            l = RejectionLetter()
+            l.Reason = 'Manifest request without a path'
+            self.send_letter(l)
+            return
+
+        # an algorithm the server does not know is answered without digests
+        algorithm = letter.Algorithm if letter.Algorithm in SUPPORTED_DIGESTS else None
+        failed = []
+        directory_count, file_count = 0, 0
+        # batches go out while the rest of the tree is still being listed
+        for directories, files in manifest_batches(letter.Path, algorithm, failed):
+            l = ManifestLetter()
+            l.Algorithm = algorithm
+            l.Directories = directories
+            l.Files = files
+            self.send_letter(l)
+            if self.shutdown:
+                return
+            directory_count, file_count = directory_count + len(directories), file_count + len(files)
+        if self.verbose:
+            print("[{}] Listed {} directories and {} files, {} failed.".format(self.uuid, directory_count, file_count, len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        self.send_letter(l)
+
+    def handle_message(self, msg):
+        if not isinstance(msg, Envelope):
+            raise ValueError('handle_letter only accepts instances of Letter class')
+
+        letter = msg.letter
+        try:
+            if isinstance(letter, ConnectionCloseLetter):
+                self.shutdown = True
+            elif isinstance(letter, UploadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested upload of file {} of size {}".format(self.uuid, letter.DestinationPath, letter.FileSize))
+                if self.admit(letter, *upload_needs(letter), letter.DestinationPath):
+                    self.begin_metrics('upload', letter.DestinationPath, letter.FileSize)
+                    self.handle_upload(letter)
+            elif isinstance(letter, DownloadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested download of file {}".format(self.uuid, letter.DownloadPath))
+                if self.admit(letter, download_size(letter)):
+                    self.begin_metrics('download', letter.DownloadPath)
+                    self.handle_download(letter)
+            elif isinstance(letter, FileBatchLetter):
+                if self.verbose:
+                    print("[{}] Requested upload of {} files into {}".format(self.uuid, len(letter.Files), letter.DestinationPath))
+                if self.admit_batch(letter, *batch_needs(letter)):
+                    self.begin_metrics('tree-upload', letter.DestinationPath, sum(entry[1] for entry in letter.Files))
+                    self.handle_file_batch(letter)
+            elif isinstance(letter, TreeDownloadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested download of tree {}".format(self.uuid, letter.DownloadPath))
+                # the size of a tree is not known before it is listed, it takes a slot only
+                if self.admit(letter, 0):
+                    self.begin_metrics('tree-download', letter.DownloadPath)
+                    self.handle_tree_download(letter)
+            elif isinstance(letter, ManifestRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested manifest of {}".format(self.uuid, letter.Path))
+                self.handle_manifest(letter)
+            elif isinstance(letter, StatsRequestLetter):
+                self.handle_stats()
+            elif isinstance(letter, LimitsLetter):
+                self.send_letter(limits_reply(self.bandwidth_shaper, letter, self.peername_details[0], self.workers))
+            else:
+                if self.verbose:
+                    print("[{}] Unhandleable letter received {}".format(self.uuid, letter.__class__))
+        finally:
+            self.end_metrics()
+            if self.admission is not None:
+                self.admission_control.release(self.admission)
+                self.admission = None
+        if self.verbose and self.metrics is not None:
+            print("[{}] Transfer metrics: {}".format(self.uuid, self.metrics))
+            self.metrics = None
+
+    def admit(self, letter, size, space = 0, path = None):
+        # returns whether a transfer request may go ahead, it is answered when
+        # not. Over the caps a request waits here in line if its client can
+        # wait, and is turned away if not
+        ticket = 0 if letter.Queue else None
+        noticed = None
+        try:
+            while True:
+                try:
+                    admission = self.admission_control.admit(size, ticket, path, space, ADMISSION_POLL_INTERVAL)
+                except OSError as e:
+                    l = RejectionLetter()
+                    l.Reason = str(e)
+                    self.send_letter(l)
+                    if self.verbose:
+                        print("[{}] Request turned away: {}".format(self.uuid, str(e)))
+                    return False
+                if admission.admitted:
+                    self.admission = admission
+                    return True
+                if admission.ticket is None:
+                    l = RejectionLetter()
+                    l.Reason = 'Server busy, try again later'
+                    self.send_letter(l)
+                    if self.verbose:
+                        print("[{}] Server busy ({}), request turned away".format(self.uuid, self.admission_control))
+                    return False
+                ticket = admission.ticket
+                if noticed is None or time.monotonic() - noticed >= ADMISSION_NOTICE_INTERVAL:
+                    noticed = time.monotonic()
+                    l = BusyLetter()
+                    l.Position = admission.position
+                    self.send_letter(l)
+                    if self.verbose:
+                        print("[{}] Server busy ({}), request waits at position {}".format(self.uuid, self.admission_control, admission.position))
+                if self.shutdown or any(key.fileobj is self.socket_o for key, events in self._selector.select(0)):
+                    # a waiting client only speaks up to leave
+                    if not self.shutdown and self.socket_o.recv(1, socket.MSG_PEEK):
+                        self.receive()
+                    self.shutdown = True
+                    return False
+        finally:
+            # an admitted request has left the line already
+            if ticket:
+                self.admission_control.withdraw(ticket)
+
+    def admit_batch(self, letter, size, space):
+        # a file batch cannot be told where it stands, its data follows the
+        # letter with the client waiting for it to be taken. It waits in line
+        # quietly, a batch turned away has its data read off
+        try:
+            admission = self.admission_control.admit(size, 0, letter.DestinationPath, space, ADMISSION_BATCH_WAIT)
+        except OSError as e:
+            reason = str(e)
+        else:
+            if admission.admitted:
+                self.admission = admission
+                return True
+            self.admission_control.withdraw(admission.ticket)
+            reason = 'Server busy, try again later'
+        remaining = size
+        while remaining > 0 and not self.shutdown:
+            remaining = remaining - len(self.receive_chunk())
+        if not self.shutdown:
+            l = RejectionLetter()
+            l.Reason = reason
+            self.send_letter(l)
+        if self.verbose:
+            print("[{}] Batch turned away: {}".format(self.uuid, reason))
+        return False
+
+    def handle_stats(self):
+        l = StatsLetter()
+        l.Fields = TRANSFER_METRICS_FIELDS
+        if self.workers is not None:
+            l.Transfers = self.workers.rows()
+        else:
+            l.Transfers = self.transfer_registry.rows() if self.transfer_registry is not None else []
+        self.send_letter(l)
+
+    def transmission_received(self, msg):
+        envelope = self.decode_letter(msg)
+        self.handle_message(envelope)
+
+class TpftServer(TinyProtoServer):
+    __slots__ = ('verbose', 'display_progress', 'chunk_size', 'queue_depth', 'file_cache', 'transfer_registry', 'bandwidth_shaper', 'admission_control', 'durability', 'sync_interval', 'progress_shown', 'workers')
+
+    def _activate_l(self, connection_details):
+        if self.workers is None:
+            return super()._activate_l(connection_details)
+        # every worker listens on the port, the kernel spreads connections over them
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(connection_details.socket_connect_details)
+        listen_socket.listen(5)
+        self._selector.register(listen_socket, selectors.EVENT_READ)
+        self.listen_socks.append(listen_socket)
+
+    def pre_loop(self):
+        self.progress_shown = time.monotonic()
+
+    def loop_pass(self):
+        if self.display_progress and time.monotonic() - self.progress_shown >= 1:
+            self.progress_shown = time.monotonic()
+            self.transfer_registry.print_progress()
+
+    def conn_init(self, conn_id, conn_o):
+        if self.verbose:
+            print('[SRV] Opened connection from {}'.format(conn_o.socket_o.getpeername()))
+        conn_o.verbose = self.verbose
+        conn_o.display_progress = self.display_progress
+        conn_o.chunk_size = self.chunk_size
+        conn_o.queue_depth = self.queue_depth
+        conn_o.file_cache = self.file_cache
+        conn_o.transfer_registry = self.transfer_registry
+        conn_o.bandwidth_shaper = self.bandwidth_shaper
+        conn_o.admission_control = self.admission_control
+        conn_o.workers = self.workers
+        conn_o.durability = self.durability
+        conn_o.sync_interval = self.sync_interval
+        conn_o.shaper = self.bandwidth_shaper.attach(conn_o.socket_o.getpeername()[0])
+        conn_o.uuid = conn_id
+
+    def conn_shutdown(self, conn_id, conn_o):
+        self.bandwidth_shaper.detach(conn_o.shaper)
+        if self.verbose:
+            print('[SRV] Connection closed from {}'.format(conn_o.peername_details))
+            if self.file_cache is not None:
+                print('[SRV] File cache: {}'.format(self.file_cache))
+
+
+class AsyncTpftServerConnection:
+    # speaks the same protocol as TpftServerConnection on asyncio streams.
+    # Compression and delta are declined by not echoing them back, the
+    # client then sends plain data
+    __slots__ = ('reader', 'writer', 'server', 'uuid', 'verbose', 'chunk_size', 'file_cache', 'control_encoding', 'transferred', 'shutdown', 'peer', 'metrics', 'shaper', 'admission')
+
+    def __init__(self, reader, writer, server, uuid):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.uuid = uuid
+        self.verbose = server.verbose
+        self.chunk_size = server.chunk_size
+        self.file_cache = server.file_cache
+        self.control_encoding = CONTROL_JSON
+        self.transferred = 0
+        self.shutdown = False
+        peername = writer.get_extra_info('peername')
+        self.peer = '{}:{}'.format(*peername[:2]) if peername else None
+        self.metrics = None
+        self.shaper = server.bandwidth_shaper.attach(peername[0] if peername else None)
+        self.admission = None
+
+    def begin_metrics(self, direction, path, size = None):
+        self.metrics = TransferMetrics(direction, path, size, self.peer)
+        self.server.transfer_registry.begin(self.metrics)
+
+    def end_metrics(self):
+        if self.metrics is not None:
+            self.metrics.finish()
+            self.server.transfer_registry.end(self.metrics)
+            if self.verbose:
+                print("[{}] Transfer metrics: {}".format(self.uuid, self.metrics))
+            self.metrics = None
+
+    def run_disk(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.server.disk_pool, function, *args)
+
+    async def receive(self):
+        started = time.perf_counter()
+        try:
+            recv_count = int.from_bytes(await self.reader.readexactly(4), 'big')
+            if recv_count > MSG_MAX_SIZE:
+                self.writer.write(bytes((SC_GENERIC_ERROR, )))
+                raise TinyProtoError('Remote end trying to send message of size {} which is bigger then supported max size of {}'.format(recv_count, MSG_MAX_SIZE))
+            self.writer.write(bytes((SC_OK, )))
+            return await self.reader.readexactly(recv_count)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.shutdown = True
+            return b''
+        finally:
+            if self.metrics is not None:
+                self.metrics.network_receive += time.perf_counter() - started
+
+    async def transmit(self, payload):
+        started = time.perf_counter()
+        try:
+            self.writer.write(len(payload).to_bytes(4, 'big'))
+            tx_status = await self.reader.readexactly(1)
+            if tx_status[0] != SC_OK:
+                raise TinyProtoError('Transmission rejected: {0}'.format(tx_status))
+            self.writer.write(payload)
+            # waits while the socket buffer is full, so a slow client holds no more than a chunk
+            await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.shutdown = True
+        finally:
+            if self.metrics is not None:
+                self.metrics.network_send += time.perf_counter() - started
+
+    async def send_letter(self, letter):
+        await self.transmit(Envelope(letter).encode(self.control_encoding))
+
+    def decode_letter(self, payload):
+        envelope = Envelope(payload)
+        if envelope.encoding == CONTROL_BINARY or CONTROL_BINARY in envelope.letter.Encodings:
+            self.control_encoding = CONTROL_BINARY
+        return envelope
+
+    async def reject(self, reason):
+        l = RejectionLetter()
+        l.Reason = reason
+        await self.send_letter(l)
+
+    async def receive_ranges(self, fd, partial, ranges, digest = None, chunks = None):
+        # frames are gathered into one vectored write of up to WRITE_COALESCE_SIZE,
+        # which is kept in flight while the next frames come off the socket.
+        # With digest set, the write hashes its frames as well and
+        # [offset, length, digest] of every frame is appended to chunks
+        pending = None
+
+        def write(frames, position, hashed):
+            pwritev_all(fd, frames, position)
+            for frame, chunk in zip(frames, hashed):
+                chunk[2] = hashlib.new(digest, frame).digest()
+
+        for offset, length in ranges:
+            count = 0
+            # frames received since the last write, starting at written
+            frames = []
+            hashed = []
+            written = 0
+            checkpoint = 0
+
+            async def flush(wait):
+                # with wait set, returns once everything up to written is on disk
+                nonlocal pending, frames, hashed, written
+                if pending is not None:
+                    started = time.perf_counter()
+                    await pending
+                    self.metrics.disk_write += time.perf_counter() - started
+                    pending = None
+                if frames:
+                    pending = self.run_disk(write, frames, offset + written, hashed)
+                    frames = []
+                    hashed = []
+                    written = count
+                if wait and pending is not None:
+                    await flush(False)
+
+            try:
+                while count < length:
+                    buff = await self.receive()
+                    if self.shutdown:
+                        break
+                    self.metrics.moved(len(buff))
+                    if digest is not None:
+                        hashed.append([offset + count, len(buff), None])
+                        chunks.append(hashed[-1])
+                    frames.append(buff)
+                    count = count + len(buff)
+                    self.transferred = self.transferred + len(buff)
+                    if count - written >= WRITE_COALESCE_SIZE or len(frames) >= WRITE_COALESCE_FRAMES:
+                        await flush(False)
+                    if written - checkpoint >= partial.checkpoint_size:
+                        await flush(True)
+                        await self.run_disk(partial.commit, offset + checkpoint, written - checkpoint)
+                        checkpoint = written
+            finally:
+                await flush(True)
+                await self.run_disk(partial.commit, offset + checkpoint, written - checkpoint)
+            if count < length:
+                return False
+        return True
+
+    async def throttle(self, count):
+        for delay in self.shaper.delays(count):
+            if delay > 0:
+                await asyncio.sleep(delay)
+                self.metrics.throttled += delay
+
+    async def send_ranges(self, read, ranges, chunk_size, digest = None):
+        # read(length, offset) runs on the disk pool, the next chunk is read while
+        # the current one is sent. With digest set, chunks are hashed there as
+        # well and their digests returned
+        digests = []
+
+        def fetch(length, offset):
+            buff = read(length, offset)
+            return buff, hashlib.new(digest, buff).digest() if digest is not None else None
+
+        chunks = chunk_table(ranges, chunk_size)
+        pending = self.run_disk(fetch, chunks[0][1], chunks[0][0]) if chunks else None
+        for index in range(len(chunks)):
+            started = time.perf_counter()
+            buff, chunk_digest = await pending
+            self.metrics.disk_read += time.perf_counter() - started
+            pending = self.run_disk(fetch, chunks[index + 1][1], chunks[index + 1][0]) if index + 1 < len(chunks) else None
+            if len(buff) != chunks[index][1]:
+                raise EOFError('File ended {} bytes short of offset {}'.format(chunks[index][1] - len(buff), sum(chunks[index])))
+            digests.append(chunk_digest)
+            await self.throttle(len(buff))
+            await self.transmit(buff)
+            self.metrics.moved(len(buff))
+            self.transferred = self.transferred + len(buff)
+            if self.shutdown:
+                break
+        if pending is not None:
+            await pending
+        return digests if digest is not None else None
+
+    async def serve_retransmits(self, read, ranges, chunk_size, algorithm, digests):
+        # see TpftConnection.serve_retransmits. Returns None when the connection dropped
+        l = ChunkDigestLetter()
+        l.Algorithm = algorithm
+        l.Digests = digests
+        await self.send_letter(l)
+
+        table = chunk_table(ranges, chunk_size)
+        while True:
+            msg = await self.receive()
+            if self.shutdown:
+                return None
+            envelope = self.decode_letter(msg)
+            if not isinstance(envelope.letter, RetransmitRequestLetter):
+                return envelope
+            for index in envelope.letter.Chunks:
+                offset, length = table[index]
+                buff = await self.run_disk(read, length, offset)
+                await self.throttle(len(buff))
+                await self.transmit(buff)
+                self.metrics.moved(len(buff))
+
+    async def verify_received(self, fd, chunks, algorithm, commits):
+        # see TpftConnection.verify_received, retransmitted chunks are written
+        # and hashed on the disk pool
+        def rewrite(buff, chunk):
+            pwrite_all(fd, buff, chunk[0])
+            chunk[2] = hashlib.new(algorithm, buff).digest()
+
+        msg = await self.receive()
+        if self.shutdown:
+            return None
+        envelope = self.decode_letter(msg)
+        if not isinstance(envelope.letter, ChunkDigestLetter):
+            return None
+        expected = envelope.letter.Digests
+        for attempt in range(MAX_RETRANSMIT_ROUNDS + 1):
+            mismatched = [index for index, chunk in enumerate(chunks) if index >= len(expected) or chunk[2].hex() != expected[index]]
+            if len(expected) == len(chunks) and not mismatched:
+                try:
+                    await self.run_disk(commits.release)
+                except OSError as e:
+                    await self.reject(str(e))
+                    return None
+                l = ConfirmationLetter()
+                l.TransferDigest = transfer_digest(algorithm, [chunk[2] for chunk in chunks])
+                await self.send_letter(l)
+                return l.TransferDigest
+            if attempt == MAX_RETRANSMIT_ROUNDS or len(expected) != len(chunks):
+                break
+            l = RetransmitRequestLetter()
+            l.Chunks = mismatched
+            await self.send_letter(l)
+            for index in mismatched:
+                buff = await self.receive()
+                if self.shutdown:
+                    return None
+                self.metrics.moved(len(buff))
+                await self.run_disk(rewrite, buff, chunks[index])
+
+        await self.reject('Integrity check failed for {} chunks'.format(max(len(mismatched), abs(len(expected) - len(chunks)))))
+        return None
+
+    async def handle_upload(self, letter):
+        if letter.Stream:
+            await self.handle_stream_upload(letter)
+            return
+        file_size = letter.FileSize
+        ranged = letter.Offset is not None
+        offset = letter.Offset or 0
+        length = file_size - offset if letter.Length is None else letter.Length
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        partial = PartialFile(letter.DestinationPath, self.server.durability, self.server.sync_interval)
+
+        try:
+            ranges = await self.run_disk(partial.begin, file_size, letter.TransferId or str(uuid4()), letter.Resume, letter.SourceModified, offset, length)
+            fd = await self.run_disk(partial.open_for_write)
+            if letter.Extents is not None:
+                ranges, holes = split_sparse(ranges, letter.Extents)
+                if holes:
+                    await self.run_disk(partial.commit_ranges, holes)
+            await self.run_disk(preallocate, fd, ranges)
+            self.server.admission_control.allocated(self.admission)
+        except OSError as e:
+            await self.reject(str(e))
+            if self.verbose:
+                print("[{}] Failed to open destination path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        l = ConfirmationLetter()
+        if ranged:
+            l.Offset = offset
+            l.Length = length
+        l.Ranges = ranges
+        if letter.Extents is not None:
+            l.Sparse = True
+        if digest is not None:
+            l.Digest = digest
+        await self.send_letter(l)
+        if self.verbose:
+            print("[{}] Destination file opened. Confirmation sent. Starting data transfer of {} bytes out of {} requested ... ".format(self.uuid, sum(r[1] for r in ranges), length))
+        chunks = []
+        verified = None
+        commits = VerifiedCommits(partial) if digest is not None else partial
+        try:
+            complete = await self.receive_ranges(fd, commits, ranges, digest, chunks)
+            if complete and not ranges and not self.shutdown:
+                await self.run_disk(commits.commit, offset, 0)
+            if complete and digest is not None and not self.shutdown:
+                verified = await self.verify_received(fd, chunks, digest, commits)
+        finally:
+            await self.run_disk(os.close, fd)
+        if self.shutdown:
+            if self.verbose:
+                print("[{}] Connection lost. Partial file kept at {}".format(self.uuid, partial.partial_path))
+            return
+        if digest is not None:
+            # verification already answered the client
+            if self.verbose:
+                if verified:
+                    print("[{}] File saved. Verification passed with {} chunk-list digest {}.".format(self.uuid, digest, verified))
+                else:
+                    print("[{}] Verification failed. Partial file kept at {}".format(self.uuid, partial.partial_path))
+            return
+        if self.verbose:
+            print("[{}] File saved. Sending confirmation to client.".format(self.uuid))
+        await self.send_letter(ConfirmationLetter())
+
+    async def handle_stream_upload(self, letter):
+        # see TpftServerConnection.handle_stream_upload. A frame is written on
+        # the disk pool while the next one comes off the socket
+        streamed = StreamedFile(letter.DestinationPath, self.server.durability, self.server.sync_interval)
+        try:
+            fd = await self.run_disk(streamed.open_for_write)
+        except OSError as e:
+            await self.reject(str(e))
+            if self.verbose:
+                print("[{}] Failed to open destination path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        def write(buff):
+            write_all(fd, buff)
+            streamed.written(fd, len(buff))
+
+        l = ConfirmationLetter()
+        l.Stream = True
+        await self.send_letter(l)
+        pending = None
+        error = None
+        try:
+            while True:
+                buff = await self.receive()
+                if self.shutdown or not buff:
+                    break
+                self.metrics.moved(len(buff))
+                self.transferred = self.transferred + len(buff)
+                if pending is not None:
+                    started = time.perf_counter()
+                    try:
+                        await pending
+                    except OSError as e:
+                        error = error or str(e)
+                    self.metrics.disk_write += time.perf_counter() - started
+                    pending = None
+                if error is None:
+                    pending = self.run_disk(write, buff)
+            if pending is not None:
+                try:
+                    await pending
+                except OSError as e:
+                    error = error or str(e)
+            if not self.shutdown:
+                # the confirmation behind the stream, it only carries a digest that was never asked for
+                await self.receive()
+            if error is None and not self.shutdown:
+                try:
+                    await self.run_disk(streamed.finish, fd)
+                except OSError as e:
+                    error = str(e)
+        finally:
+            await self.run_disk(os.close, fd)
+        if error is not None or self.shutdown:
+            await self.run_disk(streamed.abandon)
+            if self.verbose:
+                print("[{}] Stream dropped: {}".format(self.uuid, error or 'Connection lost'))
+            if not self.shutdown:
+                await self.reject(error)
+            return
+        if self.verbose:
+            print("[{}] Stream of {} bytes saved. Sending confirmation to client.".format(self.uuid, self.transferred))
+        await self.send_letter(ConfirmationLetter())
+
+    async def handle_stream_download(self, letter):
+        # see TpftServerConnection.handle_stream_download, the next chunk is
+        # read on the disk pool while the current one is sent
+        try:
+            fd = await self.run_disk(os.open, letter.DownloadPath, os.O_RDONLY)
+        except OSError as e:
+            await self.reject(str(e))
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        pending = None
+        try:
+            l = DownloadConfirmationLetter()
+            l.Stream = True
+            await self.send_letter(l)
+            msg = await self.receive()
+            if self.shutdown or not isinstance(self.decode_letter(msg).letter, ConfirmationLetter):
+                if self.verbose:
+                    print("[{}] Client rejected file.".format(self.uuid))
+                return
+            chunk_size = min(max(letter.ChunkSize or self.chunk_size, 1), MAX_CHUNK_SIZE)
+            pending = self.run_disk(os.read, fd, chunk_size)
+            while not self.shutdown:
+                started = time.perf_counter()
+                buff = await pending
+                self.metrics.disk_read += time.perf_counter() - started
+                pending = None
+                if not buff:
+                    break
+                pending = self.run_disk(os.read, fd, chunk_size)
+                await self.throttle(len(buff))
+                await self.transmit(buff)
+                self.metrics.moved(len(buff))
+                self.transferred = self.transferred + len(buff)
+            if self.shutdown:
+                return
+            await self.transmit(b'')
+            await self.send_letter(ConfirmationLetter())
+            await self.receive()
+            if self.verbose:
+                print("[{}] Stream of {} bytes completed.".format(self.uuid, self.transferred))
+        finally:
+            if pending is not None:
+                with contextlib.suppress(OSError):
+                    await pending
+            await self.run_disk(os.close, fd)
+
+    async def handle_download(self, letter):
+        if letter.Stream:
+            await self.handle_stream_download(letter)
+            return
+        download_path, offset, length = letter.DownloadPath, letter.Offset, letter.Length
+        entry = None
+        try:
+            if self.file_cache is not None and not letter.Follow:
+                entry = await self.run_disk(self.file_cache.acquire, download_path)
+            if entry is None:
+                fd = await self.run_disk(os.open, download_path, os.O_RDONLY)
+        except OSError as e:
+            await self.reject(str(e))
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        try:
+            if entry is None:
+                stat = await self.run_disk(os.fstat, fd)
+                file_size, modified = stat.st_size, stat.st_mtime_ns
+                read = lambda length, offset: os.pread(fd, length, offset)
+            else:
+                file_size, modified = entry.size, entry.modified
+                # copied out on the pool, so page faults never stall the event loop
+                read = lambda length, offset: bytes(entry.view[offset:offset + length])
+            ranged = offset is not None
+            offset, length = resolve_window(file_size, offset, length)
+            if await self.serve_range(fd if entry is None else entry.file_o.fileno(), read, letter, offset, length, file_size, modified, ranged) and letter.Follow:
+                await self.follow_download(fd, read, letter, offset + length)
+        finally:
+            if entry is not None:
+                self.file_cache.release(entry)
+            else:
+                await self.run_disk(os.close, fd)
+
+    async def serve_range(self, fd, read, letter, offset, length, file_size, modified, ranged):
+        # offers offset and length of an open download and sends them once the
+        # client accepts, returns whether the client confirmed what it got
+        ranges = [(offset, length)]
+        if letter.Sparse:
+            ranges = await self.run_disk(data_extents, fd, offset, length)
+
+        self.metrics.size = (self.metrics.size or 0) + sum(size for start, size in ranges)
+        l = DownloadConfirmationLetter()
+        l.FileSize = file_size
+        l.Modified = modified
+        if ranged:
+            l.Offset = offset
+            l.Length = length
+        if ranges != [(offset, length)]:
+            l.Extents = ranges
+        digest = letter.Digest if letter.Digest in SUPPORTED_DIGESTS else None
+        if digest is not None:
+            l.Digest = digest
+        if letter.Follow:
+            l.Follow = True
+        await self.send_letter(l)
+
+        msg = await self.receive()
+        if self.shutdown:
+            return False
+        if not isinstance(self.decode_letter(msg).letter, ConfirmationLetter):
+            if self.verbose:
+                print("[{}] Client rejected file.".format(self.uuid))
+            return False
+        if self.verbose:
+            print("[{}] Client accepted file. Starting transfer of {} bytes at offset {} ... ".format(self.uuid, length, offset))
+        chunk_size = min(max(letter.ChunkSize or self.chunk_size, 1), MAX_CHUNK_SIZE)
+        digests = await self.send_ranges(read, ranges, chunk_size, digest)
+        if digest is not None and not self.shutdown:
+            envelope = await self.serve_retransmits(read, ranges, chunk_size, digest, digests)
+            confirmed = envelope is not None and isinstance(envelope.letter, ConfirmationLetter)
+        else:
+            msg = await self.receive()
+            confirmed = not self.shutdown and isinstance(self.decode_letter(msg).letter, ConfirmationLetter)
+        if not self.shutdown and not confirmed and self.verbose:
+            print("[{}] Client rejected binary transfer.".format(self.uuid))
+        if self.verbose:
+            print("[{}] Transfer completed.".format(self.uuid))
+        return confirmed
+
+    async def follow_download(self, fd, read, letter, end):
+        # see TpftServerConnection.follow_download. A pending receive stands in
+        # for polling the socket, it is cancelled before anything is sent
+        async def leave():
+            # a follower only speaks up to leave
+            await self.receive()
+
+        if self.admission is not None:
+            self.server.admission_control.release(self.admission)
+            self.admission = None
+            self.server.admission_changes()
+        if self.verbose:
+            print("[{}] Following {} from offset {}".format(self.uuid, letter.DownloadPath, end))
+        leaving = asyncio.ensure_future(leave())
+        try:
+            while not self.shutdown:
+                await asyncio.wait((leaving, ), timeout=FOLLOW_POLL_INTERVAL)
+                if leaving.done():
+                    self.shutdown = True
+                    break
+                stat = await self.run_disk(os.fstat, fd)
+                if stat.st_size == end:
+                    continue
+                leaving.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await leaving
+                if not leaving.cancelled():
+                    self.shutdown = True
+                    break
+                if stat.st_size < end:
+                    await self.reject('File {} was truncated while followed'.format(letter.DownloadPath))
+                    break
+                if not await self.serve_range(fd, read, letter, end, stat.st_size - end, stat.st_size, stat.st_mtime_ns, True):
+                    break
+                end = stat.st_size
+                leaving = asyncio.ensure_future(leave())
+        finally:
+            leaving.cancel()
+        if self.verbose:
+            print("[{}] Stopped following {} at offset {}".format(self.uuid, letter.DownloadPath, end))
+
+    async def receive_batch(self, root, directories, files):
+        # see TpftConnection.receive_batch. Each frame is handed to the disk
+        # pool, which writes it into the files it covers and renames the ones it
+        # completes into place, while the next frame comes off the socket
+        failed = []
+        synced_directories = set()
+        durability = self.server.durability
+        # the file being written, its bytes written so far and [path, descriptor] once opened
+        index, written, current = 0, 0, None
+
+        def prepare():
+            for relative, mode in directories:
+                try:
+                    path = tree_path(root, relative)
+                    os.makedirs(path, exist_ok=True)
+                    os.chmod(path, mode | 0o700)
+                except (OSError, ValueError) as e:
+                    failed.append([relative, str(e)])
+
+        def store(view):
+            # also completes the files of size 0 that follow the data
+            nonlocal index, written, current
+            while index < len(files):
+                relative, size, modified, mode = files[index]
+                if current is None:
+                    current = [None, None]
+                    try:
+                        current[0] = tree_path(root, relative)
+                        os.makedirs(os.path.dirname(current[0]), exist_ok=True)
+                        current[1] = os.open(current[0] + PARTIAL_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                        if size >= RANGE_ALIGNMENT:
+                            preallocate(current[1], [(0, size)])
+                    except (OSError, ValueError) as e:
+                        failed.append([relative, str(e)])
+                path, fd = current
+                piece = view[:size - written]
+                if fd is not None and len(piece) > 0:
+                    try:
+                        pwrite_all(fd, piece, written)
+                    except OSError as e:
+                        # the rest of the file is still taken off the frames
+                        failed.append([relative, str(e)])
+                        os.close(fd)
+                        current[1] = fd = None
+                        with contextlib.suppress(OSError):
+                            os.unlink(path + PARTIAL_SUFFIX)
+                written = written + len(piece)
+                view = view[len(piece):]
+                if written < size:
+                    return
+                if fd is not None:
+                    try:
+                        os.fchmod(fd, mode)
+                        if durability != DURABILITY_NONE:
+                            os.fsync(fd)
+                        os.close(fd)
+                        current[1] = None
+                        os.utime(path + PARTIAL_SUFFIX, ns=(modified, modified))
+                        os.replace(path + PARTIAL_SUFFIX, path)
+                        if durability != DURABILITY_NONE:
+                            synced_directories.add(os.path.dirname(path))
+                    except OSError as e:
+                        failed.append([relative, str(e)])
+                    finally:
+                        if current[1] is not None:
+                            os.close(current[1])
+                index, written, current = index + 1, 0, None
+
+        def abandon():
+            if current is not None and current[1] is not None:
+                os.close(current[1])
+
+        def finish():
+            for directory in synced_directories:
+                with contextlib.suppress(OSError):
+                    sync_directory(directory)
+
+        await self.run_disk(prepare)
+        pending = self.run_disk(store, memoryview(b''))
+        remaining = sum(entry[1] for entry in files)
+        try:
+            while remaining > 0:
+                buff = await self.receive()
+                if self.shutdown:
+                    return None
+                self.metrics.moved(len(buff))
+                remaining = remaining - len(buff)
+                self.transferred = self.transferred + len(buff)
+                started = time.perf_counter()
+                await pending
+                self.metrics.disk_write += time.perf_counter() - started
+                pending = self.run_disk(store, memoryview(buff))
+            started = time.perf_counter()
+            await pending
+            pending = None
+            await self.run_disk(finish)
+            self.metrics.disk_write += time.perf_counter() - started
+        finally:
+            if pending is not None:
+                with contextlib.suppress(OSError):
+                    await pending
+            if self.shutdown:
+                await self.run_disk(abandon)
+        return failed
+
+    async def send_batch(self, files):
+        # see TpftConnection.send_batch, the next frame is read on the disk pool while the current one is sent
+        failed = []
+        frames = batch_frames(files, self.chunk_size, failed)
+        pending = self.run_disk(next, frames, None)
+        try:
+            while True:
+                started = time.perf_counter()
+                frame = await pending
+                self.metrics.disk_read += time.perf_counter() - started
+                pending = None
+                if frame is None:
+                    break
+                pending = self.run_disk(next, frames, None)
+                await self.throttle(len(frame))
+                await self.transmit(frame)
+                self.metrics.moved(len(frame))
+                self.transferred = self.transferred + len(frame)
+                if self.shutdown:
+                    break
+        finally:
+            if pending is not None:
+                with contextlib.suppress(OSError):
+                    await pending
+            await self.run_disk(frames.close)
+        return failed
+
+    async def admit_batch(self, letter, size, space):
+        # see TpftServerConnection.admit_batch. The batch waits in line
+        # quietly on admission_changed, for ADMISSION_BATCH_WAIT at most
+        control = self.server.admission_control
+        ticket = 0
+        deadline = time.monotonic() + ADMISSION_BATCH_WAIT
+        reason = 'Server busy, try again later'
+        try:
+            while True:
+                changed = self.server.admission_changed
+                try:
+                    admission = await self.run_disk(control.admit, size, ticket, letter.DestinationPath, space)
+                except OSError as e:
+                    reason = str(e)
+                    break
+                if admission.admitted:
+                    self.admission = admission
+                    return True
+                ticket = admission.ticket
+                if time.monotonic() >= deadline:
+                    break
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(changed.wait(), deadline - time.monotonic())
+        finally:
+            if ticket:
+                control.withdraw(ticket)
+                self.server.admission_changes()
+        remaining = size
+        while remaining > 0 and not self.shutdown:
+            remaining = remaining - len(await self.receive())
+        if not self.shutdown:
+            await self.reject(reason)
+        if self.verbose:
+            print("[{}] Batch turned away: {}".format(self.uuid, reason))
+        return False
+
+    async def handle_file_batch(self, letter):
+        failed = await self.receive_batch(letter.DestinationPath, letter.Directories, letter.Files)
+        if failed is None:
+            if self.verbose:
+                print("[{}] Connection lost. File batch discarded.".format(self.uuid))
+            return
+        if self.verbose:
+            print("[{}] Saved batch of {} directories and {} files, {} failed. Sending confirmation to client.".format(self.uuid, len(letter.Directories), len(letter.Files), len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        await self.send_letter(l)
+
+    async def handle_tree_download(self, letter):
+        # see TpftServerConnection.handle_tree_download, the tree is listed on the disk pool
+        download_path = letter.DownloadPath
+        try:
+            await self.run_disk(os.stat, download_path)
+        except OSError as e:
+            await self.reject(str(e))
+            if self.verbose:
+                print("[{}] Failed to open download path: {} - Sending reject.".format(self.uuid, str(e)))
+            return
+
+        failed = []
+        file_count = 0
+        if letter.Paths is None:
+            batches = batch_tree([download_path], failed)
+        else:
+            root, name = os.path.split(os.path.normpath(download_path))
+            paths = []
+            for relative in letter.Paths:
+                if relative.split('/', 1)[0] == name:
+                    paths.append((root, relative))
+                else:
+                    failed.append([relative, 'Refusing path outside of the download path'])
+            batches = batch_entries(listed_entries(paths, failed))
+        while True:
+            batch = await self.run_disk(next, batches, None)
+            if batch is None:
+                break
+            directories, files = batch
+            l = FileBatchLetter()
+            l.Directories = directories
+            l.Files = [entry[:4] for entry in files]
+            await self.send_letter(l)
+            failed.extend(await self.send_batch(files))
+            if self.shutdown:
+                if self.verbose:
+                    print("[{}] Connection lost during tree download.".format(self.uuid))
+                return
+            file_count = file_count + len(files)
+        if self.verbose:
+            print("[{}] Sent {} files, {} failed.".format(self.uuid, file_count, len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        await self.send_letter(l)
+
+    async def handle_manifest(self, letter):
+        # see TpftServerConnection.handle_manifest, listing and hashing run on the disk pool
+        if letter.Path is None:
+            await self.reject('Manifest request without a path')
+            return
+
+        algorithm = letter.Algorithm if letter.Algorithm in SUPPORTED_DIGESTS else None
+        failed = []
+        directory_count, file_count = 0, 0
+        batches = manifest_batches(letter.Path, algorithm, failed)
+        while True:
+            batch = await self.run_disk(next, batches, None)
+            if batch is None:
+                break
+            directories, files = batch
+            l = ManifestLetter()
+            l.Algorithm = algorithm
+            l.Directories = directories
+            l.Files = files
+            await self.send_letter(l)
+            if self.shutdown:
+                await self.run_disk(batches.close)
+                return
+            directory_count, file_count = directory_count + len(directories), file_count + len(files)
+        if self.verbose:
+            print("[{}] Listed {} directories and {} files, {} failed.".format(self.uuid, directory_count, file_count, len(failed)))
+        l = ConfirmationLetter()
+        l.Failed = failed
+        await self.send_letter(l)
+
+    async def handle_stats(self):
+        l = StatsLetter()
+        l.Fields = TRANSFER_METRICS_FIELDS
+        if self.server.workers is not None:
+            l.Transfers = await self.run_disk(self.server.workers.rows)
+        else:
+            l.Transfers = self.server.transfer_registry.rows()
+        await self.send_letter(l)
+
+    async def handle_message(self, msg):
+        letter = msg.letter
+        try:
+            if isinstance(letter, ConnectionCloseLetter):
+                self.shutdown = True
+            elif isinstance(letter, UploadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested upload of file {} of size {}".format(self.uuid, letter.DestinationPath, letter.FileSize))
+                if await self.admit(letter, *await self.run_disk(upload_needs, letter), letter.DestinationPath):
+                    self.begin_metrics('upload', letter.DestinationPath, letter.FileSize)
+                    await self.handle_upload(letter)
+            elif isinstance(letter, DownloadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested download of file {}".format(self.uuid, letter.DownloadPath))
+                if await self.admit(letter, await self.run_disk(download_size, letter)):
+                    self.begin_metrics('download', letter.DownloadPath)
+                    await self.handle_download(letter)
+            elif isinstance(letter, FileBatchLetter):
+                if self.verbose:
+                    print("[{}] Requested upload of {} files into {}".format(self.uuid, len(letter.Files), letter.DestinationPath))
+                if await self.admit_batch(letter, *await self.run_disk(batch_needs, letter)):
+                    self.begin_metrics('tree-upload', letter.DestinationPath, sum(entry[1] for entry in letter.Files))
+                    await self.handle_file_batch(letter)
+            elif isinstance(letter, TreeDownloadRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested download of tree {}".format(self.uuid, letter.DownloadPath))
+                if await self.admit(letter, 0):
+                    self.begin_metrics('tree-download', letter.DownloadPath)
+                    await self.handle_tree_download(letter)
+            elif isinstance(letter, ManifestRequestLetter):
+                if self.verbose:
+                    print("[{}] Requested manifest of {}".format(self.uuid, letter.Path))
+                await self.handle_manifest(letter)
+            elif isinstance(letter, StatsRequestLetter):
+                await self.handle_stats()
+            elif isinstance(letter, LimitsLetter):
+                await self.send_letter(await self.run_disk(limits_reply, self.server.bandwidth_shaper, letter, self.writer.get_extra_info('peername')[0], self.server.workers))
+            else:
+                if self.verbose:
+                    print("[{}] Unhandleable letter received {}".format(self.uuid, letter.__class__))
+        finally:
+            self.end_metrics()
+            if self.admission is not None:
+                self.server.admission_control.release(self.admission)
+                self.admission = None
+                self.server.admission_changes()
+
+    async def admit(self, letter, size, space = 0, path = None):
+        # see TpftServerConnection.admit. Waiting requests wake on
+        # admission_changed, and as with a followed download a pending receive
+        # stands in for polling the socket. It is stopped after each attempt,
+        # before anything else reads or writes
+        async def leave():
+            await self.receive()
+
+        control = self.server.admission_control
+        ticket = 0 if letter.Queue else None
+        noticed = None
+        leaving = None
+        try:
+            while True:
+                changed = self.server.admission_changed
+                try:
+                    admission = await self.run_disk(control.admit, size, ticket, path, space)
+                except OSError as e:
+                    admission = e
+                if leaving is not None:
+                    leaving.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await leaving
+                    if not leaving.cancelled():
+                        if isinstance(admission, Admission) and admission.admitted:
+                            control.release(admission)
+                        break
+                    leaving = None
+                if isinstance(admission, OSError):
+                    self.server.admission_changes()
+                    await self.reject(str(admission))
+                    if self.verbose:
+                        print("[{}] Request turned away: {}".format(self.uuid, str(admission)))
+                    return False
+                if admission.admitted:
+                    self.admission = admission
+                    if ticket:
+                        # the next in line may fit as well
+                        self.server.admission_changes()
+                    return True
+                if admission.ticket is None:
+                    await self.reject('Server busy, try again later')
+                    if self.verbose:
+                        print("[{}] Server busy ({}), request turned away".format(self.uuid, control))
+                    return False
+                ticket = admission.ticket
+                if noticed is None or time.monotonic() - noticed >= ADMISSION_NOTICE_INTERVAL:
+                    noticed = time.monotonic()
+                    l = BusyLetter()
+                    l.Position = admission.position
+                    await self.send_letter(l)
+                    if self.verbose:
+                        print("[{}] Server busy ({}), request waits at position {}".format(self.uuid, control, admission.position))
+                leaving = asyncio.ensure_future(leave())
+                waiter = asyncio.ensure_future(changed.wait())
+                await asyncio.wait((leaving, waiter), timeout=ADMISSION_NOTICE_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            # a waiting client only speaks up to leave
+            self.shutdown = True
+            return False
+        finally:
+            if leaving is not None:
+                leaving.cancel()
+            # an admitted request has left the line already
+            if ticket:
+                control.withdraw(ticket)
+                self.server.admission_changes()
+
+    async def run(self):
+        self.writer.write(bytes((SC_OK, )))
+        status = await self.reader.readexactly(1)
+        if status[0] != SC_OK:
+            raise TinyProtoError('Initialisation error: {0}'.format(status))
+        while not self.shutdown:
+            msg = await self.receive()
+            if self.shutdown:
+                break
+            await self.handle_message(self.decode_letter(msg))
+
+class AsyncTpftServer:
+    __slots__ = ('listen_host', 'listen_port', 'verbose', 'display_progress', 'chunk_size', 'file_cache', 'transfer_registry', 'bandwidth_shaper', 'admission_control', 'admission_changed', 'durability', 'sync_interval', 'disk_pool', 'connections', 'workers')
+
+    def __init__(self, listen_host, listen_port):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.verbose = False
+        self.display_progress = False
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.file_cache = None
+        self.transfer_registry = TransferRegistry()
+        self.bandwidth_shaper = BandwidthShaper()
+        self.admission_control = AdmissionControl()
+        # set and replaced whenever a request may have been let in
+        self.admission_changed = asyncio.Event()
+        self.durability = DURABILITY_NONE
+        self.sync_interval = 0
+        # every blocking file operation of every connection goes through this pool
+        self.disk_pool = ThreadPoolExecutor(max_workers=ASYNC_DISK_WORKERS)
+        self.connections = {}
+        self.workers = None
+
+    async def handle_connection(self, reader, writer):
+        conn_id = uuid4()
+        peername = writer.get_extra_info('peername')
+        if self.verbose:
+            print('[SRV] Opened connection from {}'.format(peername))
+        connection = AsyncTpftServerConnection(reader, writer, self, conn_id)
+        self.connections[conn_id] = connection
+        try:
+            await connection.run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print('[{}] Connection failed: {}'.format(conn_id, e))
+        finally:
+            del self.connections[conn_id]
+            self.bandwidth_shaper.detach(connection.shaper)
+            writer.close()
+            if self.verbose:
+                print('[SRV] Connection closed from {}'.format(peername))
+                if self.file_cache is not None:
+                    print('[SRV] File cache: {}'.format(self.file_cache))
+
+    def admission_changes(self):
+        self.admission_changed.set()
+        self.admission_changed = asyncio.Event()
+
+    async def show_progress(self):
+        while True:
+            await asyncio.sleep(1)
+            self.transfer_registry.print_progress()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection, self.listen_host, self.listen_port, limit=ASYNC_STREAM_LIMIT, backlog=ASYNC_LISTEN_BACKLOG, reuse_address=True, reuse_port=self.workers is not None)
+        if self.display_progress:
+            progress = asyncio.ensure_future(self.show_progress())
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.disk_pool.shutdown()
+
+class WorkerGroup:
+    # the server processes a supervisor started on one port. Each worker
+    # answers its siblings on a unix socket in directory with its transfers
+    # and limits, so stats and limit changes reach every worker whichever one
+    # a client connected to. Server wide limits are split into a share for
+    # each worker. A worker exits once the supervisor is gone
+    __slots__ = ('directory', 'count', 'index', 'lifeline', 'transfer_registry', 'bandwidth_shaper', 'global_limit', 'listener')
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+        self.index = None
+        # the supervisor holds the write end, the workers see end of file when it dies
+        self.lifeline = os.pipe()
+        self.transfer_registry = None
+        self.bandwidth_shaper = None
+        # the server wide rate limit, the shaper of the worker runs with its share
+        self.global_limit = 0
+        self.listener = None
+
+    def path(self, index):
+        return os.path.join(self.directory, 'worker-{}'.format(index))
+
+    def join(self, index):
+        # runs in the forked worker
+        self.index = index
+        os.close(self.lifeline[1])
+        threading.Thread(target=self.watch_supervisor, daemon=True).start()
+
+    def watch_supervisor(self):
+        while os.read(self.lifeline[0], 1):
+            pass
+        os._exit(1)
+
+    def share(self, limit):
+        # the part of a server wide limit this worker enforces, the shares add up to limit
+        if limit == 0:
+            return 0
+        return max(1, limit // self.count + (1 if self.index < limit % self.count else 0))
+
+    def apply_limits(self, global_limit = None, client_limit = None, connection_limit = None):
+        if global_limit is not None:
+            self.global_limit = global_limit
+            global_limit = self.share(global_limit)
+        self.bandwidth_shaper.set_limits(global_limit, client_limit, connection_limit)
+
+    def limits(self):
+        shaper = self.bandwidth_shaper
+        return [self.global_limit, shaper.client_limit, shaper.connection_limit]
+
+    def serve(self, transfer_registry, bandwidth_shaper):
+        # bandwidth_shaper comes with the server wide limits
+        self.transfer_registry = transfer_registry
+        self.bandwidth_shaper = bandwidth_shaper
+        self.apply_limits(bandwidth_shaper.global_limit)
+        # a replaced worker takes up the limits its siblings run with
+        for answer in self.ask({}):
+            self.apply_limits(*answer['limits'])
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path(self.index))
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path(self.index))
+        self.listener.listen()
+        threading.Thread(target=self.answer_siblings, daemon=True).start()
+
+    def answer_siblings(self):
+        while True:
+            sibling, address = self.listener.accept()
+            with sibling:
+                sibling.settimeout(WORKER_QUERY_TIMEOUT)
+                try:
+                    request = json.loads(read_to_end(sibling))
+                    if 'limits' in request:
+                        self.apply_limits(*request['limits'])
+                    sibling.sendall(json.dumps({
+                        'transfers': self.transfer_registry.rows(),
+                        'limits': self.limits(),
+                    }).encode())
+                except (OSError, ValueError):
+                    pass
+
+    def ask(self, request):
+        # returns the answers of the other workers, one being replaced is left out
+        answers = []
+        for index in range(self.count):
+            if index == self.index:
+                continue
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sibling:
+                    sibling.settimeout(WORKER_QUERY_TIMEOUT)
+                    sibling.connect(self.path(index))
+                    sibling.sendall(json.dumps(request).encode())
+                    sibling.shutdown(socket.SHUT_WR)
+                    answers.append(json.loads(read_to_end(sibling)))
+            except (OSError, ValueError):
+                pass
+        return answers
+
+    def rows(self):
+        return self.transfer_registry.rows() + [row for answer in self.ask({}) for row in answer['transfers']]
+
+    def set_limits(self, global_limit = None, client_limit = None, connection_limit = None):
+        self.ask({'limits': [global_limit, client_limit, connection_limit]})
+
+
+class TpftClientUploadConnection(TpftConnection):
+    __slots__ = ('source_file_descriptor', 'source_file_size', 'destination_path', 'offset', 'length', 'transfer_id', 'resume', 'delta', 'stream', 'literal_bytes', 'ready_for_upload', 'transfer_size', 'rejection', 'on_complete', 'future', 'closing')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_for_upload = False
+        self.stream = False
+        self.transfer_size = None
+        self.literal_bytes = None
+        self.rejection = None
+        # set by a session, the connection then stays open and reports each finished transfer here
+        self.on_complete = None
+        self.future = None
+        self.closing = False
+
+    def upload_file(self, source_file, source_file_size, destination_path, offset = None, length = None, transfer_id = None, resume = False, delta = False):
+        self.source_file_descriptor = source_file
+        self.source_file_size = source_file_size
+        self.destination_path = destination_path
+        self.offset = offset
+        self.length = length
+        self.transfer_id = transfer_id or str(uuid4())
+        self.resume = resume
+        self.delta = delta and offset is None and not resume
+        self.stream = False
+        self.transfer_size = source_file_size if offset is None else length
+        self.transferred = 0
+        self.literal_bytes = None
+        self.rejection = None
+        self.integrity_failure = None
+        self.ready_for_upload = True
+
+    def upload_stream(self, source_fd, destination_path):
+        # source_fd is read until it ends, its size is never known
+        self.source_file_descriptor = source_fd
+        self.source_file_size = None
+        self.destination_path = destination_path
+        self.offset = None
+        self.length = None
+        self.transfer_id = None
+        self.resume = False
+        self.delta = False
+        self.stream = True
+        self.transfer_size = None
+        self.transferred = 0
+        self.literal_bytes = None
+        self.rejection = None
+        self.integrity_failure = None
+        self.ready_for_upload = True
+
+    def request_upload(self):
+        l = UploadRequestLetter()
+        l.FileSize = self.source_file_size
+        l.DestinationPath = self.destination_path
+        if self.offset is not None:
+            l.Offset = self.offset
+            l.Length = self.length
+        l.TransferId = self.transfer_id
+        l.Resume = self.resume
+        l.SourceModified = os.fstat(self.source_file_descriptor.fileno()).st_mtime_ns
+        if self.digest is not None:
+            l.Digest = self.digest
+        l.Delta = self.delta
+        if self.delta and self.digest is not None:
+            l.DeltaDigest = True
+        if self.compression is not None:
+            l.Compression = self.compression
+        if not self.delta:
+            offset = self.offset or 0
+            length = self.source_file_size - offset if self.offset is None else self.length
+            extents = data_extents(self.source_file_descriptor.fileno(), offset, length)
+            if extents != [(offset, length)]:
+                l.Extents = extents
+        return self.request(l)
+
+    def upload_confirmed(self):
+        envelope = self.receive_letter()
+        if isinstance(envelope.letter, ConfirmationLetter):
+            return True
+        else:
+            return False
+
+    def upload_binary(self, ranges, digest = None, compression = None):
+        self.transfer_size = sum(length for offset, length in ranges)
+        self.transferred = 0
+        return self.send_ranges(self.source_file_descriptor, ranges, None, digest, compression, self.compression_level)
+
+    def upload_delta(self, block_size, block_count, digest = None):
+        # returns the digest of the whole source when one is asked for, it is
+        # taken while the source is read for matching
+        signature = self.receive()
+        weak_table = {}
+        for index in range(block_count):
+            weak, strong = SIGNATURE_ENTRY.unpack_from(signature, index * SIGNATURE_ENTRY.size)
+            weak_table.setdefault(weak, {}).setdefault(strong, index)
+
+        fd = self.source_file_descriptor.fileno()
+        batch_blocks = max(1, DELTA_BATCH_SIZE // block_size)
+
+        def match_batch(first_block):
+            # block-aligned matching: the strong hash is only computed for weak hits
+            data = memoryview(os.pread(fd, batch_blocks * block_size, first_block * block_size))
+            matches = []
+            for o in range(0, len(data), block_size):
+                block = data[o:o + block_size]
+                candidates = weak_table.get(zlib.adler32(block))
+                if candidates is not None:
+                    candidates = candidates.get(hashlib.blake2b(block, digest_size=16).digest())
+                matches.append(candidates)
+            return data, matches
+
+        frame = bytearray()
+        run_first, run_count = None, 0
+        # literal bytes are copied out of their batch, which is released once walked
+        literal = bytearray()
+        self.literal_bytes = 0
+
+        def flush_literal():
+            nonlocal frame
+            if len(literal) > 0:
+                frame += DELTA_LITERAL.pack(DELTA_OP_LITERAL, len(literal))
+                frame += literal
+                self.literal_bytes += len(literal)
+                literal.clear()
+
+        def flush_run():
+            nonlocal frame, run_first, run_count
+            if run_count > 0:
+                frame += DELTA_COPY.pack(DELTA_OP_COPY, run_first, run_count)
+            run_first, run_count = None, 0
+
+        hasher = hashlib.new(digest) if digest is not None else None
+        block_total = -(-self.source_file_size // block_size)
+        pending = deque()
+
+        def batches(pool):
+            # reading stays a bounded window of batches ahead of the socket
+            for first_block in range(0, block_total, batch_blocks):
+                pending.append(pool.submit(match_batch, first_block))
+                if len(pending) > DELTA_WORKERS:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        with ThreadPoolExecutor(max_workers=DELTA_WORKERS) as pool:
+            new_index = 0
+            for data, matches in batches(pool):
+                if hasher is not None:
+                    hasher.update(data)
+                for position, old_index in enumerate(matches):
+                    offset = new_index * block_size
+                    length = min(block_size, self.source_file_size - offset)
+                    if old_index is not None:
+                        flush_literal()
+                        if run_count > 0 and run_first + run_count == old_index:
+                            run_count += 1
+                        else:
+                            flush_run()
+                            run_first, run_count = old_index, 1
+                    else:
+                        flush_run()
+                        literal += data[position * block_size:position * block_size + length]
+                        if len(literal) >= self.chunk_size:
+                            flush_literal()
+                    if len(frame) >= self.chunk_size:
+                        self.transmit_chunk(frame)
+                        frame = bytearray()
+                    new_index += 1
+                    self.transferred = self.transferred + length
+                data = None
+        flush_literal()
+        flush_run()
+        if len(frame) > 0:
+            self.transmit_chunk(frame)
+        return hasher.hexdigest() if hasher is not None else None
+
+    def upload_verified(self, ranges, digest, digests):
+        envelope = self.serve_retransmits(self.source_file_descriptor, ranges, None, digest, digests)
+        if isinstance(envelope.letter, RejectionLetter):
+            self.integrity_failure = envelope.letter.Reason
+        elif not isinstance(envelope.letter, ConfirmationLetter) or envelope.letter.TransferDigest != transfer_digest(digest, digests):
+            self.integrity_failure = 'Remote chunk-list digest does not match the source'
+
+    def run_upload(self):
+        msg = self.request_upload()
+
+        if isinstance(msg.letter, ConfirmationLetter):
+            if self.offset is not None and msg.letter.Offset is None:
+                print('Remote server does not support multi-stream uploads')
+            elif self.delta and msg.letter.BlockSize is not None:
+                digest = msg.letter.Digest if self.digest is not None else None
+                if self.digest is not None and digest is None:
+                    print('Remote server does not support verification of delta uploads, data is sent unverified')
+                if self.compression is not None:
+                    print('Delta uploads do not support compression, data is sent uncompressed')
+                source_digest = self.upload_delta(msg.letter.BlockSize, msg.letter.BlockCount, digest)
+                if digest is not None:
+                    l = ConfirmationLetter()
+                    l.TransferDigest = source_digest
+                    self.send_letter(l)
+                envelope = self.receive_letter()
+                if isinstance(envelope.letter, RejectionLetter):
+                    self.integrity_failure = envelope.letter.Reason
+                elif digest is not None and envelope.letter.TransferDigest != source_digest:
+                    self.integrity_failure = 'Rebuilt file does not match the source'
+            else:
+                ranges = msg.letter.Ranges
+                if ranges is None:
+                    ranges = [(self.offset or 0, self.transfer_size)]
+                digest = msg.letter.Digest if self.digest is not None else None
+                if self.digest is not None and digest is None:
+                    print('Remote server does not support verification, data is sent unverified')
+                compression = msg.letter.Compression if self.compression is not None else None
+                if self.compression is not None and compression is None:
+                    print('Remote server does not support compression, data is sent uncompressed')
+                digests = self.upload_binary(ranges, digest, compression)
+                if digest is not None:
+                    self.upload_verified(ranges, digest, digests)
+                else:
+                    msg = self.upload_confirmed()
+        elif isinstance(msg.letter, RejectionLetter):
+            self.rejection = msg.letter.Reason
+            print(msg.letter.Reason)
+
+    def run_stream_upload(self):
+        l = UploadRequestLetter()
+        l.DestinationPath = self.destination_path
+        l.Stream = True
+        if self.digest is not None:
+            l.Digest = self.digest
+        msg = self.request(l)
+
+        digest = None
+        if isinstance(msg.letter, ConfirmationLetter):
+            if not msg.letter.Stream:
+                print('Remote server does not support streaming')
+                return
+            digest = msg.letter.Digest if self.digest is not None else None
+            if self.digest is not None and digest is None:
+                print('Remote server does not support verification, data is sent unverified')
+            self.send_stream(self.source_file_descriptor, None, digest)
+            if self.shutdown:
+                return
+            msg = self.receive_letter()
+        if isinstance(msg.letter, RejectionLetter):
+            self.rejection = msg.letter.Reason
+            if digest is not None:
+                self.integrity_failure = msg.letter.Reason
+            print(msg.letter.Reason)
+
+    def loop_pass(self):
+        self.clear_wakeup()
+        if self.closing:
+            self.send_letter(ConnectionCloseLetter())
+            self.shutdown = True
+        while self.ready_for_upload:
+            self.begin_metrics('upload', self.destination_path, self.transfer_size)
+            if self.stream:
+                self.run_stream_upload()
+            else:
+                self.run_upload()
+            self.end_metrics()
+            if self.on_complete is None:
+                self.send_letter(ConnectionCloseLetter())
+                time.sleep(0.1)
+                self.shutdown = True
+                return
+            # the session may hand this connection its next transfer right away
+            self.ready_for_upload = False
+            self.on_complete(self)
+
+    def pre_loop(self):
+        self.socket_o.settimeout(90)
+        # a session runs many small request and answer exchanges, none of them should wait on Nagle
+        self.socket_o.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.enable_wakeup()
+
+    def post_loop(self):
+        self.close_wakeup()
+
+class TpftClientDownloadConnection(TpftConnection):
+    __slots__ = ('partial', 'remote_path', 'ranges', 'transfer_id', 'base', 'window', 'follow', 'output', 'ready_for_download', 'probe_only', 'remote_file_size', 'remote_modified', 'transfer_size', 'rejection', 'on_complete', 'future', 'closing')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_for_download = False
+        self.output = None
+        self.probe_only = False
+        self.remote_file_size = None
+        self.remote_modified = None
+        self.transfer_size = None
+        self.rejection = None
+        self.on_complete = None
+        self.future = None
+        self.closing = False
+
+    def download_file(self, remote_path, partial, ranges = None, transfer_id = None, base = 0, window = None, follow = False, output = None):
+        # ranges and window are positions in the remote file, base of it is
+        # the start of the local file. Without ranges, window is requested as
+        # (offset, length) and its resolved offset becomes the base. follow
+        # keeps appending what is added to the remote file until stop
+        self.partial = partial
+        self.remote_path = remote_path
+        self.ranges = ranges
+        self.transfer_id = transfer_id or str(uuid4())
+        self.base = base
+        self.window = window
+        self.follow = follow
+        self.output = output
+        self.transfer_size = None if ranges is None else sum(length for offset, length in ranges)
+        self.transferred = 0
+        self.probe_only = False
+        self.remote_file_size = None
+        self.remote_modified = None
+        self.rejection = None
+        self.integrity_failure = None
+        self.ready_for_download = True
+
+    def download_stream(self, remote_path, output):
+        # the remote file is read until it ends and written to the output fd
+        # as it arrives, front to back, so output can be a pipe
+        self.download_file(remote_path, None, output = output)
+
+    def probe_file(self, remote_path):
+        self.download_file(remote_path, None)
+        self.probe_only = True
+
+    def stop(self):
+        # ends a followed download from another thread
+        self.closing = True
+        self.wake()
+
+    def request_download(self, offset = None, length = None):
+        l = DownloadRequestLetter()
+        l.DownloadPath = self.remote_path
+        if offset is not None:
+            l.Offset = offset
+            if length is not None:
+                l.Length = length
+        l.ChunkSize = self.chunk_size
+        l.Sparse = True
+        if self.follow:
+            l.Follow = True
+        if self.output is not None:
+            l.Stream = True
+        if self.digest is not None:
+            l.Digest = self.digest
+        if self.compression is not None:
+            l.Compression = self.compression
+            if self.compression_level is not None:
+                l.CompressionLevel = self.compression_level
+        return self.request(l)
+
+    def download_binary(self, offset, length, digest = None, compression = None, extents = None):
+        # also answers the server with the final confirmation. offset and
+        # extents are positions in the remote file
+        fd = self.partial.open_for_write()
+        try:
+            ranges = [(offset - self.base, length)]
+            if extents is not None:
+                extents = [(start - self.base, size) for start, size in extents]
+                # holes are never sent, the partial file has them zeroed from the start
+                ranges, holes = split_sparse(ranges, extents)
+                if holes:
+                    self.partial.commit_ranges(holes)
+            preallocate(fd, ranges)
+            chunks = []
+            commits = VerifiedCommits(self.partial) if digest is not None else self.partial
+            complete = self.receive_ranges(fd, commits, ranges, digest, chunks, compression)
+            if not complete or self.shutdown:
+                return
+            if length == 0:
+                # an empty file or window, nothing was received that would have completed it
+                commits.commit(0, 0)
+            if digest is None:
+                self.confirm_download()
+            elif self.verify_received(fd, chunks, digest, commits) is None:
+                self.integrity_failure = 'Downloaded data failed verification'
+        finally:
+            os.close(fd)
+
+    def downloaded_digest(self, letter):
+        if self.digest is None:
+            return None
+        if letter.Digest is None:
+            print('Remote server does not support verification, data is received unverified')
+        return letter.Digest
+
+    def downloaded_compression(self, letter):
+        if self.compression is None:
+            return None
+        if letter.Compression is None:
+            print('Remote server does not support compression, data is received uncompressed')
+        return letter.Compression
+
+    def accept_download(self):
+        self.send_letter(ConfirmationLetter())
+
+    def reject_download(self):
+        self.send_letter(RejectionLetter())
+
+    def confirm_download(self):
+        self.send_letter(ConfirmationLetter())
+
+    def download_whole_file(self):
+        msg = self.request_download(*self.window) if self.window is not None else self.request_download()
+        if isinstance(msg.letter, DownloadConfirmationLetter):
+            self.remote_file_size = msg.letter.FileSize
+            self.remote_modified = msg.letter.Modified
+            if self.probe_only:
+                self.reject_download()
+                return
+            if self.window is not None and msg.letter.Offset is None:
+                print('Remote server does not support ranged downloads')
+                self.reject_download()
+                return
+            if self.follow and not msg.letter.Follow:
+                print('Remote server does not support following, the download ends with the current file')
+                self.follow = False
+            if self.window is not None:
+                offset, length = msg.letter.Offset, msg.letter.Length
+            else:
+                offset, length = 0, self.remote_file_size
+            self.base = offset
+            self.partial.begin(length, self.transfer_id, False, self.remote_modified, 0, length)
+            self.transfer_size = length if msg.letter.Extents is None else sum(size for start, size in msg.letter.Extents)
+            self.metrics.size = self.transfer_size
+            self.accept_download()
+            digest, compression = self.downloaded_digest(msg.letter), self.downloaded_compression(msg.letter)
+            self.download_binary(offset, length, digest, compression, msg.letter.Extents)
+            if self.follow and not self.shutdown and self.integrity_failure is None:
+                self.follow_file(digest, compression)
+        elif isinstance(msg.letter, RejectionLetter):
+            self.rejection = msg.letter.Reason
+            print(msg.letter.Reason)
+
+    def follow_file(self, digest, compression):
+        # the first range is in place, every range the server appends is
+        # written straight into the local file until stop is called
+        self.partial = FollowedFile(self.partial.path, self.durability)
+        try:
+            while not self.shutdown:
+                events = self._selector.select()
+                self.clear_wakeup()
+                if self.closing:
+                    return
+                if not any(key.fileobj is self.socket_o for key, mask in events):
+                    continue
+                msg = self.receive()
+                if self.shutdown:
+                    return
+                envelope = self.decode_letter(msg)
+                if isinstance(envelope.letter, DownloadConfirmationLetter):
+                    self.remote_file_size = envelope.letter.FileSize
+                    self.remote_modified = envelope.letter.Modified
+                    self.transfer_size = self.transfer_size + envelope.letter.Length
+                    self.metrics.size = self.transfer_size
+                    self.accept_download()
+                    self.download_binary(envelope.letter.Offset, envelope.letter.Length, digest, compression, envelope.letter.Extents)
+                    if self.integrity_failure is not None:
+                        return
+                else:
+                    if isinstance(envelope.letter, RejectionLetter):
+                        self.rejection = envelope.letter.Reason
+                        print(envelope.letter.Reason)
+                    return
+        except TinyProtoError:
+            # the server went away, what arrived so far is kept
+            self.shutdown = True
+
+    def stream_file(self):
+        msg = self.request_download()
+        if isinstance(msg.letter, DownloadConfirmationLetter):
+            if not msg.letter.Stream:
+                print('Remote server does not support streaming')
+                self.reject_download()
+                return
+            digest, compression = self.downloaded_digest(msg.letter), self.downloaded_compression(msg.letter)
+            self.accept_download()
+            # a reader of the output that went away ends the download, there is no point in the rest
+            error = self.receive_stream(self.output, digest, drain=False)
+            if error is None:
+                self.confirm_download()
+            elif not self.shutdown:
+                self.integrity_failure = error
+                self.reject_download()
+            elif error != 'Connection lost':
+                print(error)
+        elif isinstance(msg.letter, RejectionLetter):
+            self.rejection = msg.letter.Reason
+            print(msg.letter.Reason)
+
+    def download_ranges(self):
+        for offset, length in self.ranges:
+            msg = self.request_download(offset, length)
+            if isinstance(msg.letter, DownloadConfirmationLetter):
+                if msg.letter.Offset is None:
+                    print('Remote server does not support ranged downloads')
+                    self.reject_download()
+                    return
+                self.accept_download()
+                self.download_binary(msg.letter.Offset, msg.letter.Length, self.downloaded_digest(msg.letter), self.downloaded_compression(msg.letter), msg.letter.Extents)
+                if self.shutdown or self.integrity_failure is not None:
+                    return
+            elif isinstance(msg.letter, RejectionLetter):
+                self.rejection = msg.letter.Reason
+                print(msg.letter.Reason)
+                return
+
+    def loop_pass(self):
+        self.clear_wakeup()
+        if self.closing:
+            self.send_letter(ConnectionCloseLetter())
+            self.shutdown = True
+        while self.ready_for_download:
+            self.begin_metrics('download', self.remote_path, self.transfer_size)
+            if self.output is not None:
+                self.stream_file()
+            elif self.ranges is None:
+                self.download_whole_file()
+            else:
+                self.download_ranges()
+            self.end_metrics()
+
+            if self.on_complete is None:
+                if not self.shutdown:
+                    self.send_letter(ConnectionCloseLetter())
+                    time.sleep(0.1)
+                self.shutdown = True
+                return
+            self.ready_for_download = False
+            self.on_complete(self)
+
+    def pre_loop(self):
+        self.socket_o.settimeout(90)
+        self.socket_o.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.enable_wakeup()
+
+    def post_loop(self):
+        self.close_wakeup()
+
+class TpftClientTreeUploadConnection(TpftConnection):
+    __slots__ = ('batches', 'destination_path', 'failed', 'file_count', 'ready_for_upload', 'transfer_size')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_for_upload = False
+        self.transfer_size = None
+        self.file_count = 0
+
+    def upload_tree(self, batches, destination_path, failed):
+        self.batches = batches
+        self.destination_path = destination_path
+        self.failed = failed
+        self.transfer_size = sum(entry[1] for directories, files in batches for entry in files)
+        self.transferred = 0
+        self.ready_for_upload = True
+
+    def loop_pass(self):
+        if self.ready_for_upload:
+            self.begin_metrics('tree-upload', self.destination_path, self.transfer_size)
+            for directories, files in self.batches:
+                l = FileBatchLetter()
+                l.DestinationPath = self.destination_path
+                l.Directories = directories
+                l.Files = [entry[:4] for entry in files]
+                self.send_letter(l)
+                self.failed.extend(self.send_batch(files))
+                if self.shutdown:
+                    break
+                msg = self.receive_letter()
+                if isinstance(msg.letter, ConfirmationLetter):
+                    self.failed.extend(msg.letter.Failed)
+                    self.file_count = self.file_count + len(files)
+                else:
+                    if isinstance(msg.letter, RejectionLetter):
+                        print(msg.letter.Reason)
+                    break
+            self.end_metrics()
+
+            if not self.shutdown:
+                self.send_letter(ConnectionCloseLetter())
+                time.sleep(0.1)
+            self.shutdown = True
+
+    def pre_loop(self):
+        self.socket_o.settimeout(90)
+
+class TpftClientTreeDownloadConnection(TpftConnection):
+    __slots__ = ('remote_path', 'destination_path', 'paths', 'failed', 'file_count', 'ready_for_download', 'transfer_size')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_for_download = False
+        self.transfer_size = None
+        self.file_count = 0
+
+    def download_tree(self, remote_path, destination_path, paths = None):
+        # paths limits the download to the listed entries of the tree
+        self.remote_path = remote_path
+        self.destination_path = destination_path
+        self.paths = paths
+        self.failed = []
+        self.transferred = 0
+        self.ready_for_download = True
+
+    def loop_pass(self):
+        if self.ready_for_download:
+            l = TreeDownloadRequestLetter()
+            l.DownloadPath = self.remote_path
+            if self.paths is not None:
+                l.Paths = self.paths
+            envelope = self.request(l)
+            self.begin_metrics('tree-download', self.remote_path)
+
+            while not self.shutdown:
+                if isinstance(envelope.letter, FileBatchLetter):
+                    # the total is not known up front, it grows batch by batch
+                    self.transfer_size = (self.transfer_size or 0) + sum(entry[1] for entry in envelope.letter.Files)
+                    failed = self.receive_batch(self.destination_path, envelope.letter.Directories, envelope.letter.Files)
+                    if failed is None:
+                        break
+                    self.failed.extend(failed)
+                    self.file_count = self.file_count + len(envelope.letter.Files)
+                    msg = self.receive()
+                    if self.shutdown:
+                        break
+                    envelope = self.decode_letter(msg)
+                elif isinstance(envelope.letter, ConfirmationLetter):
+                    self.failed.extend(envelope.letter.Failed)
+                    break
+                else:
+                    if isinstance(envelope.letter, RejectionLetter):
+                        print(envelope.letter.Reason)
+                    break
+            self.end_metrics()
+
+            if not self.shutdown:
+                self.send_letter(ConnectionCloseLetter())
+                time.sleep(0.1)
+            self.shutdown = True
+
+    def pre_loop(self):
+        self.socket_o.settimeout(90)
+
+class TpftClientManifestConnection(TpftConnection):
+    # lists a remote tree, directories and files hold the manifest once the
+    # connection is no longer alive and complete is set
+    __slots__ = ('remote_path', 'algorithm', 'directories', 'files', 'failed', 'complete', 'ready_for_request')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_for_request = False
+        self.complete = False
+
+    def request_manifest(self, remote_path, algorithm = None):
+        self.remote_path = remote_path
+        self.algorithm = algorithm
+        self.directories = {}
+        self.files = {}
+        self.failed = []
+        self.complete = False
+        self.ready_for_request = True
+
+    @property
+    def manifest(self):
+        return self.directories, self.files
+
+    def loop_pass(self):
+        if self.ready_for_request:
+            l = ManifestRequestLetter()
+            l.Path = self.remote_path
+            l.Algorithm = self.algorithm
+            self.send_letter(l)
+
+            while True:
+                msg = self.receive()
+                if self.shutdown:
+                    break
+                envelope = self.decode_letter(msg)
+                if isinstance(envelope.letter, ManifestLetter):
+                    for relative, mode in envelope.letter.Directories:
+                        self.directories[relative] = mode
+                    for relative, size, modified, digest in envelope.letter.Files:
+                        self.files[relative] = [size, modified, digest]
+                elif isinstance(envelope.letter, ConfirmationLetter):
+                    self.failed.extend(envelope.letter.Failed)
+                    self.complete = True
+                    break
+                else:
+                    if isinstance(envelope.letter, RejectionLetter):
+                        print(envelope.letter.Reason)
+                    break
+
+            if not self.shutdown:
+                self.send_letter(ConnectionCloseLetter())
+                time.sleep(0.1)
+            self.shutdown = True
+
+    def pre_loop(self):
+        self.socket_o.settimeout(90)
+
+class TpftClientQueryConnection(TpftConnection):
+    # sends one letter to a server and keeps the letter that comes back
+    __slots__ = ('request', 'reply')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request = None
+        self.reply = None
+
+    def query(self, letter):
+        self.request = letter
+
+    def loop_pass(self):
+        if self.request is not None:
+            self.send_letter(self.request)
+            msg = self.receive_letter()
+            if isinstance(msg.letter, RejectionLetter):
+                print(msg.letter.Reason)
+            else:
+                self.reply = msg.letter
+
+            if not self.shutdown:
+                self.send_letter(ConnectionCloseLetter())
+                time.sleep(0.1)
+            self.shutdown = True
+
+    def pre_loop(self):
+        self.socket_o.settimeout(10)
+
+
+class TpftClient(TinyProtoClient):
+    __slots__ = ('chunk_size', 'queue_depth', 'digest', 'compression', 'compression_level', 'control', 'verbose', 'durability', 'sync_interval')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.queue_depth = 0
+        self.digest = None
+        self.compression = None
+        self.compression_level = None
+        self.control = CONTROL_BINARY
+        self.verbose = False
+        self.durability = DURABILITY_NONE
+        self.sync_interval = 0
+
+    def connect(self, connection_details, handler = None):
+        if handler is not None:
+            self.set_conn_handler(handler)
+        uuid = self.connect_to(connection_details)
         connection = self.active_connections[uuid]
-        connection.upload_file(local_path.filedescriptor, local_path.filesize, remote_path.path)
+        connection.chunk_size = self.chunk_size
+        connection.queue_depth = self.queue_depth
+        connection.digest = self.digest
+        connection.compression = self.compression
+        connection.compression_level = self.compression_level
+        connection.durability = self.durability
+        connection.sync_interval = self.sync_interval
+        if self.control == CONTROL_BINARY:
+            connection.control_offer = CONTROL_BINARY
+        return connection
 
-        while connection.is_alive():
+    def session(self, max_connections = DEFAULT_SESSION_CONNECTIONS):
+        return TpftSession(self, max_connections)
+
+    def wait_for_transfers(self, connections, progress):
+        while any(c.is_alive() for c in connections):
             if progress:
-                print('\rProgress: {}%'.format(connection.progress), end='')
+                total = sum(c.transfer_size or 0 for c in connections)
+                done = sum(c.transferred for c in connections)
+                # a stream has no size, how much of it moved is all there is to show
+                print('\rProgress: {}'.format('{}%'.format(int(done / total * 100)) if total else '{} bytes'.format(done)), end='')
             time.sleep(0.1)
         print()
+        if self.verbose:
+            for connection in connections:
+                if connection.pipeline_stats is not None:
+                    print('Pipeline stats: {}'.format(connection.pipeline_stats))
+                if connection.compression_stats is not None:
+                    print('Compression stats: {}'.format(connection.compression_stats))
+                if connection.metrics is not None:
+                    print('Transfer metrics: {}'.format(connection.metrics))
+                if getattr(connection, 'literal_bytes', None) is not None:
+                    print('Delta upload sent {} literal bytes'.format(connection.literal_bytes))
+        for connection in connections:
+            if connection.integrity_failure is not None:
+                raise IntegrityCheckFailedError(connection.integrity_failure)
+
+    def query(self, connection_details, letter):
+        connection = self.connect(connection_details, TpftClientQueryConnection)
+        connection.query(letter)
+        while connection.is_alive():
+            time.sleep(0.01)
+        return connection.reply
 
-    def download_file(self, remote_path, local_path, progress):
+    def request_stats(self, connection_details):
+        reply = self.query(connection_details, StatsRequestLetter())
+        if not isinstance(reply, StatsLetter):
+            return None
+        return [dict(zip(reply.Fields, row)) for row in reply.Transfers]
+
+    def set_limits(self, connection_details, global_limit = None, client_limit = None, connection_limit = None):
+        # None leaves a limit unchanged, returns the limits in effect afterwards
+        l = LimitsLetter()
+        for name, value in (('GlobalLimit', global_limit), ('ClientLimit', client_limit), ('ConnectionLimit', connection_limit)):
+            if value is not None:
+                setattr(l, name, value)
+        reply = self.query(connection_details, l)
+        if not isinstance(reply, LimitsLetter):
+            return None
+        return {'global': reply.GlobalLimit, 'client': reply.ClientLimit, 'connection': reply.ConnectionLimit}
+
+    def probe_file(self, connection_details, remote_path):
         self.set_conn_handler(TpftClientDownloadConnection)
+        connection = self.connect(connection_details)
+        connection.probe_file(remote_path)
+        while connection.is_alive():
+            time.sleep(0.01)
+        return connection.remote_file_size, connection.remote_modified
+
+    def upload_file(self, local_path, remote_path, progress, streams = 1, resume = False, delta = False):
+        self.set_conn_handler(TpftClientUploadConnection)
         if not isinstance(local_path, ParsedPath) or not isinstance(remote_path, ParsedPath):
             raise ValueError('Paths need to be instances of ParsedPath')
 
         connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
-        uuid = self.connect_to(connection_details)
-        connection = self.active_connections[uuid]
-        connection.download_file(remote_path.path, local_path.path)
+        groups = distribute_ranges([(0, local_path.filesize)], streams) if streams > 1 else []
+        ranges = [group[0] for group in groups] if len(groups) > 1 else [(None, None)]
+
+        transfer_id = str(uuid4())
+        connections = []
+        for offset, length in ranges:
+            connection = self.connect(connection_details)
+            connection.upload_file(local_path.filedescriptor, local_path.filesize, remote_path.path, offset, length, transfer_id, resume, delta)
+            connections.append(connection)
 
+        self.wait_for_transfers(connections, progress)
+
+    def upload_stream(self, source_fd, remote_path, progress):
+        self.set_conn_handler(TpftClientUploadConnection)
+        connection = self.connect(TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT))
+        connection.upload_stream(source_fd, remote_path.path)
+        self.wait_for_transfers([connection], progress)
+
+    def download_stream(self, remote_path, output, progress):
+        self.set_conn_handler(TpftClientDownloadConnection)
+        connection = self.connect(TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT))
+        connection.download_stream(remote_path.path, output)
+        self.wait_for_transfers([connection], progress)
+
+    def upload_tree(self, local_paths, remote_path, progress):
+        # every local path ends up inside the remote directory, under its own name
+        self.set_conn_handler(TpftClientTreeUploadConnection)
+        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
+        started = time.perf_counter()
+        failed = []
+        batches = list(batch_tree([local_path.path for local_path in local_paths], failed))
+        connection = self.connect(connection_details)
+        connection.upload_tree(batches, remote_path.path, failed)
+        self.wait_for_transfers([connection], progress)
+        self.report_tree([connection], time.perf_counter() - started)
+
+    def download_tree(self, remote_path, local_path, progress):
+        self.set_conn_handler(TpftClientTreeDownloadConnection)
+        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
+        started = time.perf_counter()
+        connection = self.connect(connection_details)
+        connection.download_tree(remote_path.path, local_path.path)
+        self.wait_for_transfers([connection], progress)
+        self.report_tree([connection], time.perf_counter() - started)
+
+    def fetch_manifest(self, connection_details, remote_path, algorithm = None):
+        # the manifest arrives in the background, it is ready once the returned connection is no longer alive
+        connection = self.connect(connection_details, TpftClientManifestConnection)
+        connection.request_manifest(remote_path, algorithm)
+        return connection
+
+    def wait_for_manifest(self, connection):
         while connection.is_alive():
-            if progress:
-                print('\rProgress: {}%'.format(connection.progress), end='')
-            time.sleep(0.1)
-        print()
+            time.sleep(0.01)
+        if not connection.complete:
+            print('Failed to list {}'.format(connection.remote_path))
+            return None
+        return connection.manifest
+
+    def sync_tree_upload(self, local_paths, remote_path, progress, workers = 1, algorithm = None):
+        # like upload_tree, but only files missing from the remote directory or
+        # differing from it are sent, spread over up to workers connections.
+        # Files are compared by digest when algorithm is set
+        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
+        started = time.perf_counter()
+        failed = []
+        entries = []
+        unchanged = 0
+        for local_path in local_paths:
+            path = os.path.abspath(local_path.path)
+            root, name = os.path.split(path)
+            listing = self.fetch_manifest(connection_details, os.path.join(remote_path.path, name), algorithm)
+            # the local tree is listed while the server lists its side
+            local = build_manifest(path, algorithm, failed)
+            remote = self.wait_for_manifest(listing)
+            if remote is None:
+                return
+            directories, files = diff_manifest(local, remote)
+            entries.extend((root, relative, 0) for relative in directories)
+            entries.extend((root, relative, local[1][relative][0]) for relative in files)
+            unchanged = unchanged + len(local[1]) - len(files)
+
+        self.set_conn_handler(TpftClientTreeUploadConnection)
+        connections = []
+        for group in distribute_entries(entries, workers):
+            batches = list(batch_entries(listed_entries(((root, relative) for root, relative, size in group), failed)))
+            connection = self.connect(connection_details)
+            connection.upload_tree(batches, remote_path.path, [])
+            connections.append(connection)
+        self.wait_for_transfers(connections, progress)
+        self.report_tree(connections, time.perf_counter() - started, failed, unchanged)
+
+    def sync_tree_download(self, remote_path, local_path, progress, workers = 1, algorithm = None):
+        # like download_tree, but only files missing from the local directory or
+        # differing from it are fetched, spread over up to workers connections.
+        # Files are compared by digest when algorithm is set
+        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
+        started = time.perf_counter()
+        listing = self.fetch_manifest(connection_details, remote_path.path, algorithm)
+        # entries missing locally are simply fetched, failures listing them do not matter
+        local = build_manifest(os.path.join(local_path.path, os.path.basename(os.path.normpath(remote_path.path))), algorithm, [])
+        remote = self.wait_for_manifest(listing)
+        if remote is None:
+            return
+        directories, files = diff_manifest(remote, local)
+        entries = [(relative, 0) for relative in directories] + [(relative, remote[1][relative][0]) for relative in files]
+
+        self.set_conn_handler(TpftClientTreeDownloadConnection)
+        connections = []
+        for group in distribute_entries(entries, workers):
+            connection = self.connect(connection_details)
+            connection.download_tree(remote_path.path, local_path.path, [relative for relative, size in group])
+            connections.append(connection)
+        self.wait_for_transfers(connections, progress)
+        self.report_tree(connections, time.perf_counter() - started, listing.failed, len(remote[1]) - len(files))
+
+    def report_tree(self, connections, elapsed, failed = (), unchanged = None):
+        # failed lists entries that could not be read before any connection started
+        for path, reason in list(failed) + [entry for connection in connections for entry in connection.failed]:
+            print('Failed to transfer {}: {}'.format(path, reason))
+        if self.verbose:
+            file_count = sum(connection.file_count for connection in connections)
+            transferred = sum(connection.transferred for connection in connections)
+            print('Transferred {} files, {} bytes in {:.2f}s ({:.0f} files/s)'.format(file_count, transferred, elapsed, file_count / elapsed if elapsed else 0))
+            if unchanged is not None:
+                print('Skipped {} unchanged files'.format(unchanged))
+
+    def download_file(self, remote_path, local_path, progress, streams = 1, resume = False, offset = None, length = None, follow = False):
+        # offset and length pick a window of the remote file that becomes the
+        # local file, a negative offset counts back from the end. follow keeps
+        # appending what is added to the remote file over a single connection,
+        # until interrupted
+        if not isinstance(local_path, ParsedPath) or not isinstance(remote_path, ParsedPath):
+            raise ValueError('Paths need to be instances of ParsedPath')
+
+        connection_details = TinyProtoConnectionDetails(remote_path.host, remote_path.port if remote_path.port is not None else DEFAULT_PORT)
+        partial = PartialFile(local_path.path, self.durability, self.sync_interval)
+        transfer_id = str(uuid4())
+        window = (offset or 0, length) if offset is not None or length is not None else None
+        base = 0
+        if (streams > 1 or resume) and not follow:
+            file_size, modified = self.probe_file(connection_details, remote_path.path)
+            if file_size is None:
+                return
+            base, size = resolve_window(file_size, *window) if window is not None else (0, file_size)
+            missing = partial.begin(size, transfer_id, resume, modified, 0, size)
+            if not missing:
+                partial.commit(0, 0)
+                return
+            groups = [[(start + base, count) for start, count in group] for group in distribute_ranges(missing, streams)]
+        else:
+            groups = [None]
+
+        self.set_conn_handler(TpftClientDownloadConnection)
+        connections = []
+        for ranges in groups:
+            connection = self.connect(connection_details)
+            connection.download_file(remote_path.path, partial, ranges, transfer_id, base, window, follow)
+            connections.append(connection)
+
+        try:
+            self.wait_for_transfers(connections, progress)
+        except KeyboardInterrupt:
+            if not follow:
+                raise
+            for connection in connections:
+                connection.stop()
+            self.wait_for_transfers(connections, False)
+
+class SessionPool:
+    __slots__ = ('connection_details', 'handler', 'idle', 'open_count', 'pending')
+
+    def __init__(self, connection_details, handler):
+        self.connection_details = connection_details
+        self.handler = handler
+        self.idle = []
+        # connections opened and not yet lost, idle or busy
+        self.open_count = 0
+        # (future, start) of requests waiting for a connection
+        self.pending = deque()
+
+class TpftSession:
+    # keeps connections open across transfers. Each request returns a Future
+    # resolving to the number of bytes moved, connections are pooled per
+    # host:port and direction, so up to max_connections requests to one host
+    # run at the same time
+    __slots__ = ('client', 'max_connections', 'pools', 'lock', 'closed')
+
+    def __init__(self, client = None, max_connections = DEFAULT_SESSION_CONNECTIONS):
+        self.client = client if client is not None else TpftClient()
+        self.max_connections = max(1, max_connections)
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def upload(self, local_path, remote_path, resume = False, delta = False):
+        local_path, remote_path = ParsedPath(local_path), ParsedPath(remote_path)
+        if local_path.is_remote or not remote_path.is_remote:
+            raise ValueError('Upload needs a local source and a remote destination')
+        if not local_path.fileexists:
+            raise LocalPathFileDoesNotExistError(local_path.path)
+        fd = local_path.filedescriptor
+        future = self.submit(remote_path, TpftClientUploadConnection, lambda c: c.upload_file(fd, local_path.filesize, remote_path.path, resume = resume, delta = delta))
+        future.add_done_callback(lambda f: fd.close())
+        return future
+
+    def download(self, remote_path, local_path):
+        remote_path, local_path = ParsedPath(remote_path), ParsedPath(local_path)
+        if local_path.is_remote or not remote_path.is_remote:
+            raise ValueError('Download needs a remote source and a local destination')
+        if local_path.filedescriptor is not None:
+            local_path.filedescriptor.close()
+        partial_file = PartialFile(local_path.path, self.client.durability, self.client.sync_interval)
+        return self.submit(remote_path, TpftClientDownloadConnection, lambda c: c.download_file(remote_path.path, partial_file))
+
+    def submit(self, remote_path, handler, start):
+        # start(connection) hands the transfer to an idle connection of the pool
+        port = remote_path.port if remote_path.port is not None else DEFAULT_PORT
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise SessionClosedError()
+            key = (remote_path.host, port, handler)
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = SessionPool(TinyProtoConnectionDetails(remote_path.host, port), handler)
+            pool.pending.append((future, start))
+        self.dispatch(pool)
+        return future
+
+    def dispatch(self, pool):
+        while True:
+            with self.lock:
+                if not pool.pending:
+                    return
+                connection = None
+                while pool.idle and connection is None:
+                    connection = pool.idle.pop()
+                    if connection.shutdown or not connection.is_alive():
+                        pool.open_count -= 1
+                        connection = None
+                if connection is None:
+                    if pool.open_count >= self.max_connections:
+                        return
+                    pool.open_count += 1
+
+            if connection is None:
+                # connecting happens outside the lock, transfers finishing meanwhile are not held up
+                connection = self.open(pool)
+                if connection is None:
+                    with self.lock:
+                        pool.open_count -= 1
+                        job = pool.pending.popleft() if pool.pending else None
+                    if job is not None and job[0].set_running_or_notify_cancel():
+                        job[0].set_exception(ConnectionError('Could not connect to {}:{}'.format(pool.connection_details.host, pool.connection_details.port)))
+                    continue
+
+            with self.lock:
+                job = pool.pending.popleft() if pool.pending else None
+                if job is None:
+                    pool.idle.append(connection)
+                    return
+            future, start = job
+            if future.set_running_or_notify_cancel():
+                connection.future = future
+                start(connection)
+                connection.wake()
+            else:
+                with self.lock:
+                    pool.idle.append(connection)
+
+    def open(self, pool):
+        with self.lock:
+            connection = self.client.connect(pool.connection_details, pool.handler)
+        connection.on_complete = lambda c: self.complete(pool, c)
+        while connection.peername_details is None and connection.is_alive():
+            time.sleep(0.01)
+        if not connection.is_alive():
+            return None
+        return connection
+
+    def complete(self, pool, connection):
+        # runs on the connection thread once a transfer is over
+        future, connection.future = connection.future, None
+        if connection.integrity_failure is not None:
+            error = IntegrityCheckFailedError(connection.integrity_failure)
+        elif connection.rejection is not None:
+            error = TransferRejectedError(connection.rejection)
+        elif connection.shutdown:
+            error = ConnectionError('Connection to {}:{} lost'.format(pool.connection_details.host, pool.connection_details.port))
+        else:
+            error = None
+        with self.lock:
+            if connection.shutdown:
+                pool.open_count -= 1
+            else:
+                pool.idle.append(connection)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(connection.transferred)
+        self.dispatch(pool)
+
+    def close(self):
+        # waits for every submitted request, then closes all pooled connections
+        with self.lock:
+            self.closed = True
+        while True:
+            with self.lock:
+                if all(not pool.pending and len(pool.idle) == pool.open_count for pool in self.pools.values()):
+                    connections = [connection for pool in self.pools.values() for connection in pool.idle]
+                    for pool in self.pools.values():
+                        pool.idle = []
+                        pool.open_count = 0
+                    break
+            time.sleep(0.01)
+        # the close letter goes out from the connection thread, between two polls of the socket
+        for connection in connections:
+            connection.closing = True
+            connection.wake()
+        for connection in connections:
+            while connection.is_alive():
+                time.sleep(0.01)
 
 
 class ParsedPath:
-    __slots__ = ('raw_path', 'path', 'directory', 'filename', 'filesize', 'filedescriptor', 'fileexists', 'is_remote', 'host', 'port')
+    __slots__ = ('raw_path', 'path', 'directory', 'filename', 'filesize', 'filedescriptor', 'fileexists', 'isdirectory', 'isstream', 'is_remote', 'host', 'port')
 
     def __init__(self, raw_path):
         self.raw_path = raw_path
@@ -434,6 +5419,8 @@ class ParsedPath:
         self.filename = None
         self.filesize = None
         self.filedescriptor = None
+        self.isdirectory = False
+        self.isstream = False
         self.is_remote = False
         self.host = None
         self.port = None
@@ -471,11 +5458,16 @@ class ParsedPath:
 
     def parse_local_path(self):
         self.path = self.raw_path
+        if self.path == STREAM_PATH:
+            self.fileexists = False
+            self.isstream = True
+            return
         self.filename = os.path.basename(self.path)
         self.directory = os.path.dirname(self.path)
 
         if not os.path.isfile(self.path):
             self.fileexists = False
+            self.isdirectory = os.path.isdir(self.path)
         else:
             self.fileexists = True
             self.filesize = os.path.getsize(self.path)
@@ -484,6 +5476,657 @@ class ParsedPath:
 
 
 
+def merge_ranges(ranges):
+    merged = []
+    for offset, length in sorted((offset, length) for offset, length in ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+        elif length > 0:
+            merged.append([offset, length])
+    return merged
+
+def subtract_ranges(ranges, taken):
+    missing = []
+    taken = merge_ranges(taken)
+    for offset, length in ranges:
+        end = offset + length
+        for taken_offset, taken_length in taken:
+            taken_end = taken_offset + taken_length
+            if taken_end <= offset or taken_offset >= end:
+                continue
+            if taken_offset > offset:
+                missing.append((offset, taken_offset - offset))
+            offset = max(offset, taken_end)
+        if offset < end:
+            missing.append((offset, end - offset))
+    return missing
+
+def data_extents(fd, offset, length):
+    # [offset, length] of the data within a byte range of fd, found with
+    # SEEK_DATA and SEEK_HOLE. Short holes are folded into the data around
+    # them, without hole reporting the whole range comes back as data
+    end = offset + length
+    extents = []
+    position = offset
+    try:
+        while position < end:
+            try:
+                start = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            if start >= end:
+                break
+            stop = min(os.lseek(fd, start, os.SEEK_HOLE), end)
+            previous = extents[-1][0] + extents[-1][1] if extents else offset
+            if start - previous < SPARSE_MIN_HOLE:
+                if extents:
+                    extents[-1][1] = stop - extents[-1][0]
+                else:
+                    extents.append([offset, stop - offset])
+            else:
+                extents.append([start, stop - start])
+            if len(extents) > SPARSE_MAX_EXTENTS:
+                return [(offset, length)]
+            position = stop
+    except (OSError, AttributeError):
+        return [(offset, length)]
+    if extents and end - extents[-1][0] - extents[-1][1] < SPARSE_MIN_HOLE:
+        extents[-1][1] = end - extents[-1][0]
+    return [(start, size) for start, size in extents]
+
+def read_available(fd, buffer, poller):
+    # fills buffer with what fd has ready. Only the first read waits, so data
+    # moves on as it is produced, and comes in chunks while it is produced
+    # faster than it is sent. Returns 0 once fd has ended
+    count = os.readv(fd, [buffer])
+    while 0 < count < len(buffer) and poller.poll(0):
+        more = os.readv(fd, [buffer[count:]])
+        if more == 0:
+            break
+        count = count + more
+    return count
+
+def write_all(fd, view):
+    # a pipe may take less than it is given
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+def pwrite_all(fd, view, offset):
+    # a write may take less than it is given, a nearly full disk for one
+    while len(view) > 0:
+        count = os.pwrite(fd, view, offset)
+        if count == 0:
+            raise OSError(errno.EIO, 'Write at offset {} made no progress'.format(offset))
+        view = view[count:]
+        offset = offset + count
+
+def pwritev_all(fd, buffers, offset):
+    # see pwrite_all, buffers written in full are dropped and the rest goes out again
+    buffers = list(buffers)
+    while buffers:
+        count = os.pwritev(fd, buffers, offset)
+        if count == 0:
+            raise OSError(errno.EIO, 'Write at offset {} made no progress'.format(offset))
+        offset = offset + count
+        done = 0
+        while done < len(buffers) and count >= len(buffers[done]):
+            count = count - len(buffers[done])
+            done = done + 1
+        buffers = buffers[done:]
+        if count > 0:
+            buffers[0] = memoryview(buffers[0])[count:]
+
+def read_to_end(sock):
+    chunks = []
+    chunk = sock.recv(64 * 1024)
+    while chunk:
+        chunks.append(chunk)
+        chunk = sock.recv(64 * 1024)
+    return b''.join(chunks)
+
+def preallocate(fd, ranges):
+    # reserves the blocks of ranges before they are written, so a file lands
+    # in few extents and a full disk shows up before the transfer starts
+    for offset, length in ranges:
+        try:
+            os.posix_fallocate(fd, offset, length)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+
+def sync_directory(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def split_sparse(ranges, extents):
+    # returns the parts of ranges covered by extents, and the holes in between
+    holes = subtract_ranges(ranges, extents)
+    return subtract_ranges(ranges, holes), holes
+
+def chunk_table(ranges, chunk_size):
+    return [(offset + count, min(chunk_size, length - count)) for offset, length in ranges for count in range(0, length, chunk_size)]
+
+def transfer_digest(algorithm, digests):
+    # a hash over the chunk digests in order, not a digest of the file itself
+    return hashlib.new(algorithm, b''.join(digests)).hexdigest()
+
+def encode_binary_value(value, out):
+    if value is None:
+        out.append(BINARY_NONE)
+    elif value is True:
+        out.append(BINARY_TRUE)
+    elif value is False:
+        out.append(BINARY_FALSE)
+    elif isinstance(value, int):
+        out.append(BINARY_INT)
+        out += BINARY_INT_VALUE.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out.append(BINARY_STR)
+        out += BINARY_LENGTH.pack(len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        encode_binary_list(value, out)
+    else:
+        raise ValueError('Cannot encode {} in a binary envelope'.format(type(value)))
+
+def encode_binary_list(value, out):
+    # struct and str.join do the per item work wherever the list allows it
+    count = len(value)
+    if count > 0:
+        if all(type(item) is int for item in value):
+            out.append(BINARY_INT_LIST)
+            out += BINARY_LENGTH.pack(count)
+            out += struct.pack('!{}q'.format(count), *value)
+            return
+        if all(type(item) is str for item in value):
+            data = '\0'.join(value).encode()
+            if data.count(0) == count - 1:
+                out.append(BINARY_STR_LIST)
+                out += BINARY_LENGTH.pack(count)
+                out += BINARY_LENGTH.pack(len(data))
+                out += data
+                return
+        if all(type(item) in (list, tuple) for item in value):
+            width = len(value[0])
+            if width > 0 and all(len(item) == width for item in value):
+                out.append(BINARY_TABLE)
+                out += BINARY_LENGTH.pack(count)
+                out += BINARY_LENGTH.pack(width)
+                for column in zip(*value):
+                    encode_binary_list(column, out)
+                return
+    out.append(BINARY_LIST)
+    out += BINARY_LENGTH.pack(count)
+    for item in value:
+        encode_binary_value(item, out)
+
+def decode_binary_value(payload, offset):
+    # returns the value and the offset just past it
+    tag = payload[offset]
+    offset = offset + 1
+    if tag == BINARY_INT:
+        return BINARY_INT_VALUE.unpack_from(payload, offset)[0], offset + BINARY_INT_VALUE.size
+    elif tag == BINARY_STR:
+        length = BINARY_LENGTH.unpack_from(payload, offset)[0]
+        offset = offset + BINARY_LENGTH.size
+        if offset + length > len(payload):
+            raise ValueError('String runs past the end of the envelope')
+        return bytes(payload[offset:offset + length]).decode(), offset + length
+    elif tag == BINARY_INT_LIST:
+        count = BINARY_LENGTH.unpack_from(payload, offset)[0]
+        offset = offset + BINARY_LENGTH.size
+        return list(struct.unpack_from('!{}q'.format(count), payload, offset)), offset + count * BINARY_INT_VALUE.size
+    elif tag == BINARY_STR_LIST:
+        count, length = struct.unpack_from('!II', payload, offset)
+        offset = offset + 2 * BINARY_LENGTH.size
+        if offset + length > len(payload):
+            raise ValueError('String list runs past the end of the envelope')
+        items = bytes(payload[offset:offset + length]).decode().split('\0')
+        if len(items) != count:
+            raise ValueError('String list holds {} items instead of {}'.format(len(items), count))
+        return items, offset + length
+    elif tag == BINARY_TABLE:
+        count, width = struct.unpack_from('!II', payload, offset)
+        offset = offset + 2 * BINARY_LENGTH.size
+        columns = []
+        for x in range(width):
+            column, offset = decode_binary_value(payload, offset)
+            if len(column) != count:
+                raise ValueError('Table column holds {} items instead of {}'.format(len(column), count))
+            columns.append(column)
+        return [list(row) for row in zip(*columns)], offset
+    elif tag == BINARY_LIST:
+        count = BINARY_LENGTH.unpack_from(payload, offset)[0]
+        offset = offset + BINARY_LENGTH.size
+        items = []
+        for x in range(count):
+            item, offset = decode_binary_value(payload, offset)
+            items.append(item)
+        return items, offset
+    elif tag == BINARY_NONE:
+        return None, offset
+    elif tag == BINARY_TRUE:
+        return True, offset
+    elif tag == BINARY_FALSE:
+        return False, offset
+    raise ValueError('Unknown binary value tag {}'.format(tag))
+
+def compress_chunk(algorithm, data, level = None):
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[algorithm]
+    if algorithm == 'zlib':
+        return zlib.compress(data, level)
+    elif algorithm == 'lzma':
+        return lzma.compress(data, preset=level)
+    elif algorithm == 'bz2':
+        return bz2.compress(data, level)
+    raise ValueError('Unsupported compression {}'.format(algorithm))
+
+def decompress_chunk(algorithm, data, size):
+    # never inflates past size, a hostile peer cannot make us allocate more than a chunk
+    if algorithm == 'zlib':
+        decompressor = zlib.decompressobj()
+    elif algorithm == 'lzma':
+        decompressor = lzma.LZMADecompressor()
+    elif algorithm == 'bz2':
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        raise ValueError('Unsupported compression {}'.format(algorithm))
+    return decompressor.decompress(data, size)
+
+def delta_block_size(file_size):
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size < DELTA_MAX_BLOCK_SIZE and block_size * DELTA_TARGET_BLOCK_COUNT < file_size:
+        block_size = block_size * 2
+    return block_size
+
+def block_signature(fd, file_size, block_size):
+    # yields packed SIGNATURE_ENTRY batches in file order. Batches are hashed
+    # in parallel, zlib and hashlib release the GIL on buffers this large
+    batch_blocks = max(1, DELTA_BATCH_SIZE // block_size)
+
+    def sign_batch(first_block):
+        data = memoryview(os.pread(fd, batch_blocks * block_size, first_block * block_size))
+        return b''.join(
+            SIGNATURE_ENTRY.pack(zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest())
+            for block in (data[o:o + block_size] for o in range(0, len(data), block_size))
+        )
+
+    block_count = -(-file_size // block_size)
+    with ThreadPoolExecutor(max_workers=DELTA_WORKERS) as pool:
+        yield from pool.map(sign_batch, range(0, block_count, batch_blocks))
+
+def copy_file_range(source_fd, destination_fd, source_offset, destination_offset, length):
+    while length > 0:
+        if hasattr(os, 'copy_file_range'):
+            copied = os.copy_file_range(source_fd, destination_fd, length, source_offset, destination_offset)
+        else:
+            copied = os.pwrite(destination_fd, os.pread(source_fd, min(length, DELTA_BATCH_SIZE), source_offset), destination_offset)
+        if copied == 0:
+            raise EOFError('Basis file ended {} bytes early'.format(length))
+        source_offset += copied
+        destination_offset += copied
+        length -= copied
+
+def walk_tree(path, failed):
+    # yields (local path, relative path, stat result) for path and, when it is
+    # a directory, everything below it. Directories come before their content,
+    # symlinks to directories and special files are skipped. Entries that
+    # cannot be read are appended to failed as [relative path, reason]
+    path = os.path.normpath(path)
+    base = os.path.basename(path)
+    pending = [(path, base)]
+    while pending:
+        local_path, relative = pending.pop()
+        try:
+            st = os.stat(local_path)
+            if relative:
+                yield local_path, relative, st
+            if S_ISDIR(st.st_mode):
+                with os.scandir(local_path) as it:
+                    entries = sorted(it, key=lambda entry: entry.name, reverse=True)
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) or entry.is_file():
+                        pending.append((entry.path, relative + '/' + entry.name if relative else entry.name))
+        except OSError as e:
+            failed.append([relative or path, str(e)])
+
+def batch_tree(paths, failed):
+    return batch_entries(entry for path in paths for entry in walk_tree(path, failed))
+
+def batch_entries(entries):
+    # groups walk_tree style entries into (directories, files) batches,
+    # files are [relative path, size, modified, mode, local path]
+    directories, files, size = [], [], 0
+    for local_path, relative, st in entries:
+        if S_ISDIR(st.st_mode):
+            directories.append([relative, st.st_mode & 0o7777])
+        elif S_ISREG(st.st_mode):
+            files.append([relative, st.st_size, st.st_mtime_ns, st.st_mode & 0o7777, local_path])
+            size = size + st.st_size
+        if len(directories) + len(files) >= BATCH_MAX_FILES or size >= BATCH_MAX_BYTES:
+            yield directories, files
+            directories, files, size = [], [], 0
+    if directories or files:
+        yield directories, files
+
+def batch_frames(files, chunk_size, failed):
+    # yields the content of a batch_entries batch as frames of chunk_size,
+    # like TpftConnection.send_batch streams it. Files that changed since they
+    # were listed are cut or zero padded to the listed size
+    frame = bytearray()
+    for relative, size, modified, mode, local_path in files:
+        try:
+            file_o = open(local_path, 'rb')
+        except OSError as e:
+            failed.append([relative, str(e)])
+            file_o = None
+        with file_o or contextlib.nullcontext():
+            sent = 0
+            while sent < size:
+                count = min(chunk_size - len(frame), size - sent)
+                data = os.pread(file_o.fileno(), count, sent) if file_o is not None else b''
+                if len(data) < count:
+                    if file_o is not None and (not failed or failed[-1][0] != relative):
+                        failed.append([relative, 'File changed size during transfer'])
+                    data = data + bytes(count - len(data))
+                frame += data
+                sent = sent + count
+                if len(frame) >= chunk_size:
+                    yield frame
+                    frame = bytearray()
+    if len(frame) > 0:
+        yield frame
+
+def listed_entries(paths, failed):
+    # yields walk_tree style entries for (root, relative path) pairs picked
+    # from a manifest, entries that are gone are appended to failed
+    for root, relative in paths:
+        try:
+            local_path = tree_path(root, relative)
+            yield local_path, relative, os.stat(local_path)
+        except (OSError, ValueError) as e:
+            failed.append([relative, str(e)])
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb', buffering=0) as file_o:
+        if os.fstat(file_o.fileno()).st_size < MANIFEST_HASH_BLOCK:
+            digest.update(file_o.read())
+            return digest.hexdigest()
+        buffer = bytearray(MANIFEST_HASH_BLOCK)
+        view = memoryview(buffer)
+        while True:
+            count = file_o.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+class ManifestCache:
+    # digests of one tree kept between runs. A file is hashed again when its
+    # size, inode, modification or change time moved since it was cached, the
+    # change time also catches writes that restored the modification time
+    __slots__ = ('path', 'entries', 'changed')
+
+    def __init__(self, root, algorithm, directory = MANIFEST_CACHE_DIR):
+        key = hashlib.sha256('{}\0{}'.format(os.path.abspath(root), algorithm).encode()).hexdigest()
+        self.path = os.path.join(directory, key + '.json')
+        # relative path: [size, modified, changed, inode, hex digest]
+        self.entries = {}
+        self.changed = False
+        with contextlib.suppress(OSError, ValueError):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, relative, st):
+        entry = self.entries.get(relative)
+        if entry is not None and entry[:4] == [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]:
+            return entry[4]
+        return None
+
+    def store(self, relative, st, digest):
+        self.entries[relative] = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, digest]
+        self.changed = True
+
+    def save(self, relatives):
+        # entries of files no longer listed are dropped, the cache is replaced
+        # in one rename so a concurrent run reads either version
+        if len(self.entries) != len(relatives):
+            self.entries = {relative: entry for relative, entry in self.entries.items() if relative in relatives}
+            self.changed = True
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.json', dir=directory)
+        except OSError:
+            # without a cache the next run hashes everything again
+            return
+        try:
+            with open(fd, 'w') as f:
+                json.dump(self.entries, f, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+            self.changed = False
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+
+def manifest_batches(path, algorithm, failed):
+    # lists path like walk_tree in (directories, files) batches of up to
+    # MANIFEST_BATCH_ENTRIES entries, directories are [relative path, mode]
+    # and files [relative path, size, modified, hex digest]. The digest is
+    # only computed with an algorithm and comes from the ManifestCache of path
+    # when the file did not change
+    cache = ManifestCache(path, algorithm) if algorithm is not None else None
+    listed = set()
+
+    def complete(files, stats):
+        if cache is None:
+            return files
+        pending = []
+        unreadable = set()
+        for entry, (local_path, st) in zip(files, stats):
+            entry[3] = cache.lookup(entry[0], st)
+            if entry[3] is not None:
+                continue
+            # hashing releases the GIL on large buffers only, small files are not worth a thread
+            if st.st_size >= MANIFEST_HASH_BLOCK:
+                pending.append((entry, st, pool.submit(file_digest, local_path, algorithm)))
+                continue
+            try:
+                entry[3] = file_digest(local_path, algorithm)
+            except OSError as e:
+                failed.append([entry[0], str(e)])
+                unreadable.add(entry[0])
+                continue
+            cache.store(entry[0], st, entry[3])
+        for entry, st, future in pending:
+            try:
+                entry[3] = future.result()
+            except OSError as e:
+                failed.append([entry[0], str(e)])
+                unreadable.add(entry[0])
+                continue
+            cache.store(entry[0], st, entry[3])
+        listed.update(entry[0] for entry in files if entry[0] not in unreadable)
+        return [entry for entry in files if entry[0] not in unreadable] if unreadable else files
+
+    with ThreadPoolExecutor(MANIFEST_HASH_WORKERS) if cache is not None else contextlib.nullcontext() as pool:
+        directories, files, stats = [], [], []
+        for local_path, relative, st in walk_tree(path, failed):
+            if S_ISDIR(st.st_mode):
+                directories.append([relative, st.st_mode & 0o7777])
+            elif S_ISREG(st.st_mode):
+                files.append([relative, st.st_size, st.st_mtime_ns, None])
+                if cache is not None:
+                    stats.append((local_path, st))
+            if len(directories) + len(files) >= MANIFEST_BATCH_ENTRIES:
+                yield directories, complete(files, stats)
+                directories, files, stats = [], [], []
+        if directories or files:
+            yield directories, complete(files, stats)
+    if cache is not None:
+        cache.save(listed)
+
+def build_manifest(path, algorithm, failed):
+    # the whole manifest_batches listing as (directories, files) dictionaries
+    # keyed by relative path, directories map to their mode and files to
+    # [size, modified, hex digest]
+    directories, files = {}, {}
+    for batch_directories, batch_files in manifest_batches(path, algorithm, failed):
+        for relative, mode in batch_directories:
+            directories[relative] = mode
+        for relative, size, modified, digest in batch_files:
+            files[relative] = [size, modified, digest]
+    return directories, files
+
+def diff_manifest(source, destination):
+    # returns the relative paths of source directories missing from
+    # destination and of source files that are new or changed. Files are
+    # compared by digest when both sides list one, by size and modification
+    # time otherwise
+    source_directories, source_files = source
+    destination_directories, destination_files = destination
+    directories = [relative for relative in source_directories if relative not in destination_directories]
+    files = []
+    for relative, (size, modified, digest) in source_files.items():
+        other = destination_files.get(relative)
+        if other is None or other[0] != size:
+            files.append(relative)
+        elif digest is not None and other[2] is not None:
+            if digest != other[2]:
+                files.append(relative)
+        elif other[1] != modified:
+            files.append(relative)
+    return directories, files
+
+def distribute_entries(entries, count):
+    # spreads (..., size) entries over up to count groups of about the same
+    # weight, largest first. Each group keeps the order of entries
+    groups = [[] for x in range(max(count, 1))]
+    weights = [0] * len(groups)
+    for index in sorted(range(len(entries)), key=lambda index: -entries[index][-1]):
+        group = weights.index(min(weights))
+        groups[group].append(index)
+        weights[group] = weights[group] + entries[index][-1] + SYNC_FILE_WEIGHT
+    return [[entries[index] for index in sorted(group)] for group in groups if group]
+
+def resolve_window(file_size, offset, length):
+    # the (offset, length) of a file served for a requested window, a
+    # negative offset counts back from the end of the file
+    if offset is not None and offset < 0:
+        offset = max(file_size + offset, 0)
+    offset = min(offset or 0, file_size)
+    if length is None or offset + length > file_size:
+        length = file_size - offset
+    return offset, length
+
+def tree_path(root, relative):
+    # relative paths come from the remote end and must stay below root
+    parts = relative.split('/')
+    if any(part in ('', '.', '..') for part in parts):
+        raise ValueError('Refusing path {} outside of the destination'.format(relative))
+    return os.path.join(root, *parts)
+
+def distribute_ranges(ranges, count, alignment = RANGE_ALIGNMENT):
+    total_size = sum(length for offset, length in ranges)
+    share = -(-total_size // max(count, 1))
+    share = -(-share // alignment) * alignment
+    groups, group, group_size = [], [], 0
+    for offset, length in ranges:
+        while length > 0:
+            piece = min(length, share - group_size)
+            group.append((offset, piece))
+            group_size += piece
+            offset += piece
+            length -= piece
+            if group_size == share:
+                groups.append(group)
+                group, group_size = [], 0
+    if group:
+        groups.append(group)
+    return groups
+
+def is_local_address(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    mapped = getattr(address, 'ipv4_mapped', None)
+    return (mapped or address).is_loopback
+
+def upload_needs(letter):
+    # bytes an upload request announces, and how many of them its filesystem
+    # still has to find. A partial file being resumed holds its blocks already
+    if letter.Stream:
+        return 0, 0
+    if letter.Extents is not None:
+        size = sum(length for offset, length in letter.Extents)
+    else:
+        size = letter.FileSize - (letter.Offset or 0) if letter.Length is None else letter.Length
+    try:
+        held = os.stat(letter.DestinationPath + PARTIAL_SUFFIX).st_blocks * 512
+    except OSError:
+        held = 0
+    return size, max(size - held, 0)
+
+def batch_needs(letter):
+    # bytes a file batch announces, and the most its filesystem has to find
+    # while it is written. A partial file left over is truncated first, and
+    # each file frees the blocks of the one it replaces once complete
+    size = sum(entry[1] for entry in letter.Files)
+    needed, space = 0, 0
+    for relative, file_size, modified, mode in letter.Files:
+        try:
+            path = tree_path(letter.DestinationPath, relative)
+        except ValueError:
+            continue
+        held = []
+        for existing in (path + PARTIAL_SUFFIX, path):
+            try:
+                held.append(os.stat(existing).st_blocks * 512)
+            except OSError:
+                held.append(0)
+        needed = needed + file_size - held[0]
+        space = max(space, needed)
+        needed = needed - held[1]
+    return size, space
+
+def download_size(letter):
+    # what a download request will move, as far as can be told before it is served
+    if letter.Stream:
+        return 0
+    try:
+        file_size = os.stat(letter.DownloadPath).st_size
+    except OSError:
+        return 0
+    return resolve_window(file_size, letter.Offset, letter.Length)[1]
+
+def limits_reply(shaper, letter, address, workers = None):
+    # applies a LimitsLetter from address, answering with the limits in effect
+    changes = (letter.GlobalLimit, letter.ClientLimit, letter.ConnectionLimit)
+    if any(limit is not None for limit in changes):
+        if not is_local_address(address):
+            l = RejectionLetter()
+            l.Reason = 'Rate limits can only be changed from the server host'
+            return l
+        if workers is not None:
+            workers.apply_limits(*changes)
+            workers.set_limits(*changes)
+        else:
+            shaper.set_limits(*changes)
+    l = LimitsLetter()
+    l.GlobalLimit, l.ClientLimit, l.ConnectionLimit = workers.limits() if workers is not None else (shaper.global_limit, shaper.client_limit, shaper.connection_limit)
+    return l
+
 def parse_path_set(paths):
     return [ParsedPath(p) for p in paths]
 
@@ -500,50 +6143,289 @@ def get_host_port(remote_str):
     else:
         return remote_str, DEFAULT_PORT
 
+def validate_chunk_size(chunk_size):
+    if chunk_size < 1 or chunk_size > MAX_CHUNK_SIZE:
+        raise InvalidChunkSizeError(chunk_size)
+
+def validate_stream_count(streams):
+    if streams < 1:
+        raise InvalidStreamCountError(streams)
+
+def validate_queue_depth(queue_depth):
+    if queue_depth < 0:
+        raise InvalidQueueDepthError(queue_depth)
+
+def validate_length(length):
+    if length is not None and length < 0:
+        raise InvalidLengthError(length)
+
+def validate_compression_level(compression, level):
+    if compression is not None and level is not None and level not in COMPRESSION_LEVEL_RANGES[compression]:
+        raise InvalidCompressionLevelError(compression, level)
+
+def parse_durability(value):
+    # returns the policy and the bytes between syncs of a periodic one
+    policy, separator, interval = value.partition(':')
+    if policy in (DURABILITY_NONE, DURABILITY_END) and not separator:
+        return policy, 0
+    if policy == DURABILITY_PERIODIC and interval.isdigit() and int(interval) > 0:
+        return policy, int(interval) * 1024 * 1024
+    raise InvalidDurabilityError(value)
+
+def validate_rate_limit(limit):
+    if limit is not None and limit < 0:
+        raise InvalidRateLimitError(limit)
+
+def validate_admission_limit(limit):
+    if limit < 0:
+        raise InvalidAdmissionLimitError(limit)
+
+def validate_worker_count(count, max_transfers):
+    if count < 1:
+        raise InvalidWorkerCountError(count)
+    # every worker needs a share of at least one transfer, a share of 0 would not limit it
+    if 0 < max_transfers < count:
+        raise TransfersBelowWorkersError(max_transfers, count)
+
+def build_admission_control(args, workers):
+    if workers is None:
+        return AdmissionControl(args.max_transfers, args.max_inflight)
+    return AdmissionControl(workers.share(args.max_transfers), workers.share(args.max_inflight))
+
+def build_shaper(args):
+    for limit in (args.rate_limit, args.client_rate_limit, args.connection_rate_limit):
+        validate_rate_limit(limit)
+    return BandwidthShaper(args.rate_limit or 0, args.client_rate_limit or 0, args.connection_rate_limit or 0)
+
 def handle_server(args):
+    validate_chunk_size(args.chunk_size)
+    validate_queue_depth(args.queue_depth)
+    validate_admission_limit(args.max_transfers)
+    validate_admission_limit(args.max_inflight)
+    validate_worker_count(args.workers, args.max_transfers)
     listen_host, listen_port = get_host_port(args.listen)
     if args.verbose:
         print('Picked server initiation on host {} port {}'.format(listen_host, listen_port))
 
+    if args.workers > 1:
+        run_workers(args, listen_host, listen_port)
+    else:
+        start_server(args, listen_host, listen_port)
+
+def run_workers(args, listen_host, listen_port):
+    # the supervisor binds the port first, settling an ephemeral one and
+    # failing before any worker starts when it is taken. Its socket never
+    # listens, so connections only go to the workers
+    reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reservation.bind((listen_host, listen_port))
+    listen_port = reservation.getsockname()[1]
+    workers = WorkerGroup(tempfile.mkdtemp(prefix='tpft-workers-'), args.workers)
+    # pid: (index, started)
+    running = {}
+    # terminating the supervisor takes the workers down with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for index in range(args.workers):
+            running[fork_worker(args, listen_host, listen_port, workers, index)] = (index, time.monotonic())
+        while True:
+            pid, status = os.wait()
+            index, started = running.pop(pid)
+            print('[SRV] Worker {} exited with status {}, replacing it'.format(index, os.waitstatus_to_exitcode(status)))
+            time.sleep(max(0, started + WORKER_RESTART_INTERVAL - time.monotonic()))
+            running[fork_worker(args, listen_host, listen_port, workers, index)] = (index, time.monotonic())
+    finally:
+        for pid in running:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in running:
+            os.waitpid(pid, 0)
+        shutil.rmtree(workers.directory, ignore_errors=True)
+        reservation.close()
+
+def fork_worker(args, listen_host, listen_port, workers, index):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    status = 0
+    try:
+        # interrupts are the supervisor's to handle
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        workers.join(index)
+        if args.verbose:
+            print('[SRV] Worker {} running as pid {}'.format(index, os.getpid()))
+        start_server(args, listen_host, listen_port, workers)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def start_server(args, listen_host, listen_port, workers = None):
+    if args.engine == ENGINE_ASYNCIO:
+        srv = AsyncTpftServer(listen_host, listen_port)
+        srv.verbose = args.verbose
+        srv.display_progress = args.progress
+        srv.chunk_size = args.chunk_size
+        srv.file_cache = FileCache(args.cache_size) if args.cache_size > 0 else None
+        srv.bandwidth_shaper = build_shaper(args)
+        srv.admission_control = build_admission_control(args, workers)
+        srv.durability, srv.sync_interval = parse_durability(args.durability)
+        srv.workers = workers
+        if workers is not None:
+            workers.serve(srv.transfer_registry, srv.bandwidth_shaper)
+        srv.start()
+        return
+
     srv_connection_details = TinyProtoConnectionDetails(listen_host, listen_port)
     srv = TpftServer(listen_addresses = [srv_connection_details], connection_handler = TpftServerConnection)
     srv.verbose = args.verbose
     srv.display_progress = args.progress
+    srv.chunk_size = args.chunk_size
+    srv.queue_depth = args.queue_depth
+    srv.file_cache = FileCache(args.cache_size) if args.cache_size > 0 else None
+    srv.transfer_registry = TransferRegistry()
+    srv.bandwidth_shaper = build_shaper(args)
+    srv.admission_control = build_admission_control(args, workers)
+    srv.durability, srv.sync_interval = parse_durability(args.durability)
+    srv.workers = workers
+    if workers is not None:
+        workers.serve(srv.transfer_registry, srv.bandwidth_shaper)
     srv.start()
 
+def handle_client_limits(args):
+    for limit in (args.rate_limit, args.client_rate_limit, args.connection_rate_limit):
+        validate_rate_limit(limit)
+    host, port = get_host_port(args.limits)
+    client = build_client(args)
+    limits = client.set_limits(TinyProtoConnectionDetails(host, port), args.rate_limit, args.client_rate_limit, args.connection_rate_limit)
+    if limits is not None:
+        print(json.dumps(limits, indent=2))
+
+def handle_client_stats(args):
+    host, port = get_host_port(args.stats)
+    client = build_client(args)
+    stats = client.request_stats(TinyProtoConnectionDetails(host, port))
+    if stats is not None:
+        print(json.dumps(stats, indent=2))
+
 def handle_client(args):
+    validate_chunk_size(args.chunk_size)
+    validate_stream_count(args.streams)
+    validate_queue_depth(args.queue_depth)
+    parse_durability(args.durability)
+    validate_compression_level(args.compress, args.compress_level)
+    validate_length(args.length)
     parsed_paths = parse_path_set(args.path)
+    ranged = args.offset is not None or args.length is not None or args.follow
 
     if len(parsed_paths) <= 1:
         raise InsufficientPathsProvidedError()
-    elif len(parsed_paths) > 2 and not parsed_paths[0].is_remote:
+    elif len(parsed_paths) > 2 and not parsed_paths[0].is_remote and not parsed_paths[-1].is_remote:
         raise MultipleUploadsUnsupportedError()
     elif len([True for p in parsed_paths if p.is_remote]) > 1:
         raise MultipleRemotePathsError()
     elif len([True for p in parsed_paths if p.is_remote]) < 1:
         raise NoRemotePathError()
-    elif len(parsed_paths) == 2 and parsed_paths[1].is_remote:
-        if not parsed_paths[0].fileexists:
-            raise LocalPathFileDoesNotExistError(parsed_paths[0].path)
-        handle_client_upload(parsed_paths, args.progress)
+    elif any(p.isstream for p in parsed_paths) and (len(parsed_paths) > 2 or ranged or args.recursive or args.sync or args.resume or args.delta):
+        raise StreamRequiresSingleFileError()
+    elif ranged and (parsed_paths[-1].is_remote or args.recursive or args.sync):
+        raise RangeRequiresDownloadError()
+    elif parsed_paths[0].isstream:
+        handle_client_stream_upload(parsed_paths, args)
+    elif parsed_paths[-1].is_remote:
+        for local_path in parsed_paths[:-1]:
+            if local_path.isdirectory and not args.recursive and not args.sync:
+                raise DirectoryRequiresRecursiveError(local_path.path)
+            elif not local_path.fileexists and not local_path.isdirectory:
+                raise LocalPathFileDoesNotExistError(local_path.path)
+        if args.sync:
+            handle_client_sync_upload(parsed_paths, args)
+        elif len(parsed_paths) > 2 or args.recursive:
+            handle_client_tree_upload(parsed_paths, args)
+        else:
+            handle_client_upload(parsed_paths, args)
+    elif parsed_paths[-1].isstream:
+        handle_client_stream_download(parsed_paths, args)
+    elif args.sync:
+        handle_client_sync_download(parsed_paths, args)
+    elif args.recursive:
+        handle_client_tree_download(parsed_paths, args)
     else:
-        handle_client_download(parsed_paths, args.progress)
+        handle_client_download(parsed_paths, args)
 
-def handle_client_upload(parsed_paths, progress = False):
-    local_path, remote_path = parsed_paths
+def build_client(args):
     client = TpftClient()
-    client.upload_file(local_path, remote_path, progress)
+    client.chunk_size = args.chunk_size
+    client.queue_depth = args.queue_depth
+    client.digest = args.digest if args.verify else None
+    client.compression = args.compress
+    client.compression_level = args.compress_level
+    client.control = args.control
+    client.verbose = args.verbose
+    client.durability, client.sync_interval = parse_durability(args.durability)
+    return client
 
-def handle_client_download(parsed_paths, progress):
+def handle_client_upload(parsed_paths, args):
+    local_path, remote_path = parsed_paths
+    client = build_client(args)
+    client.upload_file(local_path, remote_path, args.progress, args.streams, args.resume, args.delta)
+
+def handle_client_download(parsed_paths, args):
     remote_path, local_path = parsed_paths
-    client = TpftClient()
-    client.download_file(remote_path, local_path, progress)
+    client = build_client(args)
+    client.download_file(remote_path, local_path, args.progress, args.streams, args.resume, args.offset, args.length, args.follow)
+
+def handle_client_stream_upload(parsed_paths, args):
+    local_path, remote_path = parsed_paths
+    client = build_client(args)
+    client.upload_stream(sys.stdin.fileno(), remote_path, args.progress)
+
+def handle_client_stream_download(parsed_paths, args):
+    remote_path, local_path = parsed_paths
+    client = build_client(args)
+    # the data owns stdout, anything printed goes to stderr
+    output = sys.stdout.fileno()
+    sys.stdout.flush()
+    sys.stdout = sys.stderr
+    client.download_stream(remote_path, output, args.progress)
+
+def handle_client_tree_upload(parsed_paths, args):
+    client = build_client(args)
+    client.upload_tree(parsed_paths[:-1], parsed_paths[-1], args.progress)
 
+def handle_client_tree_download(parsed_paths, args):
+    remote_path, local_path = parsed_paths
+    client = build_client(args)
+    client.download_tree(remote_path, local_path, args.progress)
+
+def handle_client_sync_upload(parsed_paths, args):
+    client = build_client(args)
+    client.sync_tree_upload(parsed_paths[:-1], parsed_paths[-1], args.progress, args.streams, args.digest if args.checksum else None)
+
+def handle_client_sync_download(parsed_paths, args):
+    remote_path, local_path = parsed_paths
+    client = build_client(args)
+    client.sync_tree_download(remote_path, local_path, args.progress, args.streams, args.digest if args.checksum else None)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench']:
+        import bench_transfers
+        bench_transfers.main(sys.argv[2:])
+        sys.exit()
     args = arg_parser.parse_args()
     try:
-        if args.listen is None:
+        if args.stats is not None:
+            handle_client_stats(args)
+        elif args.limits is not None:
+            handle_client_limits(args)
+        elif args.listen is None:
             handle_client(args)
         else:
             handle_server(args)
@@ -561,6 +6443,35 @@ if __name__ == '__main__':
         print('Multiple remote paths is not supported')
     except NoRemotePathError as e:
         print('One of the paths needs to be a remote path')
+    except DirectoryRequiresRecursiveError as e:
+        print('Path {} is a directory. Use -r to transfer directories'.format(e.args[0]))
+    except IntegrityCheckFailedError as e:
+        print('Integrity check FAILED: {}'.format(e.args[0]))
+        raise SystemExit(1)
+    except InvalidChunkSizeError as e:
+        print('Chunk size {} invalid. It must be between 1 and {} bytes'.format(e.args[0], MAX_CHUNK_SIZE))
+    except InvalidStreamCountError as e:
+        print('Stream count {} invalid. It must be 1 or more'.format(e.args[0]))
+    except InvalidQueueDepthError as e:
+        print('Queue depth {} invalid. It must be 0 to disable pipelining or a number of chunks'.format(e.args[0]))
+    except InvalidDurabilityError as e:
+        print('Durability {} invalid. Use none, end or periodic:N with N a number of MB'.format(e.args[0]))
+    except InvalidLengthError as e:
+        print('Length {} invalid. It must be a number of bytes, 0 or more'.format(e.args[0]))
+    except RangeRequiresDownloadError as e:
+        print('--offset, --length and --follow only apply to downloads of a single file')
+    except StreamRequiresSingleFileError as e:
+        print('{} streams a single file through stdin or stdout. It cannot be combined with -r, --sync, --resume, --delta, --offset, --length or --follow'.format(STREAM_PATH))
+    except InvalidRateLimitError as e:
+        print('Rate limit {} invalid. It must be 0 for unlimited or a number of bytes per second'.format(e.args[0]))
+    except InvalidAdmissionLimitError as e:
+        print('Admission limit {} invalid. It must be 0 for unlimited or a positive number'.format(e.args[0]))
+    except InvalidWorkerCountError as e:
+        print('Worker count {} invalid. It must be 1 or more'.format(e.args[0]))
+    except TransfersBelowWorkersError as e:
+        print('--max-transfers {} is shared by {} workers. It must be 0 or at least the number of workers'.format(e.args[0], e.args[1]))
+    except InvalidCompressionLevelError as e:
+        print('Compression level {} invalid for {}. It must be between {} and {}'.format(e.args[1], e.args[0], COMPRESSION_LEVEL_RANGES[e.args[0]][0], COMPRESSION_LEVEL_RANGES[e.args[0]][-1]))
     except Exception as e:
         print('Unhandled exception! PANIC!')
         raise e